@@ -1,26 +1,53 @@
 import os
 import csv
+import operator
 import json
 import shutil
 import threading
+import queue
 import time
+import random
 import logging
+import logging.handlers
 import requests
+import requests.adapters
 import urllib
 import schedule
-from datetime import datetime
+from datetime import datetime, timedelta
 import urllib.parse
-from collections import defaultdict
+import urllib.request
+from collections import defaultdict, OrderedDict
+import sqlite3
+import gzip
+import zipfile
+import hashlib
 import sys
+import functools
+import argparse
+import signal
+import atexit
+import concurrent.futures
+import http.server
+import select
+import struct
+import ctypes
+import ctypes.util
 
 # Define the password for reset (retrieve from environment variable for security else default value)
 RESET_PASSWORD = os.getenv('RESET_PASSWORD', 'Kayneskt01')  # Changes based on plant - WIN - set RESET_PASSWORD=anypassword
 
 # Configure logging
 log_file_path = os.path.join(os.path.dirname(__file__), 'LM_app.log')
-logging.basicConfig(filename=log_file_path, 
-                    level=logging.INFO, 
-                    format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Function to start logging to LM_app.log - called by main() and the tools, so importing the program
+# (tests, benchmark) writes no log file next to it. path redirects the log, e.g. into a scratch folder.
+def init_logging(path=None):
+    global log_file_path
+    if path:
+        log_file_path = path
+    logging.basicConfig(filename=log_file_path,
+                        level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
 
 # Get the current directory of the app
 current_directory = os.path.dirname(os.path.abspath(__file__))
@@ -32,6 +59,9 @@ folders = {
     "Backup_Folder": os.path.join(current_directory, "Backup_Folder"),
     "Logs_Folder": os.path.join(current_directory, "Logs_Folder"),
     "Done_Folder": os.path.join(current_directory, "Done_Folder"),  # Added cmd.py_10
+    "State_Folder": os.path.join(current_directory, "State_Folder"),
+    "Export_Folder": os.path.join(current_directory, "Export_Folder"),
+    "Sources_Folder": os.path.join(current_directory, "Sources_Folder"),  # Staging state of the extra sources
 
 }
 
@@ -42,6 +72,459 @@ log_folders = {
     "Parser_Logs": os.path.join(folders["Logs_Folder"], "Parser_Logs"),
 }
 
+# Defining tunable settings - defaults used when the key is missing in config.json
+settings = {
+    "ERP_Batch_Size": 500,  # Max laser_marking rows sent to ERP in one update per work order
+    "ERP_Append_Mode": "child_insert",  # child_insert - send only new rows, full_rewrite - GET + PUT whole table
+    "ERP_Child_Doctype": "Laser Marking",  # Child doctype behind the laser_marking table field
+    "Parent_Cache_Size": 1024,  # Max model_id -> parent name entries kept in memory (LRU)
+    "Parent_Cache_TTL": 3600,  # Seconds a known parent name is trusted
+    "Parent_Cache_Negative_TTL": 30,  # Seconds a "no parent yet" answer is trusted
+    "Parent_Cache_Persist": True,  # Keep the parent names in State_Folder across restarts
+    "ERP_Pool_Size": 10,  # Keep-alive connections kept open to the ERP server
+    "ERP_Keep_Alive": True,
+    "ERP_Connect_Timeout": 5,  # Seconds
+    "ERP_Read_Timeout": 30,  # Seconds
+    "ERP_Max_RPS": 0,  # Max ERP requests per second over all threads, 0 - no limit
+    "Upload_Concurrency": 4,  # Work orders uploaded in parallel, rows of one work order always go out in order
+    "Bulk_Parent_Create": True,  # One lookup for all work orders of a batch, new parents created with one insert_many
+    "Breaker_Failure_Threshold": 5,  # Consecutive failed ERP requests before uploads are paused
+    "Breaker_Reset_Timeout": 60,  # Seconds uploads stay paused before one probe request is tried
+    "Outbox_Backoff_Base": 15,  # Seconds before the first retry of a failed row, doubled on every failure
+    "Outbox_Backoff_Max": 900,  # Upper limit of the retry wait in seconds
+    "Outbox_Retention_Days": 30,  # Days delivered rows are kept for serial_no de-duplication
+    "Ingest_Manifest_Retention_Days": 30,  # Days a copied file stays in the ingestion manifest once gone from the machine folder
+    "Output_Format": "jsonl",  # jsonl - streaming append per CSV, json - whole document rewritten per CSV
+    "Ingest_Mode": "schedule",  # schedule - scheduled cycles only, watch - event driven ingest + scheduled sweep
+    "Watcher": "auto",  # auto, inotify or polling
+    "Watch_Poll_Interval": 2,  # Seconds between scans of the polling watcher
+    "Settle_Seconds": 2,  # Seconds a file size must stay unchanged before it is ingested
+    "Staging_Mode": "copy",  # copy - copy2 into Scan_Folder, link - hardlink/reflink, direct - parse in place + .gz backup
+    "Incremental_Scan": True,  # Only look at new machine folder entries between full scans
+    "Scan_Full_Interval": 3600,  # Seconds between full rescans of the machine folder
+    "Scan_Hot_Seconds": 300,  # Files modified more recently than this are checked again on every scan
+    "Workflow_Mode": "pipeline",  # pipeline - collector/parser/uploader threads, sequential - one task_workflow per tick
+    "Queue_Size": 1000,  # Max items waiting between two pipeline stages
+    "Upload_Workers": 1,  # Uploader threads in pipeline mode
+    "Parse_Batch_Size": 200,  # Max staged files parsed into one JSON file
+    "Upload_Batch_Files": 20,  # Max queued JSON files (of any source) merged into one upload batch
+    "Pairing_Buffer_Enabled": True,  # Keep unmatched -T/-B marks across CSV files until their other side arrives
+    "Pairing_Window_Seconds": 600,  # A half older than this (by DateTime) than the newest mark is sent single sided
+    "Pairing_Max_Wait_Seconds": 3600,  # Wall clock limit for a half while no new marks arrive
+    "Pairing_Buffer_Size": 20000,  # Max halves held, the oldest is sent single sided beyond that
+    "Serial_Index_Export_Interval": 60,  # Min seconds between updates of the serial_no index export in Done_Folder
+    "Serial_Index_Retention_Days": 365,  # Boards not seen for this many days are dropped from the index, 0 - never
+    "Export_Bundles": True,  # Write Done records into rolling compressed bundles in Export_Folder
+    "Export_Windows_Hours": [24, 48],  # One manifest per window, older segments are pruned
+    "Archive_Enabled": False,  # Shard old Backup_Folder / Done_Folder files by day and pack closed days into zips
+    "Archive_After_Hours": 48,  # Files stay loose in the folder this long (keeps the 24/48 h windows untouched)
+    "Archive_Interval_Minutes": 60,  # Minutes between archive runs
+    "Archive_Retention_Days": 0,  # Days archived files are kept, 0 - forever
+    "Archive_Max_MB": 0,  # Max size of the archives per folder, the oldest days are deleted beyond it (0 - no limit)
+    "Metrics_Enabled": False,  # Per-stage timings and counters, served on the local metrics endpoint
+    "Metrics_Host": "127.0.0.1",
+    "Metrics_Port": 9108,
+    "Metrics_Snapshot_Interval": 60,  # Seconds between JSON snapshots written to State_Folder
+    "Quiet_Mode": False,  # No console line per copied, parsed, backed up or uploaded file - errors are still shown
+    "Log_Max_Bytes": 10485760,  # LM_app.log is rotated beyond this size (0 - no size limit)
+    "Log_Rotate_Daily": True,  # LM_app.log is also rotated at midnight
+    "Log_Backup_Count": 30,  # Rotated LM_app.log files kept, gzip compressed
+    "Buffered_Audit_Logs": True,  # Copy/Parser/Backup log lines are written in batches by a background thread
+    "Schedule_Frequency": 10,  # Minutes between scheduled cycles in headless mode (asked on start otherwise)
+    "Catch_Up_On_Start": True,  # Run one cycle right after start instead of waiting a full interval
+    "Shutdown_Timeout": 60,  # Seconds a graceful stop waits for queued and running uploads
+}
+
+# Defining persistent state files in State_Folder
+state_files = {
+    "Ingest_Manifest": os.path.join(folders["State_Folder"], "ingest_manifest.db"),
+    "Parent_Cache": os.path.join(folders["State_Folder"], "parent_cache.json"),
+    "Outbox": os.path.join(folders["State_Folder"], "outbox.db"),
+    "Serial_Index": os.path.join(folders["State_Folder"], "serial_index.db"),
+    "Metrics_Snapshot": os.path.join(folders["State_Folder"], "metrics_snapshot.json"),
+    "Pairing_Buffer": os.path.join(folders["State_Folder"], "pairing_buffer.json"),
+    "Archive_Index": os.path.join(folders["State_Folder"], "archive_index.db"),
+    "Control_File": os.path.join(folders["State_Folder"], "lm_control.txt"),
+    "Status_File": os.path.join(folders["State_Folder"], "lm_status.json"),
+}
+
+#----------------------------------------------------------------------------Logging----!
+
+# LM_app.log handler rotating by size and at midnight, rotated files are gzip compressed (LM_app.log.1.gz, ...)
+class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    def __init__(self, filename, max_bytes=0, backup_count=30, daily=True):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+        self.daily = daily
+        self.rollover_at = self.next_midnight()
+        self.namer = lambda name: name + ".gz"
+        self.rotator = self.compress
+
+    @staticmethod
+    def next_midnight():
+        return (datetime.now() + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+
+    @staticmethod
+    def compress(source, dest):
+        with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
+    def shouldRollover(self, record):
+        if self.daily and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = self.next_midnight()
+
+log_listener = None
+
+# Function to move LM_app.log writing onto a background thread - log calls only put the record on a queue,
+# a QueueListener formats it and writes it to the rotating file handler
+def setup_logging():
+    global log_listener
+    if log_listener is not None:
+        return log_listener
+    file_handler = CompressingRotatingFileHandler(log_file_path, max_bytes=settings["Log_Max_Bytes"],
+                                                  backup_count=settings["Log_Backup_Count"],
+                                                  daily=settings["Log_Rotate_Daily"])
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+
+    log_queue = queue.Queue(-1)
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    log_listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(shutdown_logging)
+    return log_listener
+
+# Function to write out everything still queued - LM_app.log and the audit logs
+def shutdown_logging():
+    global log_listener
+    if audit_log is not None:
+        audit_log.flush()
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+# Helper function for the per-file console lines, silenced in Quiet_Mode
+def console(message):
+    if not settings["Quiet_Mode"]:
+        print(message)
+
+# Buffered writer for the Copy/Parser/Backup logs - lines are queued and appended by one background thread,
+# a whole batch per file in one write, and the files stay open between batches instead of one open per line
+class AuditLogWriter:
+    IDLE_CLOSE = 60  # Seconds an unused log file stays open (yesterday's file gets closed)
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.files = {}  # path -> [file, last write]
+        self.thread = threading.Thread(target=self.run, name="LM-audit-log", daemon=True)
+        self.thread.start()
+
+    def write(self, path, line):
+        self.queue.put((path, line))
+
+    # Blocks until everything queued so far is on disk
+    def flush(self, timeout=10):
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def run(self):
+        while True:
+            try:
+                items = [self.queue.get(timeout=self.IDLE_CLOSE)]
+            except queue.Empty:
+                self.close_idle()
+                continue
+            while len(items) < 10000:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = defaultdict(list)
+            events = []
+            for item in items:
+                if isinstance(item, threading.Event):
+                    events.append(item)
+                else:
+                    lines[item[0]].append(item[1])
+            for path, batch in lines.items():
+                try:
+                    entry = self.files.get(path)
+                    if entry is None:
+                        entry = self.files[path] = [open(path, 'a', buffering=1024 * 1024), 0]
+                    entry[0].write("".join(batch))
+                    entry[0].flush()
+                    entry[1] = time.time()
+                except Exception as e:
+                    logging.error(f"Failed to write {len(batch)} line(s) to {path}: {e}")
+            self.close_idle()
+            for event in events:
+                event.set()
+
+    def close_idle(self):
+        now = time.time()
+        for path, (f, last_write) in list(self.files.items()):
+            if now - last_write > self.IDLE_CLOSE:
+                f.close()
+                del self.files[path]
+
+
+audit_log = None
+audit_log_lock = threading.Lock()
+
+# Helper function to start the audit log writer once per process
+def get_audit_log():
+    global audit_log
+    with audit_log_lock:
+        if audit_log is None:
+            audit_log = AuditLogWriter()
+            atexit.register(audit_log.flush)
+        return audit_log
+
+# Helper function to append one line to a Copy/Parser/Backup log
+def write_audit_line(log_file, line):
+    if settings["Buffered_Audit_Logs"]:
+        get_audit_log().write(log_file, line)
+    else:
+        with open(log_file, 'a') as log:
+            log.write(line)
+
+#----------------------------------------------------------------------------Metrics----!
+
+# Per-stage instrumentation - counters, gauges and timing histograms, served in Prometheus text format on a
+# local HTTP endpoint and written as a periodic JSON snapshot. While disabled every call returns after one flag check.
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_TIMER = NullTimer()
+
+class MetricTimer:
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self.gauges = {}  # (name, labels) -> callable returning the current value
+        self.help = {}
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[self.key(name, labels)] += value
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        with self.lock:
+            values = self.histograms.setdefault(self.key(name, labels), [0] * (len(METRIC_BUCKETS) + 2))
+            for index, bound in enumerate(METRIC_BUCKETS):
+                if seconds <= bound:
+                    values[index] += 1
+            values[-2] += seconds
+            values[-1] += 1
+
+    def timer(self, name, **labels):
+        if not self.enabled:
+            return NULL_TIMER
+        return MetricTimer(self, name, labels)
+
+    # Decorator - times every call of a stage function into lm_stage_seconds{stage=...}
+    def timed(self, stage):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with MetricTimer(self, "lm_stage_seconds", {"stage": stage}):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    # Gauges are read when scraped, so they cost nothing between scrapes
+    def gauge(self, name, func, **labels):
+        with self.lock:
+            self.gauges[self.key(name, labels)] = func
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def read_gauges(self):
+        with self.lock:
+            gauges = list(self.gauges.items())
+        values = {}
+        for key, func in gauges:
+            try:
+                value = func()
+            except Exception:
+                continue
+            if value is not None:
+                values[key] = value
+        return values
+
+    @staticmethod
+    def format_labels(labels, extra=None):
+        items = list(labels) + ([extra] if extra else [])
+        if not items:
+            return ""
+        return "{" + ",".join(f'{key}="{str(value)}"' for key, value in items) + "}"
+
+    def render_prometheus(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(values) for key, values in self.histograms.items()}
+        gauges = self.read_gauges()
+
+        lines = []
+        typed = set()
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{self.format_labels(labels)} {value}")
+        for (name, labels), value in sorted(gauges.items()):
+            header(name, "gauge")
+            lines.append(f"{name}{self.format_labels(labels)} {value}")
+        for (name, labels), values in sorted(histograms.items()):
+            header(name, "histogram")
+            for bound, count in zip(METRIC_BUCKETS, values):
+                lines.append(f"{name}_bucket{self.format_labels(labels, ('le', bound))} {count}")
+            lines.append(f"{name}_bucket{self.format_labels(labels, ('le', '+Inf'))} {values[-1]}")
+            lines.append(f"{name}_sum{self.format_labels(labels)} {values[-2]}")
+            lines.append(f"{name}_count{self.format_labels(labels)} {values[-1]}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        def label_text(name, labels):
+            return name + self.format_labels(labels)
+        with self.lock:
+            counters = {label_text(*key): value for key, value in self.counters.items()}
+            histograms = {label_text(*key): {"count": values[-1], "sum": round(values[-2], 6)}
+                          for key, values in self.histograms.items()}
+        gauges = {label_text(*key): value for key, value in self.read_gauges().items()}
+        return {
+            "timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "counters": counters,
+            "gauges": gauges,
+            "histograms": histograms
+        }
+
+
+metrics = Metrics()
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith("/metrics.json"):
+            body, content_type = json.dumps(metrics.snapshot(), indent=4).encode(), "application/json"
+        elif self.path.startswith("/metrics"):
+            body, content_type = metrics.render_prometheus().encode(), "text/plain; version=0.0.4"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes are not worth an LM_app.log line
+
+# Function to enable metrics, start the local endpoint and the periodic JSON snapshot writer
+def start_metrics(host="127.0.0.1", port=9108, snapshot_file=None, snapshot_interval=60):
+    metrics.enabled = True
+    register_metric_gauges()
+    try:
+        server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="LM-metrics", daemon=True).start()
+        logging.info(f"Metrics endpoint on http://{host}:{port}/metrics")
+    except OSError as e:
+        server = None
+        logging.error(f"Metrics endpoint not started: {e}")
+
+    if snapshot_file:
+        def write_snapshots():
+            while True:
+                time.sleep(snapshot_interval)
+                try:
+                    with open(snapshot_file + ".tmp", 'w') as f:
+                        json.dump(metrics.snapshot(), f, indent=4)
+                    os.replace(snapshot_file + ".tmp", snapshot_file)
+                except Exception as e:
+                    logging.error(f"Failed to write metrics snapshot: {e}")
+        threading.Thread(target=write_snapshots, name="LM-metrics-snapshot", daemon=True).start()
+    return server
+
+# Helper function to count waiting files of a folder for the gauges
+def count_files(folder, extensions=None):
+    try:
+        with os.scandir(folder) as entries:
+            return sum(1 for entry in entries if entry.is_file() and (extensions is None or entry.name.endswith(extensions)))
+    except FileNotFoundError:
+        return 0
+
+def register_metric_gauges():
+    metrics.describe("lm_stage_seconds", "Wall time per workflow stage call")
+    metrics.describe("lm_erp_request_seconds", "ERP request latency by operation")
+    for source in active_sources or [resolve_source(None)]:
+        metrics.gauge("lm_pending_json_files",
+                      lambda source=source: count_files(source.folders["JSON_Data_Folder"], ('.json', '.jsonl')),
+                      source=source.name)
+        metrics.gauge("lm_scan_folder_files", lambda source=source: count_files(source.folders["Scan_Folder"]),
+                      source=source.name)
+    for queue_name in ("collect_queue", "parse_queue", "upload_queue"):
+        metrics.gauge("lm_queue_depth",
+                      lambda queue_name=queue_name: active_pipeline.stats()[queue_name] if active_pipeline else None,
+                      queue=queue_name)
+    metrics.gauge("lm_erp_breaker_open",
+                  lambda: 0 if erp_breaker is None or erp_breaker.state == CircuitBreaker.CLOSED else 1)
+    metrics.describe("lm_parent_cache_lookups", "Parent name cache lookups since start by result")
+    metrics.gauge("lm_parent_cache_entries", lambda: parent_cache.stats()["size"] if parent_cache else None)
+    metrics.gauge("lm_parent_cache_evictions", lambda: parent_cache.stats()["evictions"] if parent_cache else None)
+    for result, counter in (("hit", "hits"), ("negative_hit", "negative_hits"), ("miss", "misses")):
+        metrics.gauge("lm_parent_cache_lookups",
+                      lambda counter=counter: parent_cache.stats()[counter] if parent_cache else None,
+                      result=result)
+
 # Create folders. error handling added in cmd_3.py
 def create_folders():
     try:
@@ -63,7 +546,8 @@ def write_folder_paths_to_file(api_key, api_secret, erp_url, machine_data_folder
             "ERP_URL": erp_url,
             "Machine_Data_Folder": machine_data_folder,
             "Folders": folders,
-            "Log_Folders": log_folders
+            "Log_Folders": log_folders,
+            "Settings": settings
         }
 
         config_file = os.path.join(current_directory, "config.json")
@@ -75,9 +559,9 @@ def write_folder_paths_to_file(api_key, api_secret, erp_url, machine_data_folder
         print(f"Failed to write configuration file: {e}")
 
 # Function to load inputs from the config file
-def load_inputs_from_file():
+def load_inputs_from_file(config_file=None):
     try:
-        config_file = os.path.join(current_directory, "config.json")
+        config_file = config_file or os.path.join(current_directory, "config.json")
         if os.path.exists(config_file):
             with open(config_file, 'r') as f:
                 logging.info("Inputs loaded from Config file.")
@@ -86,6 +570,14 @@ def load_inputs_from_file():
         logging.error(f"Failed to load configuration file: {e}")
     return None
 
+# Function to apply optional tunables from the config file over the defaults in settings
+def apply_settings(config):
+    for key, value in config.get("Settings", {}).items():
+        if key in settings:
+            settings[key] = value
+        else:
+            logging.warning(f"Unknown setting ignored: {key}")
+
 # Function to get inputs from the user (if not available in the config file)
 def get_inputs():
     print("Please provide the following inputs:")
@@ -96,42 +588,377 @@ def get_inputs():
     logging.info("User Input Registered.")
     return api_key, api_secret, erp_url, machine_data_folder
 
+# Persistent ingestion manifest - remembers every copied machine file across days and restarts.
+# Keyed by file name + size/mtime fingerprint, so a file rewritten by the machine is picked up again.
+class IngestManifest:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS ingested ("
+            "file_name TEXT NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, "
+            "ingested_at TEXT NOT NULL, PRIMARY KEY (file_name, size, mtime_ns))"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.commit()
+
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ingested_at ON ingested (ingested_at)")
+        self.conn.commit()
+
+        # In-memory hash set for O(1) "already ingested?" checks
+        self.seen = set(self.conn.execute("SELECT file_name, size, mtime_ns FROM ingested"))
+        self.migrated = self.conn.execute("SELECT 1 FROM meta WHERE key = 'copy_logs_migrated'").fetchone() is not None
+        self.last_prune = 0
+
+    def contains(self, file_name, size, mtime_ns):
+        return (file_name, size, mtime_ns) in self.seen
+
+    def add(self, file_name, size, mtime_ns):
+        key = (file_name, size, mtime_ns)
+        with self.lock:
+            if key in self.seen:
+                return
+            self.conn.execute(
+                "INSERT OR IGNORE INTO ingested (file_name, size, mtime_ns, ingested_at) VALUES (?, ?, ?, ?)",
+                (file_name, size, mtime_ns, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            )
+            self.conn.commit()
+            self.seen.add(key)
+
+    # One time import of the old per-day copy_logs_YYYY-MM-DD.log files.
+    # Old logs only hold names, so the fingerprint is taken from the file still present in the machine folder.
+    def migrate_copy_logs(self, copy_logs_folder, src_folder):
+        if self.migrated:
+            return 0
+        with self.lock:
+
+            legacy_names = set()
+            if os.path.isdir(copy_logs_folder):
+                for log_name in os.listdir(copy_logs_folder):
+                    if log_name.startswith("copy_logs_") and log_name.endswith(".log"):
+                        with open(os.path.join(copy_logs_folder, log_name), 'r') as log:
+                            legacy_names.update(line.strip() for line in log if line.strip())
+
+            migrated = 0
+            now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            for file_name in legacy_names:
+                try:
+                    stat = os.stat(os.path.join(src_folder, file_name))
+                except OSError:
+                    continue  # No longer in the machine folder, nothing to skip
+                key = (file_name, stat.st_size, stat.st_mtime_ns)
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO ingested (file_name, size, mtime_ns, ingested_at) VALUES (?, ?, ?, ?)",
+                    key + (now,)
+                )
+                self.seen.add(key)
+                migrated += 1
+
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('copy_logs_migrated', ?)", (now,)
+            )
+            self.conn.commit()
+            self.migrated = True
+        logging.info(f"Migrated {migrated} entries from Copy_Logs into the ingestion manifest.")
+        return migrated
+
+    # Drop entries older than retention_days whose file is no longer in the machine folder - a file still there
+    # keeps its entry, so it is never ingested twice. Runs at most once an hour, 0 keeps everything.
+    def prune(self, retention_days, src_folder, now=None):
+        now = now or time.time()
+        if not retention_days or now - self.last_prune < 3600:
+            return 0
+        self.last_prune = now
+        cutoff = datetime.fromtimestamp(now - retention_days * 86400).strftime('%Y-%m-%d %H:%M:%S')
+        with self.lock:
+            old = self.conn.execute(
+                "SELECT file_name, size, mtime_ns FROM ingested WHERE ingested_at < ?", (cutoff,)
+            ).fetchall()
+            gone = [key for key in old if not os.path.exists(os.path.join(src_folder, key[0]))]
+            self.conn.executemany("DELETE FROM ingested WHERE file_name = ? AND size = ? AND mtime_ns = ?", gone)
+            self.conn.commit()
+            self.seen.difference_update(gone)
+        if gone:
+            logging.info(f"Ingestion manifest: {len(gone)} entries older than {retention_days} day(s) pruned.")
+        return len(gone)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+ingest_manifest = None
+
+# Helper function to open the shared ingestion manifest once per process
+def get_ingest_manifest():
+    global ingest_manifest
+    if ingest_manifest is None:
+        ingest_manifest = IngestManifest(state_files["Ingest_Manifest"])
+    return ingest_manifest
+
+# Incremental folder scanner - keeps a watermark per folder so a cycle only looks at what changed.
+# Unchanged directory mtime - nothing was added, removed or renamed and the listing is skipped entirely.
+# Otherwise the listing runs but entries already seen with the same inode are skipped without a stat.
+# Recently modified ("hot") files are stat'ed again on every scan until they settle, and a periodic full scan
+# catches anything rewritten in place. Scans return (name, path, stat) so callers never stat the file again.
+class FolderScanner:
+    def __init__(self, folder, full_interval=3600, hot_seconds=300):
+        self.folder = folder
+        self.full_interval = full_interval
+        self.hot_seconds = hot_seconds
+        self.lock = threading.Lock()
+        self.known = {}  # name -> inode (size/mtime on Windows, where DirEntry.inode() costs a stat) of settled files
+        self.hot = set()
+        self.dir_mtime_ns = None
+        self.last_scan_ns = 0
+        self.last_full = 0
+
+    @staticmethod
+    def entry_key(entry):
+        if os.name == 'nt':
+            stat = entry.stat()
+            return stat.st_size, stat.st_mtime_ns
+        return entry.inode()
+
+    def scan(self, full=False):
+        with self.lock:
+            now = time.time()
+            full = full or now - self.last_full >= self.full_interval
+            try:
+                dir_mtime_ns = os.stat(self.folder).st_mtime_ns
+            except FileNotFoundError:
+                return []
+            # The mtime is only trusted once it is clearly older than the previous listing (coarse file system clocks)
+            if (not full and dir_mtime_ns == self.dir_mtime_ns
+                    and dir_mtime_ns < self.last_scan_ns - 2_000_000_000):
+                metrics.inc("lm_scans_total", kind="unchanged")
+                return self.rescan_hot(now)
+
+            started_ns = time.time_ns()
+            results = []
+            names = set()
+            with os.scandir(self.folder) as entries:
+                for entry in entries:
+                    name = entry.name
+                    names.add(name)
+                    if not full and name not in self.hot and self.known.get(name) == self.entry_key(entry):
+                        continue
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    self.track(name, self.entry_key(entry), stat, now)
+                    results.append((name, entry.path, stat))
+
+            for name in self.known.keys() - names:
+                del self.known[name]
+            self.hot &= names
+            self.dir_mtime_ns = dir_mtime_ns
+            self.last_scan_ns = started_ns
+            if full:
+                self.last_full = now
+            metrics.inc("lm_scans_total", kind="full" if full else "incremental")
+            metrics.inc("lm_scan_entries_statted_total", len(results))
+            return results
+
+    # Directory unchanged - only the files still being written can have changed
+    def rescan_hot(self, now):
+        results = []
+        for name in list(self.hot):
+            path = os.path.join(self.folder, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                self.hot.discard(name)
+                continue
+            key = (stat.st_size, stat.st_mtime_ns) if os.name == 'nt' else stat.st_ino
+            self.track(name, key, stat, now)
+            results.append((name, path, stat))
+        return results
+
+    def track(self, name, key, stat, now):
+        if now - stat.st_mtime < self.hot_seconds:
+            self.hot.add(name)
+            self.known.pop(name, None)
+        else:
+            self.hot.discard(name)
+            self.known[name] = key
+
+    # Entries handed out but not handled (still being written, failed copy) are kept hot, so the next scan
+    # stats them again even when the directory mtime did not change
+    def keep_hot(self, names):
+        with self.lock:
+            for name in names:
+                self.known.pop(name, None)
+                self.hot.add(name)
+
+
+folder_scanners = {}
+folder_scanners_lock = threading.Lock()
+
+# Helper function to get the scanner of a folder, one per folder per process
+def get_folder_scanner(folder):
+    key = os.path.abspath(folder)
+    with folder_scanners_lock:
+        scanner = folder_scanners.get(key)
+        if scanner is None:
+            scanner = folder_scanners[key] = FolderScanner(folder, full_interval=settings["Scan_Full_Interval"],
+                                                           hot_seconds=settings["Scan_Hot_Seconds"])
+        return scanner
+
+# Helper function to list the file names of a small working folder (Scan_Folder, JSON_Data_Folder), sub folders left out
+def list_folder_files(folder, extensions=None):
+    with os.scandir(folder) as entries:
+        return sorted(entry.name for entry in entries
+                      if (extensions is None or entry.name.endswith(extensions)) and entry.is_file())
+
 # File Mover Functionality with error handling (added in cmd_5.py) - mvf.py
-def copy_new_files(src_folder, dest_folder, copy_log_file):
+# Already copied files are looked up in the persistent ingestion manifest, Copy_Logs is kept as the audit trail
+@metrics.timed("copy_new_files")
+def copy_new_files(src_folder, dest_folder, copy_log_file, manifest=None, file_names=None):
     # logging.info("Triggered File Mover functionality.")
+    copied = []
+    source_files = []
+    handled = 0
     try:
-        if os.path.exists(copy_log_file):
-            with open(copy_log_file, 'r') as log:
-                copied_files = log.read().splitlines()
-        else:
-            copied_files = []
-
-        src_files = os.listdir(src_folder)
-        for file_name in src_files:
-            src_file_path = os.path.join(src_folder, file_name)
-            dest_file_path = os.path.join(dest_folder, file_name)
-            
-            if file_name not in copied_files:
-                shutil.copy2(src_file_path, dest_file_path)
-                with open(copy_log_file, 'a') as log:
-                    log.write(f"{file_name}\n")
-                print(f"Copied {file_name} to {dest_folder}")
-                logging.info(f"Copied {file_name} to {dest_folder}")
+        if manifest is None:
+            manifest = get_ingest_manifest()
+        manifest.migrate_copy_logs(os.path.dirname(copy_log_file), src_folder)
+        manifest.prune(settings["Ingest_Manifest_Retention_Days"], src_folder)
+
+        mode = settings["Staging_Mode"]
+        unsettled = []
+        now = time.time()
+        source_files = iter_source_files(src_folder, file_names)
+        for file_name, src_file_path, stat in source_files:
+            handled += 1
+            if manifest.contains(file_name, stat.st_size, stat.st_mtime_ns):
+                continue
+            # Files picked up by a scan are only staged once they stopped changing (the watcher settles its own)
+            if file_names is None and now - stat.st_mtime < settings["Settle_Seconds"]:
+                unsettled.append(file_name)
+                continue
+            if mode == "direct":
+                # Parsed straight from the machine folder, the manifest entry is written with the archive copy
+                how = "direct"
+            else:
+                how = stage_file(src_file_path, os.path.join(dest_folder, file_name), mode)
+                manifest.add(file_name, stat.st_size, stat.st_mtime_ns)
+            copied.append(file_name)
+            metrics.inc("lm_files_copied_total", mode=how)
+            write_audit_line(copy_log_file, f"{file_name}\n")
+            message = f"Copied {file_name} to {dest_folder}" if how == "copy" else f"Staged {file_name} ({how})"
+            console(message)
+            logging.info(message)
+        if unsettled and settings["Incremental_Scan"]:
+            get_folder_scanner(src_folder).keep_hot(unsettled)
     except Exception as e:
         logging.error(f"Error during file copying: {e}")
         print(f"Error during file copying: {e}")
+        if file_names is None and settings["Incremental_Scan"]:
+            get_folder_scanner(src_folder).keep_hot(name for name, _, _ in source_files[max(handled - 1, 0):])
+    return copied
+
+# Helper function to list (name, path, stat) of the files to consider - new entries of the folder or only the given names
+def iter_source_files(src_folder, file_names=None):
+    if file_names is None:
+        if settings["Incremental_Scan"]:
+            return get_folder_scanner(src_folder).scan()
+        with os.scandir(src_folder) as entries:
+            return [(entry.name, entry.path, entry.stat()) for entry in entries if entry.is_file()]
+    source_files = []
+    for file_name in file_names:
+        src_file_path = os.path.join(src_folder, file_name)
+        try:
+            stat = os.stat(src_file_path)
+        except FileNotFoundError:
+            continue
+        source_files.append((file_name, src_file_path, stat))
+    return source_files
+
+FICLONE = 0x40049409  # Linux ioctl cloning a whole file (reflink) on btrfs, XFS and other copy-on-write file systems
+
+# Helper function to stage one machine file without copying its data where possible.
+# "link" tries a hardlink (same file system), then a reflink / in-kernel copy, then falls back to copy2.
+# Returns how the file was staged: link, reflink or copy
+def stage_file(src_file_path, dest_file_path, mode="copy"):
+    if mode == "link":
+        try:
+            if os.path.lexists(dest_file_path):
+                os.remove(dest_file_path)  # A re-staged file, the link must point to the new version
+            os.link(src_file_path, dest_file_path)
+            return "link"
+        except OSError:
+            pass
+        if clone_file(src_file_path, dest_file_path):
+            return "reflink"
+    shutil.copy2(src_file_path, dest_file_path)  # copy2 itself uses sendfile on Linux
+    return "copy"
+
+# Helper function to clone a file with FICLONE, or copy it inside the kernel with copy_file_range (server side on NFS / SMB3)
+def clone_file(src_file_path, dest_file_path):
+    if not sys.platform.startswith("linux") or not hasattr(os, "copy_file_range"):
+        return False
+    try:
+        import fcntl
+        with open(src_file_path, 'rb') as src, open(dest_file_path, 'wb') as dest:
+            try:
+                fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+            except OSError:
+                remaining = os.fstat(src.fileno()).st_size
+                while remaining > 0:
+                    written = os.copy_file_range(src.fileno(), dest.fileno(), remaining)
+                    if written == 0:
+                        break
+                    remaining -= written
+        shutil.copystat(src_file_path, dest_file_path)
+        return True
+    except OSError as e:
+        logging.info(f"No clone for {src_file_path} ({e}), copying instead.")
+        try:
+            os.remove(dest_file_path)
+        except OSError:
+            pass
+        return False
+
+# Function to write the gzip archive copy of machine files parsed in place (Staging_Mode "direct") into Backup_Folder.
+# The file is only recorded in the manifest once its archive copy exists, so an interrupted cycle ingests it again.
+@metrics.timed("move_files_to_backup")
+def archive_machine_files(src_folder, backup_folder, backup_log_file, file_names, manifest=None):
+    if manifest is None:
+        manifest = get_ingest_manifest()
+    for file_name in file_names:
+        src_file_path = os.path.join(src_folder, file_name)
+        backup_file_path = os.path.join(backup_folder, file_name + ".gz")
+        try:
+            stat = os.stat(src_file_path)
+            with open(src_file_path, 'rb') as src, gzip.open(backup_file_path + ".tmp", 'wb', compresslevel=6) as dest:
+                shutil.copyfileobj(src, dest, 1024 * 1024)
+            os.utime(backup_file_path + ".tmp", ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            os.replace(backup_file_path + ".tmp", backup_file_path)
+            manifest.add(file_name, stat.st_size, stat.st_mtime_ns)
+            write_audit_line(backup_log_file, f"{file_name} archived from {src_folder} to {backup_file_path} on {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+            metrics.inc("lm_files_backed_up_total")
+            console(f"Archived {file_name} to {backup_folder}")
+            logging.info(f"Archived {file_name} to {backup_folder}")
+        except Exception as e:
+            logging.error(f"Error archiving {file_name}: {e}")
+            print(f"Error archiving {file_name}: {e}")
 
 # Function to move files to backup folder with better error handling and no skip log verification - PSR logic will be added later
-def move_files_to_backup(src_folder, backup_folder, backup_log_file):
+@metrics.timed("move_files_to_backup")
+def move_files_to_backup(src_folder, backup_folder, backup_log_file, file_names=None):
     try:
-        src_files = os.listdir(src_folder)
+        src_files = list_folder_files(src_folder) if file_names is None else file_names
         for file_name in src_files:
             src_file_path = os.path.join(src_folder, file_name)
             backup_file_path = os.path.join(backup_folder, file_name)
             shutil.move(src_file_path, backup_file_path)
-            with open(backup_log_file, 'a') as log:
-                log.write(f"{file_name} moved from {src_folder} to {backup_folder} on {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-            print(f"Moved {file_name} to {backup_folder}")
+            write_audit_line(backup_log_file, f"{file_name} moved from {src_folder} to {backup_folder} on {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+            metrics.inc("lm_files_backed_up_total")
+            console(f"Moved {file_name} to {backup_folder}")
             logging.info(f"Backed Up {file_name} to {backup_folder}")
     except Exception as e:
         logging.error(f"Error during file backup: {e}")
@@ -140,86 +967,843 @@ def move_files_to_backup(src_folder, backup_folder, backup_log_file):
 #---------------------------------------------------------------------------Parser----!
 
 # CSV to JSON parser function with better error handling and logging
-def parse_csv_to_json(csv_file, json_file, log_file):
+# A .jsonl json_file selects the streaming mode - new records are appended, the file is never re-read
+# Unmatched marks are held in the pairing buffer of the source and merged with their other side from a later CSV
+@metrics.timed("parse_csv_to_json")
+def parse_csv_to_json(csv_file, json_file, log_file, source=None):
     try:
-        existing_data, last_pd_no = load_existing_json(json_file)
+        pairing = resolve_source(source).get_pairing_buffer()
+        streaming = json_file.endswith('.jsonl')
+        if streaming:
+            existing_data, last_pd_no = None, get_jsonl_last_pd_no(json_file)
+        else:
+            existing_data, last_pd_no = load_existing_json(json_file)
 
-        # Extract model_id from the first record if available
-        model_id = None
-        laser_marking_data = existing_data.get("laser_marking", [])
-        
-        panel_dict = {}
+        new_records, last_pd_no, model_id = read_csv_records(csv_file, last_pd_no, pairing)
+        write_parsed_records(json_file, existing_data, new_records, last_pd_no, model_id)
+        if pairing is not None:
+            pairing.save()
 
-        with open(csv_file, 'r') as file:
-            reader = csv.DictReader(file)
-            
-            for row in reader:
-                serial_no = row['SerialNo']
-                panel_no = row['PanelNo']
-                panel_time = row['DateTime']
-                model_id = row['ModelID']  # Fetch model_id from the CSV file (WO)
-
-                if panel_no.endswith('-T'):
-                    # Initialize top panel data in panel_dict
-                    panel_dict[serial_no] = {
-                        'serial_no': serial_no,
-                        'model_id': model_id,
-                        'program_name': row['ProgramName'],
-                        'top_panel': panel_no,
-                        'top_time': panel_time
-                    }
-                elif panel_no.endswith('-B'):
-                    # Add bottom panel data if matching serial_no exists
-                    if serial_no in panel_dict:
-                        panel_dict[serial_no]['bottom_panel'] = panel_no
-                        panel_dict[serial_no]['bottom_time'] = panel_time
-                    else:
-                        # Initialize bottom panel data if top is missing
-                        panel_dict[serial_no] = {
-                            'serial_no': serial_no,
-                            'model_id': model_id,
-                            'program_name': row['ProgramName'],
-                            'bottom_panel': panel_no,
-                            'bottom_time': panel_time
-                        }
-
-                    # Assign pd_no and add to laser_marking_data
-                    last_pd_no = generate_pd_no(last_pd_no)
-                    panel_dict[serial_no]['pd_no'] = last_pd_no
-                    laser_marking_data.append(panel_dict[serial_no])
-                    del panel_dict[serial_no]  # Remove after adding
-
-            # Add remaining unmatched entries from panel_dict (single-sided marks)
-            for panel_data in panel_dict.values():
-                last_pd_no = generate_pd_no(last_pd_no)
-                panel_data['pd_no'] = last_pd_no
-                laser_marking_data.append(panel_data)
+        log_parsed_file(log_file, csv_file)
+        metrics.inc("lm_files_parsed_total")
+        metrics.inc("lm_records_parsed_total", len(new_records))
+        console(f"Data from {csv_file} has been parsed and saved to {json_file}")
+        logging.info(f"Data from {csv_file} has been parsed and saved to {json_file}")
+    
+    except Exception as e:
+        logging.error(f"Error parsing CSV file {csv_file}: {e}")
+        print(f"Error parsing CSV file {csv_file}: {e}")
 
+
+# Laser marking record types - one mark as a slotted object, and a columnar batch of marks.
+# A batch keeps one list per field instead of one dict per mark, repeated values (work order, program name,
+# panel numbers) share one interned string, and JSONL lines and ERP rows are serialized straight from the columns.
+MARK_FIELDS = ("serial_no", "model_id", "program_name", "top_panel", "top_time", "bottom_panel", "bottom_time", "pd_no")
+ERP_MARK_FIELDS = MARK_FIELDS[:-1]  # pd_no is only used locally
+encode_json_string = json.encoder.encode_basestring_ascii  # Same escaping as json.dumps, C accelerated
+
+class LaserMark:
+    __slots__ = MARK_FIELDS
+
+    def __init__(self, serial_no, model_id, program_name, top_panel=None, top_time=None, bottom_panel=None,
+                 bottom_time=None, pd_no=None):
+        self.serial_no = serial_no
+        self.model_id = model_id
+        self.program_name = program_name
+        self.top_panel = top_panel
+        self.top_time = top_time
+        self.bottom_panel = bottom_panel
+        self.bottom_time = bottom_time
+        self.pd_no = pd_no
+
+    # Missing sides are left out, like the dict records written before
+    def to_dict(self):
+        return {field: getattr(self, field) for field in MARK_FIELDS if getattr(self, field) is not None}
+
+    @classmethod
+    def from_dict(cls, record):
+        return cls(*(record.get(field) for field in MARK_FIELDS))
+
+
+class MarkBatch:
+    __slots__ = ("columns",)
+
+    def __init__(self, columns=None):
+        self.columns = columns or tuple([] for _ in MARK_FIELDS)
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def append(self, mark):
+        serial_nos, model_ids, program_names, top_panels, top_times, bottom_panels, bottom_times, pd_nos = self.columns
+        serial_nos.append(mark.serial_no)
+        model_ids.append(mark.model_id)
+        program_names.append(mark.program_name)
+        top_panels.append(mark.top_panel)
+        top_times.append(mark.top_time)
+        bottom_panels.append(mark.bottom_panel)
+        bottom_times.append(mark.bottom_time)
+        pd_nos.append(mark.pd_no)
+
+    @classmethod
+    def from_marks(cls, marks):
+        batch = cls()
+        for mark in marks:
+            batch.append(mark)
+        return batch
+
+    # Builds the columns from dict records (JSON files, outbox rows) without a per record copy
+    @classmethod
+    def from_records(cls, records):
+        return cls(tuple([record.get(field) for record in records] for field in MARK_FIELDS))
+
+    def slice(self, start, stop=None):
+        return MarkBatch(tuple(column[start:stop] for column in self.columns))
+
+    def column(self, field):
+        return self.columns[MARK_FIELDS.index(field)]
+
+    def last_model_id(self):
+        model_ids = self.column("model_id")
+        return model_ids[-1] if model_ids else None
+
+    def to_dicts(self):
+        return [{field: value for field, value in zip(MARK_FIELDS, values) if value is not None}
+                for values in zip(*self.columns)]
+
+    # Rows as ERP expects them - every child field present, "" for a missing side
+    def to_erp_dicts(self):
+        return [{field: value or "" for field, value in zip(ERP_MARK_FIELDS, values)} for values in zip(*self.columns)]
+
+    # One compact JSON object per line, same text json.dumps(record, separators=(',', ':')) gives for the dict record
+    def to_jsonl(self):
+        lines = []
+        for values in zip(*self.columns):
+            lines.append("{" + ",".join(f'"{field}":{encode_json_string(value)}'
+                                        for field, value in zip(MARK_FIELDS, values) if value is not None) + "}\n")
+        return "".join(lines)
+
+    # ERP child rows as JSON object strings, suffix holds the pre-encoded fields shared by every row
+    def to_erp_json(self, suffix=""):
+        return [("{" + ", ".join(f'"{field}": {encode_json_string(value or "")}' for field, value in zip(ERP_MARK_FIELDS, values))
+                 + suffix + "}") for values in zip(*self.columns)]
+
+
+# Helper function to write parsed records (pd_no already assigned) into the JSON or streaming JSONL file
+def write_parsed_records(json_file, existing_data, new_records, last_pd_no, model_id):
+    if json_file.endswith('.jsonl'):
+        append_jsonl_records(json_file, new_records, last_pd_no)
+    else:
         # Update the model_id field in the JSON data
         existing_data["model_id"] = model_id
-        existing_data["laser_marking"] = laser_marking_data
+        existing_data["laser_marking"] = existing_data.get("laser_marking", []) + new_records.to_dicts()
 
         with open(json_file, 'w') as json_output:
             json.dump(existing_data, json_output, indent=4)
 
-        log_parsed_file(log_file, csv_file)
-        print(f"Data from {csv_file} has been parsed and saved to {json_file}")
-        logging.info(f"Data from {csv_file} has been parsed and saved to {json_file}")
-    
+# Function to read one laser marking CSV into a MarkBatch - also used by the backfill tool.
+# Columns are found by name in the header once, rows are then read positionally.
+def read_csv_records(csv_file, last_pd_no="PD0000", pairing=None):
+    opener = gzip.open if csv_file.endswith('.gz') else open  # .csv.gz archive copies of direct staging
+    with opener(csv_file, 'rt') as file:
+        return read_csv_stream(file, last_pd_no, pairing)
+
+# Helper function of read_csv_records for an already opened text stream (e.g. a member of an archive day zip)
+def read_csv_stream(file, last_pd_no="PD0000", pairing=None):
+    reader = csv.reader(file)
+    header = next(reader, None)
+    if header is None:
+        return MarkBatch(), last_pd_no, None
+    position = {name: index for index, name in enumerate(header)}
+    fields = operator.itemgetter(position['SerialNo'], position['PanelNo'], position['DateTime'],
+                                 position['ModelID'], position['ProgramName'])
+    return pair_panel_rows((fields(row) for row in reader if row), last_pd_no, pairing)
+
+# Function to pair the top (-T) and bottom (-B) marks of each serial_no into one record with its pd_no.
+# rows are (SerialNo, PanelNo, DateTime, ModelID, ProgramName) tuples.
+# Without a pairing buffer unmatched marks become single sided records at the end of the file. With one they
+# are held across files, and only halves expired from the buffer are returned single sided.
+# Returns (MarkBatch, last_pd_no, model_id of the last row)
+def pair_panel_rows(rows, last_pd_no="PD0000", pairing=None):
+    model_id = None
+    batch = MarkBatch()
+    panel_dict = {}
+    intern = sys.intern
+    pd_number = int(last_pd_no[2:])
+
+    def add_record(mark):
+        nonlocal pd_number
+        pd_number += 1
+        mark.pd_no = f"PD{pd_number:04d}"  # Same as generate_pd_no, without re-parsing the last number
+        batch.append(mark)
+
+    # Other side of a serial_no from this file, or else from the pairing buffer
+    def take_partner(serial_no, side):
+        half = panel_dict.pop(side + serial_no, None)
+        if half is None and pairing is not None:
+            half = pairing.take(serial_no, side)
+        return half
+
+    for serial_no, panel_no, panel_time, model_id, program_name in rows:
+        model_id = intern(model_id)  # Fetch model_id from the CSV file (WO)
+        panel_no = intern(panel_no)
+        if pairing is not None:
+            pairing.observe(panel_time)
+
+        if panel_no.endswith('-T'):
+            top = LaserMark(serial_no, model_id, intern(program_name), top_panel=panel_no, top_time=panel_time)
+            bottom = take_partner(serial_no, 'B') if pairing is not None else None
+            if bottom is not None:
+                top.bottom_panel = bottom.bottom_panel
+                top.bottom_time = bottom.bottom_time
+                add_record(top)
+            else:
+                # Initialize top panel data in panel_dict
+                panel_dict['T' + serial_no] = top
+        elif panel_no.endswith('-B'):
+            # Add bottom panel data if matching serial_no exists
+            top = take_partner(serial_no, 'T')
+            if top is not None:
+                top.bottom_panel = panel_no
+                top.bottom_time = panel_time
+                add_record(top)
+            else:
+                # Initialize bottom panel data if top is missing
+                bottom = LaserMark(serial_no, model_id, intern(program_name), bottom_panel=panel_no, bottom_time=panel_time)
+                if pairing is not None:
+                    panel_dict['B' + serial_no] = bottom  # Top may still come in a later file
+                else:
+                    add_record(bottom)
+
+    # Remaining unmatched entries from panel_dict (single-sided marks) wait in the pairing buffer
+    if pairing is not None:
+        for mark in panel_dict.values():
+            pairing.put(mark)
+        for mark in pairing.expire():
+            add_record(mark)
+    else:
+        for mark in panel_dict.values():
+            add_record(mark)
+
+    return batch, f"PD{pd_number:04d}", model_id
+
+# Cross-file pairing buffer - unmatched top or bottom marks wait here for their other side from a later CSV.
+# A half is released single sided once the newest mark seen is Pairing_Window_Seconds past its DateTime, once it
+# waited Pairing_Max_Wait_Seconds of wall time, or when the buffer holds more than Pairing_Buffer_Size halves.
+# Kept in a small JSON file so halves survive restarts.
+class PairingBuffer:
+    def __init__(self, window_seconds=600, max_wait_seconds=3600, max_size=20000, persist_file=None):
+        self.window_seconds = window_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self.max_size = max_size
+        self.persist_file = persist_file
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # Parser threads and the reconcile sweep save concurrently
+        self.halves = OrderedDict()  # side + serial_no -> [LaserMark, marked_at or None, buffered_at]
+        self.newest_mark = None  # Newest DateTime seen, as a timestamp
+        self.newest_text = None  # ... and as text, so older marks are skipped without parsing
+        self.dirty = False
+        self.paired = 0
+        self.expired = 0
+        self.evicted = 0
+        if persist_file:
+            self.load()
+
+    @staticmethod
+    def mark_time(panel_time):
+        try:
+            return datetime.strptime(panel_time, '%Y-%m-%d %H:%M:%S').timestamp()
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def side_key(mark):
+        return ('T' if mark.top_panel is not None else 'B') + mark.serial_no
+
+    # Only DateTime texts sorting after the newest one seen are parsed (the format sorts chronologically)
+    # Parser threads call this concurrently, so the newer value is checked again under the lock
+    def observe(self, panel_time):
+        if self.newest_text is None or panel_time > self.newest_text:
+            marked_at = self.mark_time(panel_time)
+            if marked_at is not None:
+                with self.lock:
+                    if self.newest_text is None or panel_time > self.newest_text:
+                        self.newest_mark = marked_at
+                        self.newest_text = panel_time
+
+    # Returns the held half of serial_no on the given side ('T' or 'B'), or None
+    def take(self, serial_no, side):
+        with self.lock:
+            entry = self.halves.pop(side + serial_no, None)
+            if entry is None:
+                return None
+            self.paired += 1
+            self.dirty = True
+            return entry[0]
+
+    def put(self, mark):
+        marked_at = self.mark_time(mark.top_time or mark.bottom_time)
+        key = self.side_key(mark)
+        with self.lock:
+            self.halves[key] = [mark, marked_at, time.time()]
+            self.halves.move_to_end(key)
+            self.dirty = True
+
+    # Function to remove and return the halves to send single sided now, oldest first
+    def expire(self, drain=False):
+        now = time.time()
+        released = []
+        with self.lock:
+            for key, (mark, marked_at, buffered_at) in list(self.halves.items()):
+                if drain:
+                    expired = True
+                elif marked_at is not None and self.newest_mark is not None:
+                    expired = self.newest_mark - marked_at > self.window_seconds or now - buffered_at > self.max_wait_seconds
+                else:
+                    expired = now - buffered_at > self.max_wait_seconds
+                if expired:
+                    del self.halves[key]
+                    released.append(mark)
+                    self.expired += 1
+            while len(self.halves) > self.max_size:
+                released.append(self.halves.popitem(last=False)[1][0])
+                self.evicted += 1
+            if released:
+                self.dirty = True
+        return released
+
+    def __len__(self):
+        return len(self.halves)
+
+    def stats(self):
+        with self.lock:
+            return {"held": len(self.halves), "paired": self.paired, "expired": self.expired, "evicted": self.evicted}
+
+    def save(self):
+        if not self.persist_file or not self.dirty:
+            return
+        # Snapshot and replace under save_lock - one writer at a time, and an older snapshot never replaces a newer one
+        with self.save_lock:
+            try:
+                with self.lock:
+                    data = {"newest_mark": self.newest_mark,
+                            "halves": [[mark.to_dict(), marked_at, buffered_at] for mark, marked_at, buffered_at in self.halves.values()]}
+                    self.dirty = False
+                temp_file = self.persist_file + ".tmp"
+                with open(temp_file, 'w') as f:
+                    json.dump(data, f)
+                os.replace(temp_file, self.persist_file)
+            except Exception as e:
+                self.dirty = True  # Tried again on the next save
+                logging.error(f"Failed to save pairing buffer: {e}")
+
+    def load(self):
+        try:
+            if os.path.exists(self.persist_file):
+                with open(self.persist_file, 'r') as f:
+                    data = json.load(f)
+                self.newest_mark = data.get("newest_mark")
+                if self.newest_mark is not None:
+                    self.newest_text = datetime.fromtimestamp(self.newest_mark).strftime('%Y-%m-%d %H:%M:%S')
+                for record, marked_at, buffered_at in data.get("halves", []):
+                    mark = LaserMark.from_dict(record)
+                    self.halves[self.side_key(mark)] = [mark, marked_at, buffered_at]
+                logging.info(f"Loaded {len(self.halves)} unmatched mark(s) into the pairing buffer.")
+        except Exception as e:
+            logging.error(f"Failed to load pairing buffer: {e}")
+
+pairing_buffer = None
+
+# Helper function to build the pairing buffer of the primary source from settings once per process
+def get_pairing_buffer(persist_file=None):
+    global pairing_buffer
+    if persist_file is not None:
+        return create_pairing_buffer(persist_file)
+    if pairing_buffer is None:
+        pairing_buffer = create_pairing_buffer(state_files["Pairing_Buffer"])
+    return pairing_buffer
+
+def create_pairing_buffer(persist_file):
+    return PairingBuffer(
+        window_seconds=settings["Pairing_Window_Seconds"],
+        max_wait_seconds=settings["Pairing_Max_Wait_Seconds"],
+        max_size=settings["Pairing_Buffer_Size"],
+        persist_file=persist_file
+    )
+
+# Function to write the halves expired from the pairing buffer into json_file, single sided.
+# Called after every parse round so marks whose other side never comes are not held back. Returns the count.
+def flush_pairing_buffer(json_file, source=None):
+    pairing = resolve_source(source).get_pairing_buffer()
+    if pairing is None or not len(pairing):
+        return 0
+    try:
+        marks = pairing.expire()
+        if marks:
+            if json_file.endswith('.jsonl'):
+                existing_data, last_pd_no = None, get_jsonl_last_pd_no(json_file)
+            else:
+                existing_data, last_pd_no = load_existing_json(json_file)
+            for mark in marks:
+                last_pd_no = generate_pd_no(last_pd_no)
+                mark.pd_no = last_pd_no
+            write_parsed_records(json_file, existing_data, MarkBatch.from_marks(marks), last_pd_no, marks[-1].model_id)
+            logging.info(f"{len(marks)} unmatched mark(s) sent single sided, pairing buffer: {pairing.stats()}")
+        pairing.save()
+        return len(marks)
     except Exception as e:
-        logging.error(f"Error parsing CSV file {csv_file}: {e}")
-        print(f"Error parsing CSV file {csv_file}: {e}")
+        logging.error(f"Error flushing the pairing buffer into {json_file}: {e}")
+        print(f"Error flushing the pairing buffer into {json_file}: {e}")
+        return 0
+
+
+#------------------------------------------------------------------------Streaming JSONL---!
+
+# Streaming output - one compact record per line, appended once per parsed CSV.
+# The last pd_no and the committed file size live in memory and in a small <file>.state sidecar,
+# so the growing file is never loaded again while parsing.
+jsonl_state = {}  # json_file -> {"last_pd_no": str, "size": int}
+jsonl_lock = threading.Lock()
+
+# Helper function to get the sidecar path of a JSONL file
+def get_jsonl_state_file(jsonl_file):
+    return jsonl_file + ".state"
+
+# Helper function to find the last pd_no of a JSONL file, recovering from an interrupted append if needed
+def get_jsonl_last_pd_no(jsonl_file):
+    with jsonl_lock:
+        return load_jsonl_state(jsonl_file)["last_pd_no"]
+
+def load_jsonl_state(jsonl_file):
+    state = jsonl_state.get(jsonl_file)
+    if state is not None:
+        return state
+
+    state = {"last_pd_no": "PD0000", "size": 0}
+    state_file = get_jsonl_state_file(jsonl_file)
+    if os.path.exists(state_file):
+        with open(state_file, 'r') as f:
+            state.update(json.load(f))
+
+    # Lines written after the last sidecar update are scanned, a torn last line is cut off
+    if os.path.exists(jsonl_file) and os.path.getsize(jsonl_file) != state["size"]:
+        with open(jsonl_file, 'rb+') as f:
+            f.seek(min(state["size"], os.path.getsize(jsonl_file)))
+            offset = f.tell()
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                offset += len(line)
+                state["last_pd_no"] = record.get("pd_no", state["last_pd_no"])
+            f.truncate(offset)
+        state["size"] = offset
+        logging.warning(f"Recovered streaming file state of {jsonl_file} at {offset} bytes.")
+
+    jsonl_state[jsonl_file] = state
+    return state
+
+# Function to append one batch of records with a single write, fsync and sidecar update
+# records is a MarkBatch (serialized from its columns) or a list of dict records
+def append_jsonl_records(jsonl_file, records, last_pd_no):
+    if not len(records):
+        return
+    if isinstance(records, MarkBatch):
+        data = records.to_jsonl().encode()
+    else:
+        data = "".join(json.dumps(record, separators=(',', ':')) + "\n" for record in records).encode()
+    with jsonl_lock:
+        state = load_jsonl_state(jsonl_file)
+        with open(jsonl_file, 'ab') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        state["last_pd_no"] = last_pd_no
+        state["size"] += len(data)
+
+        state_file = get_jsonl_state_file(jsonl_file)
+        with open(state_file + ".tmp", 'w') as f:
+            json.dump(state, f)
+        os.replace(state_file + ".tmp", state_file)
+
+# Helper function to read all complete records of a JSONL file
+def read_jsonl_records(jsonl_file):
+    records = []
+    with open(jsonl_file, 'rb') as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break  # Torn last line of an interrupted append
+            records.append(json.loads(line))
+    return records
+
+# Converter - writes a JSONL file as the Done_Folder document shape ({"model_id": ..., "laser_marking": [...]})
+def convert_jsonl_to_document(jsonl_file, json_file):
+    records = read_jsonl_records(jsonl_file)
+    document = {
+        "model_id": records[-1].get("model_id") if records else "",
+        "laser_marking": records
+    }
+    with open(json_file + ".tmp", 'w') as f:
+        json.dump(document, f, indent=4)
+    os.replace(json_file + ".tmp", json_file)
+    return document
+
+# Helper function to forget a finished JSONL file and remove its sidecar
+def discard_jsonl_state(jsonl_file):
+    with jsonl_lock:
+        jsonl_state.pop(jsonl_file, None)
+        state_file = get_jsonl_state_file(jsonl_file)
+        if os.path.exists(state_file):
+            os.remove(state_file)
 
 
 #-------------------------------------------------------------------------------API---!
 
-# Function to check if any record present for the given mode_id or not
+# Raised instead of sending a request while the ERP circuit breaker is open
+class CircuitOpenError(requests.RequestException):
+    pass
+
+# Circuit breaker shared by all ERP calls, driven by the outcome of real requests.
+# CLOSED - requests flow, consecutive failures are counted.
+# OPEN - requests fail fast with CircuitOpenError until reset_timeout has passed.
+# HALF_OPEN - one probe request is let through, its outcome closes or re-opens the breaker.
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=60, name="ERP"):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.name = name
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+        self.transitions = []  # (timestamp, from_state, to_state, reason), last 50 kept
+
+    def transition(self, new_state, reason):
+        old_state = self.state
+        if old_state == new_state:
+            return
+        self.state = new_state
+        self.transitions.append((datetime.now().strftime('%Y-%m-%d %H:%M:%S'), old_state, new_state, reason))
+        del self.transitions[:-50]
+        message = f"{self.name} circuit breaker {old_state} -> {new_state}: {reason}"
+        if new_state == self.OPEN:
+            logging.error(message)
+        else:
+            logging.info(message)
+        print(message)
+
+    # Non consuming check used to skip whole upload stages while the ERP is down
+    def is_open(self):
+        with self.lock:
+            return self.state == self.OPEN and time.time() - self.opened_at < self.reset_timeout
+
+    # Called before every request, lets a single probe through once the reset timeout has passed
+    def allow_request(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.time() - self.opened_at < self.reset_timeout:
+                    return False
+                self.transition(self.HALF_OPEN, f"reset timeout of {self.reset_timeout}s passed")
+            if self.probe_in_flight:
+                return False
+            self.probe_in_flight = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.probe_in_flight = False
+            if self.state != self.CLOSED:
+                self.transition(self.CLOSED, "request succeeded")
+
+    def record_failure(self, reason):
+        with self.lock:
+            self.failures += 1
+            self.probe_in_flight = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                self.opened_at = time.time()
+                self.transition(self.OPEN, f"{self.failures} consecutive failure(s), last: {reason}")
+            elif self.state == self.OPEN:
+                self.opened_at = time.time()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "opened_at": datetime.fromtimestamp(self.opened_at).strftime('%Y-%m-%d %H:%M:%S') if self.opened_at else None,
+                "transitions": list(self.transitions),
+            }
+
+
+erp_breaker = None
+
+# Helper function to get the ERP circuit breaker, shared across ERP client rebuilds
+def get_erp_breaker():
+    global erp_breaker
+    if erp_breaker is None:
+        erp_breaker = CircuitBreaker(
+            failure_threshold=settings["Breaker_Failure_Threshold"],
+            reset_timeout=settings["Breaker_Reset_Timeout"]
+        )
+    return erp_breaker
+
+# Token bucket limiting the ERP request rate - acquire() blocks until a request may be sent
+class RateLimiter:
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# Shared ERP client - one pooled keep-alive requests.Session with pre-built auth headers and
+# consistent connect/read timeouts, used by every ERP call instead of bare requests.get/put/post/head.
+class ERPClient:
+    def __init__(self, api_key, api_secret, erp_url, pool_size=10, keep_alive=True, connect_timeout=5, read_timeout=30,
+                 breaker=None):
+        self.api_key = api_key
+        self.breaker = breaker
+        self.api_secret = api_secret
+        self.erp_url = erp_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.rate_limiter = None  # Optional RateLimiter, applied to every request
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "Authorization": f"token {api_key}:{api_secret}",
+            "Content-Type": "application/json",
+            "Connection": "keep-alive" if keep_alive else "close"
+        })
+
+    # A timeout passed by the caller only replaces the read timeout, the connect timeout always applies.
+    # op labels the request in the lm_erp_request_seconds metric (parent_lookup, get, put, post, child_insert).
+    def request(self, method, url, timeout=None, op=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        elif not isinstance(timeout, tuple):
+            timeout = (self.timeout[0], timeout)
+
+        with metrics.timer("lm_erp_request_seconds", op=op or method.lower()):
+            response = self.send(method, url, timeout, **kwargs)
+        metrics.inc("lm_erp_requests_total", op=op or method.lower(), status=response.status_code)
+        return response
+
+    # Connection errors, timeouts and 5xx answers count as breaker failures, any other answer as success.
+    # The breaker is asked first, so requests refused while it is open use no rate limiter token.
+    def send(self, method, url, timeout, **kwargs):
+        if self.breaker is not None and not self.breaker.allow_request():
+            raise CircuitOpenError(f"{self.breaker.name} circuit breaker is {self.breaker.state}, request not sent")
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+        if self.breaker is None:
+            return self.session.request(method, url, timeout=timeout, **kwargs)
+
+        try:
+            response = self.session.request(method, url, timeout=timeout, **kwargs)
+        except requests.RequestException as e:
+            self.breaker.record_failure(str(e))
+            raise
+        if response.status_code >= 500:
+            self.breaker.record_failure(f"HTTP {response.status_code}")
+        else:
+            self.breaker.record_success()
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+erp_client = None
+erp_client_lock = threading.Lock()
+
+# Helper function to get the shared ERP client, rebuilt only when the credentials or URL change (RESET)
+def get_erp_client(api_key, api_secret, erp_url):
+    global erp_client
+    client = erp_client
+    if client is not None and (client.api_key, client.api_secret, client.erp_url) == (api_key, api_secret, erp_url):
+        return client
+    with erp_client_lock:
+        if erp_client is None or (erp_client.api_key, erp_client.api_secret, erp_client.erp_url) != (api_key, api_secret, erp_url):
+            if erp_client is not None:
+                erp_client.close()
+            erp_client = ERPClient(
+                api_key, api_secret, erp_url,
+                pool_size=settings["ERP_Pool_Size"],
+                keep_alive=settings["ERP_Keep_Alive"],
+                connect_timeout=settings["ERP_Connect_Timeout"],
+                read_timeout=settings["ERP_Read_Timeout"],
+                breaker=get_erp_breaker()
+            )
+            if settings["ERP_Max_RPS"]:
+                erp_client.rate_limiter = RateLimiter(settings["ERP_Max_RPS"])
+            logging.info(f"ERP client created for {erp_url} (pool size {settings['ERP_Pool_Size']}).")
+        return erp_client
+
+# model_id -> parent document name cache with LRU eviction and TTL.
+# A None value is a short lived negative entry ("no parent yet") so one batch does not repeat the lookup.
+class ParentNameCache:
+    def __init__(self, max_size=1024, ttl=3600, negative_ttl=30, persist_file=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.persist_file = persist_file
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # Every upload worker saves the shared cache
+        self.entries = OrderedDict()  # model_id -> (parent_name or None, expires_at)
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.evictions = 0
+        if persist_file:
+            self.load()
+
+    # Returns (found, parent_name). found is False on a miss or an expired entry.
+    def get(self, model_id):
+        with self.lock:
+            entry = self.entries.get(model_id)
+            if entry is None or entry[1] < time.time():
+                if entry is not None:
+                    del self.entries[model_id]
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(model_id)
+            if entry[0] is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return True, entry[0]
+
+    def put(self, model_id, parent_name):
+        ttl = self.ttl if parent_name else self.negative_ttl
+        with self.lock:
+            self.entries[model_id] = (parent_name, time.time() + ttl)
+            self.entries.move_to_end(model_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            if parent_name:
+                self.dirty = True
+
+    def invalidate(self, model_id):
+        with self.lock:
+            if self.entries.pop(model_id, None) is not None:
+                self.dirty = True
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    # Only positive entries are persisted, negative ones are too short lived to be worth keeping
+    def save(self):
+        if not self.persist_file or not self.dirty:
+            return
+        with self.save_lock:  # One writer at a time, see PairingBuffer.save
+            try:
+                with self.lock:
+                    now = time.time()
+                    data = {model_id: [name, expires_at] for model_id, (name, expires_at) in self.entries.items()
+                            if name and expires_at > now}
+                    self.dirty = False
+                temp_file = self.persist_file + ".tmp"
+                with open(temp_file, 'w') as f:
+                    json.dump(data, f)
+                os.replace(temp_file, self.persist_file)
+            except Exception as e:
+                self.dirty = True
+                logging.error(f"Failed to save parent name cache: {e}")
+
+    def load(self):
+        try:
+            if os.path.exists(self.persist_file):
+                with open(self.persist_file, 'r') as f:
+                    data = json.load(f)
+                now = time.time()
+                for model_id, (name, expires_at) in sorted(data.items(), key=lambda item: item[1][1]):
+                    if name and expires_at > now:
+                        self.entries[model_id] = (name, expires_at)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+                logging.info(f"Loaded {len(self.entries)} entries into the parent name cache.")
+        except Exception as e:
+            logging.error(f"Failed to load parent name cache: {e}")
+
+
+parent_cache = None
+
+# Helper function to build the shared parent name cache from settings once per process
+def get_parent_cache():
+    global parent_cache
+    if parent_cache is None:
+        parent_cache = ParentNameCache(
+            max_size=settings["Parent_Cache_Size"],
+            ttl=settings["Parent_Cache_TTL"],
+            negative_ttl=settings["Parent_Cache_Negative_TTL"],
+            persist_file=state_files["Parent_Cache"] if settings["Parent_Cache_Persist"] else None
+        )
+    return parent_cache
+
+# Function to check if any record present for the given mode_id or not - answered from the cache when possible
 def get_parent_record(model_id, api_key, api_secret, erp_url):
-    headers = {
-        "Authorization": f"token {api_key}:{api_secret}",
-        "Content-Type": "application/json"
-    }
-    
+    cache = get_parent_cache()
+    found, parent_name = cache.get(model_id)
+    if found:
+        return parent_name
+
+    parent_name = fetch_parent_record(model_id, api_key, api_secret, erp_url)
+    cache.put(model_id, parent_name)
+    return parent_name
+
+# Function to look up the parent document for the given model_id in ERP
+def fetch_parent_record(model_id, api_key, api_secret, erp_url):
+    client = get_erp_client(api_key, api_secret, erp_url)
+
     # Create the filter dynamically
     filters = f'[["model_id", "=", "{model_id}"]]'
     
@@ -233,9 +1817,9 @@ def get_parent_record(model_id, api_key, api_secret, erp_url):
     # Construct the correct filter URL
     filter_url = f"{erp_url}?filters={encoded_filters}"  # No need to add /api/resource/SMT%20Traceability again
     
-    print(f"Request URL: {filter_url}")  # Debugging line
+    console(f"Request URL: {filter_url}")  # Debugging line
     
-    response = requests.get(filter_url, headers=headers)
+    response = client.get(filter_url, op="parent_lookup")
     
     # Handle HTTP errors
     response.raise_for_status()
@@ -247,153 +1831,975 @@ def get_parent_record(model_id, api_key, api_secret, erp_url):
         return result["data"][0]["name"]
     else:
         return None
-    
-# Function to check if ERP server is reachable
-def is_erp_server_running(erp_url, retries=3, delay=5):
-    attempt = 0
-    while attempt < retries:
-        try:
-            # Sending a HEAD request to check if server is up
-            response = requests.head(erp_url, timeout=10)
-            response.raise_for_status()  # Will raise HTTPError for bad responses
-            return True  # Server is up
-        except requests.exceptions.RequestException as e:
-            print(f"Error connecting to ERP server: {e}")
-            logging.error(f"Error connecting to ERP server: {e}")
-            attempt += 1
-            if attempt < retries:
-                print(f"Retrying connection in {delay} seconds...")
-                time.sleep(delay)
-            else:
-                print("Max retries reached. ERP server is down.")
-                return False
+
+PARENT_LOOKUP_CHUNK = 100  # model_ids per "in" filter, keeps the query string short
+
+# Function to look up the parents of many work orders at once - known ones from the parent cache, the rest with one
+# list query per PARENT_LOOKUP_CHUNK model_ids. Returns {model_id: parent name or None}
+def resolve_parent_records(model_ids, api_key, api_secret, erp_url, use_cache=True):
+    cache = get_parent_cache()
+    parents = {}
+    missing = []
+    for model_id in model_ids:
+        found, parent_name = cache.get(model_id) if use_cache else (False, None)
+        if found:
+            parents[model_id] = parent_name
+        else:
+            missing.append(model_id)
+
+    client = get_erp_client(api_key, api_secret, erp_url)
+    for start in range(0, len(missing), PARENT_LOOKUP_CHUNK):
+        chunk = missing[start:start + PARENT_LOOKUP_CHUNK]
+        params = {
+            "filters": json.dumps([["model_id", "in", chunk]]),
+            "fields": '["name", "model_id"]',
+            "limit_page_length": 0  # All matches
+        }
+        response = client.get(erp_url.rstrip('/'), params=params, op="parent_lookup")
+        response.raise_for_status()
+        found = {}
+        for row in response.json().get("data", []):
+            found.setdefault(row.get("model_id"), row.get("name"))  # First match, like the single lookup
+        for model_id in chunk:
+            parents[model_id] = found.get(model_id)
+            cache.put(model_id, parents[model_id])
+    return parents
+
+# Function to create the parents of new work orders with one insert_many call, each with its first rows as children.
+# groups is {model_id: MarkBatch}. Returns {model_id: parent name} of the parents that exist afterwards - the others
+# are left to the regular per document POST
+def create_parent_records(groups, api_key, api_secret, erp_url, timeout=None):
+    client = get_erp_client(api_key, api_secret, erp_url)
+    base_url, parent_doctype = split_erp_url(erp_url)
+    model_ids = list(groups)
+    docs = [
+        f'{{"doctype": {encode_json_string(parent_doctype)}, "model_id": {json.dumps(model_id)}, '
+        f'"serial_no": {json.dumps(batch.column("serial_no")[0])}, "laser_marking": [{", ".join(batch.to_erp_json())}], '
+        f'"docstatus": 0}}'
+        for model_id, batch in groups.items()
+    ]
+    try:
+        response = client.post(f"{base_url}/api/method/frappe.client.insert_many", data='{"docs": [' + ", ".join(docs) + ']}',
+                               timeout=timeout, op="parent_insert")
+        response.raise_for_status()
+        names = response.json().get("message") or []
+        if len(names) == len(model_ids):
+            created = dict(zip(model_ids, names))
+            for model_id, parent_name in created.items():
+                get_parent_cache().put(model_id, parent_name)
+            return created
+        logging.warning(f"Bulk parent creation returned {len(names)} name(s) for {len(model_ids)} document(s).")
+    except (requests.RequestException, ValueError) as e:
+        logging.warning(f"Bulk parent creation failed for {len(model_ids)} work order(s), creating them one by one: {e}")
+        print(f"Bulk parent creation failed, creating {len(model_ids)} work order(s) one by one: {e}")
+
+    # The insert may have gone through without a usable answer - a parent found now holds the rows just sent
+    try:
+        parents = resolve_parent_records(model_ids, api_key, api_secret, erp_url, use_cache=False)
+    except requests.RequestException as e:
+        logging.error(f"Parent lookup after bulk creation failed: {e}")
+        return {}
+    return {model_id: parent_name for model_id, parent_name in parents.items() if parent_name}
+
+# Helper function of send_to_erpnext_batched - resolves every work order of the batch with one lookup and creates
+# the missing parents together, each with its first chunk of rows. Returns the model_ids whose first chunk went out
+def bulk_create_parents(data, grouped_index, record_results, batch_size, api_key, api_secret, erp_url, timeout=None):
+    if not settings["Bulk_Parent_Create"] or len(grouped_index) < 2:
+        return set()
+    try:
+        parents = resolve_parent_records(list(grouped_index), api_key, api_secret, erp_url)
+    except requests.RequestException as e:
+        logging.error(f"Bulk parent lookup failed: {e}")
+        return set()
+    new_model_ids = sorted(model_id for model_id, parent_name in parents.items() if not parent_name)
+    if len(new_model_ids) < 2:
+        return set()  # A single new work order is one POST either way
+
+    delivered = set()
+    # Taken in sorted order - the only place holding more than one work order lock
+    locks = [get_work_order_lock(model_id) for model_id in new_model_ids]
+    for lock in locks:
+        lock.acquire()
+    try:
+        cache = get_parent_cache()
+        # Another worker may have created some of them while the locks were awaited
+        pending = [model_id for model_id in new_model_ids if not cache.get(model_id)[1]]
+
+        # Same request size limits as the updates - ERP_Batch_Size rows and INSERT_MANY_LIMIT documents per call
+        calls = []
+        groups, rows = {}, 0
+        for model_id in pending:
+            batch = MarkBatch.from_records([data[i] for i in grouped_index[model_id][:batch_size]])
+            if groups and (len(groups) >= INSERT_MANY_LIMIT or rows + len(batch) > batch_size):
+                calls.append(groups)
+                groups, rows = {}, 0
+            groups[model_id] = batch
+            rows += len(batch)
+        if groups:
+            calls.append(groups)
+
+        for groups in calls:
+            created = create_parent_records(groups, api_key, api_secret, erp_url, timeout)
+            for model_id, parent_name in created.items():
+                for i in grouped_index[model_id][:batch_size]:
+                    record_results[i] = True
+                delivered.add(model_id)
+                console(f"Successfully submitted: {parent_name}")
+                logging.info(f"Successfully submitted: {parent_name} (model_id {model_id}, {len(groups[model_id])} row(s))")
+    finally:
+        for lock in locks:
+            lock.release()
+    return delivered
+
+# Function to read the serial_nos ERP already holds for a work order (empty set when the parent does not exist yet)
+def fetch_erp_serial_nos(model_id, api_key, api_secret, erp_url):
+    parent_name = get_parent_record(model_id, api_key, api_secret, erp_url)
+    if not parent_name:
+        return set()
+    client = get_erp_client(api_key, api_secret, erp_url)
+    response = client.get(f"{erp_url.rstrip('/')}/{parent_name}", op="get")
+    response.raise_for_status()
+    rows = response.json().get("data", {}).get("laser_marking", [])
+    return {row.get("serial_no") for row in rows if row.get("serial_no")}
+
+# Append-only child row insertion through frappe.client.insert_many.
+# Only the new rows go over the wire and ERP appends them to the parent, so the request size does not
+# grow with the laser_marking table and parallel writers cannot overwrite each other's rows.
+INSERT_MANY_LIMIT = 200  # Frappe rejects insert_many calls with more than 200 documents
+
+# HTTP status codes meaning the ERP has no insert_many method. A 404 only counts once the parent is known to exist,
+# other statuses (403, 417, 5xx) are ordinary failures of the batch and leave child insert enabled
+CHILD_INSERT_UNSUPPORTED = (404, 405)
+
+child_insert_state = {"disabled": False}
+
+# Helper function to check if the append-only path should be tried
+def child_insert_enabled():
+    return settings["ERP_Append_Mode"] == "child_insert" and not child_insert_state["disabled"]
+
+# Helper function to split the ERP resource URL into the site base URL and the parent doctype
+def split_erp_url(erp_url):
+    base_url, _, doctype = erp_url.rstrip('/').partition("/api/resource/")
+    return base_url, urllib.parse.unquote(doctype)
+
+# Function to append child rows to an existing parent. Returns None when child insert is unsupported.
+# child_data is a MarkBatch, the request body is serialized straight from its columns
+def insert_child_rows(parent_name, child_data, client, erp_url, timeout=None):
+    base_url, parent_doctype = split_erp_url(erp_url)
+    suffix = (f', "doctype": {encode_json_string(settings["ERP_Child_Doctype"])}, "parenttype": {encode_json_string(parent_doctype)}'
+              f', "parentfield": "laser_marking", "parent": {encode_json_string(parent_name)}')
+    body = '{"docs": [' + ", ".join(child_data.to_erp_json(suffix)) + ']}'
+
+    url = f"{base_url}/api/method/frappe.client.insert_many"
+    response = client.post(url, data=body, timeout=timeout, op="child_insert")
+
+    if response.status_code == 404 and not parent_exists(parent_name, client, erp_url):
+        response.raise_for_status()  # Parent deleted in ERP (or ERP did not answer), handled by the caller like any other 404
+
+    if response.status_code in CHILD_INSERT_UNSUPPORTED:
+        child_insert_state["disabled"] = True
+        logging.warning(f"Child insert rejected by ERP ({response.status_code}), "
+                        f"falling back to full document update: {response.text[:200]}")
+        print(f"Child insert not available ({response.status_code}), using full document update.")
+        return None
+
+    response.raise_for_status()
+    return response
+
+# Helper function to tell a missing parent apart from a missing child doctype or method after a 404.
+# Returns None when ERP could not answer.
+def parent_exists(parent_name, client, erp_url):
+    try:
+        response = client.get(f"{erp_url}/{parent_name}", params={"fields": '["name"]'}, op="get")
+    except requests.RequestException:
+        return None
+    if response.status_code == 404:
+        return False
+    return response.ok or None
 
 #Send to ERP API call with POST & PUT mode - GET added when parent with child exists - no Overwriting
-# Function to handle API requests with logging and error handling
-def send_to_erpnext(data, api_key, api_secret, erp_url, retries=3, delay=15, timeout=10):
-    logging.info("Triggered API functionality.")
-    
-    headers = {
-        "Authorization": f"token {api_key}:{api_secret}",
-        "Content-Type": "application/json"
-    }
-    
-    # Check if ERP server is reachable before proceeding
-    if not is_erp_server_running(erp_url, retries=3, delay=5):
-        return False  # Exit if the server is not reachable
-    
-    # Group records by model_id (WorkOrder no.)
-    grouped_data = defaultdict(list)
-    for record in data:
-        grouped_data[record["model_id"]].append(record)
-
-    all_successful = True
-    for model_id, records in grouped_data.items():
-        # Fetch parent document name based on model_id
+# Batch upload mode - one grouped update per work order, split into chunks of at most batch_size records.
+# Returns overall status and a per-record status list in the same order as data.
+@metrics.timed("send_to_erpnext")
+def send_to_erpnext_batched(data, api_key, api_secret, erp_url, batch_size=None, retries=3, delay=15, timeout=None):
+    logging.info("Triggered batched API functionality.")
+    if batch_size is None:
+        batch_size = settings["ERP_Batch_Size"]
+    batch_size = max(1, int(batch_size))
+
+    # True delivered, False sent but failed, None held back or not sent at all (no retry attempt used up)
+    record_results = [None] * len(data)
+
+    # Skip instantly while the ERP circuit breaker is open, data stays pending
+    if get_erp_breaker().is_open():
+        return False, record_results
+
+    # Group record positions by model_id (WorkOrder no.)
+    grouped_index = defaultdict(list)
+    for index, record in enumerate(data):
+        grouped_index[record["model_id"]].append(index)
+
+    # New work orders are looked up and created together, their first chunk goes out with the parent
+    created = bulk_create_parents(data, grouped_index, record_results, batch_size, api_key, api_secret, erp_url, timeout)
+
+    # Chunks of one work order go out strictly one after another. A failed chunk holds back the later ones,
+    # so the rows of a work order reach ERP in order once the next cycle retries them
+    def upload_work_order(model_id, indexes):
+        for start in range(batch_size if model_id in created else 0, len(indexes), batch_size):
+            chunk = indexes[start:start + batch_size]
+            chunk_results = [False] * len(chunk)
+            success = send_group_to_erpnext(model_id, [data[i] for i in chunk], api_key, api_secret, erp_url, retries, delay,
+                                            timeout, chunk_results)
+            for i, ok in zip(chunk, chunk_results):
+                record_results[i] = ok
+            if not success:
+                failed = [i for i, ok in zip(chunk, chunk_results) if not ok]
+                logging.error(f"Upload failed for {len(failed)}/{len(chunk)} record(s) of model_id {model_id}: "
+                              f"{', '.join(str(data[i].get('serial_no', '')) for i in failed)}")
+                held_back = len(indexes) - start - len(chunk)
+                if held_back:
+                    logging.warning(f"{held_back} later record(s) of model_id {model_id} held back for the next cycle.")
+                return
+
+    # Different work orders are uploaded in parallel on the shared upload pool
+    if settings["Upload_Concurrency"] > 1 and len(grouped_index) > 1:
+        futures = [submit_upload(upload_work_order, model_id, indexes) for model_id, indexes in grouped_index.items()]
+        for future in futures:
+            future.result()
+    else:
+        for model_id, indexes in grouped_index.items():
+            upload_work_order(model_id, indexes)
+
+    cache = get_parent_cache()
+    cache.save()
+    logging.info(f"Parent name cache: {cache.stats()}")
+
+    return all(record_results), record_results
+
+upload_executor = None
+upload_executor_lock = threading.Lock()
+
+# Helper function to create the upload pool once per process - shared by every caller, so Upload_Concurrency
+# is the limit for the whole program, also with several pipeline uploaders or sources
+def get_upload_executor():
+    global upload_executor
+    with upload_executor_lock:
+        if upload_executor is None:
+            upload_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, settings["Upload_Concurrency"]),
+                                                                    thread_name_prefix="LM-upload")
+        return upload_executor
+
+upload_futures = set()  # Submitted and not finished yet, waited for on shutdown
+
+# Helper function to run one upload on the shared pool and keep track of it until it is done
+def submit_upload(fn, *args):
+    future = get_upload_executor().submit(fn, *args)
+    with upload_executor_lock:
+        upload_futures.add(future)
+    future.add_done_callback(forget_upload)
+    return future
+
+def forget_upload(future):
+    with upload_executor_lock:
+        upload_futures.discard(future)
+
+work_order_locks = defaultdict(threading.Lock)
+work_order_locks_guard = threading.Lock()
+
+# Helper function to get the lock of one work order - uploads of several workers or sources to the same work order
+# are serialized, so the parent document is never created twice and full_rewrite never loses rows
+def get_work_order_lock(model_id):
+    with work_order_locks_guard:
+        return work_order_locks[model_id]
+
+# Function to send all records of one work order in a single parent update (PUT) or creation (POST).
+# record_results (optional, one entry per record) is set True for every row that reached ERP, also when a later
+# child insert chunk failed and the call as a whole returns False
+def send_group_to_erpnext(model_id, records, api_key, api_secret, erp_url, retries=3, delay=15, timeout=None,
+                          record_results=None):
+    with get_work_order_lock(model_id):
+        return send_group_locked(model_id, records, api_key, api_secret, erp_url, retries, delay, timeout, record_results)
+
+def send_group_locked(model_id, records, api_key, api_secret, erp_url, retries=3, delay=15, timeout=None,
+                      record_results=None):
+    client = get_erp_client(api_key, api_secret, erp_url)
+
+    # Fetch parent document name based on model_id
+    try:
         parent_name = get_parent_record(model_id, api_key, api_secret, erp_url)
-        logging.info(f"Parent Name: {parent_name}")
-
-        # Preparing child data for the laser_marking field with default values if no data is present
-        child_data = [{
-            "serial_no": record.get("serial_no", ""),
-            "model_id": record.get("model_id", ""),
-            "program_name": record.get("program_name", ""),
-            "top_panel": record.get("top_panel", ""),
-            "top_time": record.get("top_time", ""),
-            "bottom_panel": record.get("bottom_panel", ""),
-            "bottom_time": record.get("bottom_time", "")
-        } for record in records]
+    except requests.RequestException as e:
+        logging.error(f"Parent lookup failed for model_id {model_id}: {e}")
+        print(f"Parent lookup failed for model_id {model_id}: {e}")
+        return False
+    logging.info(f"Parent Name: {parent_name}")
 
-        
-        attempt = 0
-        while attempt < retries:
-            try:
-                if parent_name:
-                    # If parent exists, fetch the existing child records and append new data
-                    url = f"{erp_url}/{parent_name}"
-                    response = requests.get(url, headers=headers)  # Fetch existing data to avoid overwriting
-                    response.raise_for_status()
-
-                    existing_data = response.json()
-                    existing_laser_marking = existing_data.get("data", {}).get("laser_marking", [])
-
-                    # Append new data to existing child records
-                    existing_laser_marking.extend(child_data)
-
-                    # Now update the parent document with the new combined child data
-                    payload = {
-                        "laser_marking": existing_laser_marking
-                    }
-                    response = requests.put(url, headers=headers, data=json.dumps(payload), timeout=timeout)
-                else:
-                    # If parent doesn't exist, create a new parent document (POST request)
-                    url = erp_url
-                    payload = {
-                        "model_id": model_id,
-                        "serial_no": records[0]["serial_no"],
-                        "laser_marking": child_data,
-                        "docstatus": 0
-                    }
-                    response = requests.post(url, headers=headers, data=json.dumps(payload), timeout=timeout)
-                
+    # Preparing child data for the laser_marking field - columns of the records, "" for a missing side on serialization
+    child_data = records if isinstance(records, MarkBatch) else MarkBatch.from_records(records)
+
+    successful = True
+    inserted = 0  # Rows already appended through the child insert path, never re-sent on retry
+    attempt = 0
+    while attempt < retries:
+        try:
+            doc_name = None
+            if parent_name and child_insert_enabled():
+                # Append-only path - send only the new rows, ERP appends them to the parent server side
+                while inserted < len(child_data):
+                    chunk = child_data.slice(inserted, inserted + INSERT_MANY_LIMIT)
+                    response = insert_child_rows(parent_name, chunk, client, erp_url, timeout)
+                    if response is None:
+                        break  # Child insert not available, fall back to full rewrite below
+                    inserted += len(chunk)
+                    doc_name = parent_name
+
+            if parent_name and inserted < len(child_data):
+                # Fallback - fetch the existing child records and append new data
+                url = f"{erp_url}/{parent_name}"
+                response = client.get(url, op="get")  # Fetch existing data to avoid overwriting
                 response.raise_for_status()
 
-                if response.status_code == 200:
+                existing_data = response.json()
+                existing_laser_marking = existing_data.get("data", {}).get("laser_marking", [])
+
+                # Append new data to existing child records
+                existing_laser_marking.extend(child_data.slice(inserted).to_erp_dicts())
+
+                # Now update the parent document with the new combined child data
+                payload = {
+                    "laser_marking": existing_laser_marking
+                }
+                response = client.put(url, data=json.dumps(payload), timeout=timeout, op="put")
+                doc_name = None
+            elif not parent_name:
+                # If parent doesn't exist, create a new parent document (POST request)
+                url = erp_url
+                payload = (f'{{"model_id": {json.dumps(model_id)}, "serial_no": {json.dumps(child_data.column("serial_no")[0])}, '
+                           f'"laser_marking": [{", ".join(child_data.to_erp_json())}], "docstatus": 0}}')
+                response = client.post(url, data=payload, timeout=timeout, op="post")
+            
+            response.raise_for_status()
+
+            if response.status_code == 200:
+                if doc_name is None:
                     created_doc = response.json()
                     doc_name = created_doc.get("data", {}).get("name", None)
 
-                    if doc_name:
-                        print(f"Successfully submitted: {doc_name}")
-                        logging.info(f"Successfully submitted: {doc_name}")
-                    else:
-                        print("Document creation failed, no name returned.")
-                        all_successful = False
-                else:
-                    logging.error(f"Error {response.status_code}: {response.text}")
-                    print(f"Error {response.status_code}: {response.text}")
-                    all_successful = False
-                break  # Exit retry loop if successful
-
-            except requests.exceptions.HTTPError as err:
-                # Handle 409 Conflict error for existing data
-                if err.response.status_code == 409:
-                    logging.warning(f"Conflict (409) for record with model_id {model_id}. Skipping this record.")
-                    print(f"Conflict Error 409. Record for model_id {model_id} already exists, skipping.")
-                    break  # Exit retry loop as conflict is non-critical and can be skipped
-                
-                logging.error(f"API request failed on attempt {attempt + 1}/{retries}: {err}")
-                print(f"API request failed: {err}")
-                attempt += 1
-                if attempt < retries:
-                    print(f"Retrying in {delay} seconds...")
-                    time.sleep(delay)
+                if doc_name:
+                    console(f"Successfully submitted: {doc_name}")
+                    logging.info(f"Successfully submitted: {doc_name}")
+                    if not parent_name:
+                        get_parent_cache().put(model_id, doc_name)  # New parent is known right away
                 else:
-                    print("Max retries reached, giving up.")
-                    all_successful = False
-                    break
-
-            except requests.RequestException as e:
-                logging.error(f"API request failed on attempt {attempt + 1}/{retries}: {e}")
-                print(f"API request failed: {e}")
-                attempt += 1
-                if attempt < retries:
-                    print(f"Retrying in {delay} seconds...")
-                    time.sleep(delay)
-                else:
-                    print("Max retries reached, giving up.")
-                    all_successful = False
-                    break
-
-    return all_successful
+                    print("Document creation failed, no name returned.")
+                    successful = False
+            else:
+                logging.error(f"Error {response.status_code}: {response.text}")
+                print(f"Error {response.status_code}: {response.text}")
+                successful = False
+            break  # Exit retry loop if successful
+
+        except requests.exceptions.HTTPError as err:
+            # Handle 409 Conflict error for existing data
+            if err.response.status_code == 409:
+                logging.warning(f"Conflict (409) for record with model_id {model_id}. Skipping this record.")
+                print(f"Conflict Error 409. Record for model_id {model_id} already exists, skipping.")
+                break  # Exit retry loop as conflict is non-critical and can be skipped
+
+            if err.response.status_code == 404 and parent_name:
+                # Cached parent no longer exists in ERP, create it again on the next attempt
+                get_parent_cache().invalidate(model_id)
+                parent_name = None
+                inserted = 0
+            
+            logging.error(f"API request failed on attempt {attempt + 1}/{retries}: {err}")
+            print(f"API request failed: {err}")
+            attempt += 1
+            if attempt < retries:
+                print(f"Retrying in {delay} seconds...")
+                time.sleep(delay)
+            else:
+                print("Max retries reached, giving up.")
+                successful = False
+                break
+
+        except CircuitOpenError as e:
+            logging.warning(f"Upload for model_id {model_id} skipped: {e}")
+            successful = False
+            break  # No point retrying until the breaker lets a probe through
+
+        except requests.RequestException as e:
+            logging.error(f"API request failed on attempt {attempt + 1}/{retries}: {e}")
+            print(f"API request failed: {e}")
+            attempt += 1
+            if attempt < retries:
+                print(f"Retrying in {delay} seconds...")
+                time.sleep(delay)
+            else:
+                print("Max retries reached, giving up.")
+                successful = False
+                break
+
+    if record_results is not None:
+        # Child insert chunks ERP already committed are reported as delivered, so they are never sent twice
+        for i in range(len(child_data) if successful else inserted):
+            record_results[i] = True
+    return successful
+
+# Durable outbox - delivery state per (serial_no, pd_no, source file) so only undelivered rows are retried.
+# Retries wait with exponential backoff + jitter kept in the store instead of sleeping in the scheduler thread.
+class Outbox:
+    PENDING = "pending"
+    DELIVERED = "delivered"
+    DUPLICATE = "duplicate"  # Every side (top/bottom) of the row already acknowledged by ERP through other rows
+
+    def __init__(self, db_path, backoff_base=15, backoff_max=900):
+        self.db_path = db_path
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "serial_no TEXT NOT NULL, pd_no TEXT NOT NULL, source_file TEXT NOT NULL, model_id TEXT, "
+            "record TEXT NOT NULL, state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "next_attempt_at REAL NOT NULL DEFAULT 0, last_error TEXT, created_at TEXT NOT NULL, delivered_at TEXT, "
+            "PRIMARY KEY (serial_no, pd_no, source_file))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS outbox_source_state ON outbox (source_file, state)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS outbox_model_state ON outbox (model_id, state, next_attempt_at)")
+        # sides - "T", "B" or "TB", the panel sides a row carries. A later row of the same board is only a
+        # duplicate when ERP already acknowledged every side it carries
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(outbox)")}
+        if "sides" not in columns:
+            self.conn.execute("ALTER TABLE outbox ADD COLUMN sides TEXT NOT NULL DEFAULT ''")
+            rows = self.conn.execute("SELECT rowid, record FROM outbox").fetchall()
+            self.conn.executemany("UPDATE outbox SET sides = ? WHERE rowid = ?",
+                                  [(self.record_sides(json.loads(record)), rowid) for rowid, record in rows])
+        acknowledged = {row[1] for row in self.conn.execute("PRAGMA table_info(acknowledged)")}
+        if acknowledged and "side" not in acknowledged:
+            # Older stores acknowledged the serial_no only - taken as both sides, as they were treated before
+            self.conn.execute("ALTER TABLE acknowledged RENAME TO acknowledged_serials")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS acknowledged ("
+            "serial_no TEXT NOT NULL, side TEXT NOT NULL, model_id TEXT, source_file TEXT, delivered_at TEXT NOT NULL, "
+            "PRIMARY KEY (serial_no, side))"
+        )
+        if acknowledged and "side" not in acknowledged:
+            for side in ("T", "B"):
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO acknowledged (serial_no, side, model_id, source_file, delivered_at) "
+                    "SELECT serial_no, ?, model_id, source_file, delivered_at FROM acknowledged_serials", (side,)
+                )
+            self.conn.execute("DROP TABLE acknowledged_serials")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS acknowledged_delivered_at ON acknowledged (delivered_at)")
+        self.conn.commit()
+
+    @staticmethod
+    def record_sides(record):
+        return ("T" if record.get("top_panel") else "") + ("B" if record.get("bottom_panel") else "")
+
+    # Add the rows of a JSON file, rows already known are left untouched (idempotent)
+    def enqueue(self, source_file, records):
+        source = os.path.basename(source_file)
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO outbox (serial_no, pd_no, source_file, model_id, record, state, created_at, sides) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(record.get("serial_no", ""), record.get("pd_no", ""), source, record.get("model_id", ""),
+                  json.dumps(record), self.PENDING, now, self.record_sides(record)) for record in records]
+            )
+            self.conn.commit()
+
+    # Pending rows of a file whose backoff has expired. Rows whose every side is already acknowledged are closed
+    # as duplicates - a bottom half arriving after its top half went out alone is still sent.
+    # A work order with rows still in backoff is skipped as a whole, so rows held back behind a failed chunk
+    # never overtake it and reach ERP in order
+    def due(self, source_file):
+        source = os.path.basename(source_file)
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "UPDATE outbox SET state = ? WHERE source_file = ? AND state = ? AND sides != '' "
+                "AND (instr(sides, 'T') = 0 OR EXISTS (SELECT 1 FROM acknowledged AS a "
+                "WHERE a.serial_no = outbox.serial_no AND a.side = 'T')) "
+                "AND (instr(sides, 'B') = 0 OR EXISTS (SELECT 1 FROM acknowledged AS a "
+                "WHERE a.serial_no = outbox.serial_no AND a.side = 'B'))",
+                (self.DUPLICATE, source, self.PENDING)
+            )
+            self.conn.commit()
+            rows = self.conn.execute(
+                "SELECT serial_no, pd_no, record FROM outbox WHERE source_file = ? AND state = ? AND next_attempt_at <= ? "
+                "AND model_id NOT IN (SELECT model_id FROM outbox WHERE state = ? AND next_attempt_at > ? AND model_id IS NOT NULL) "
+                "ORDER BY rowid",
+                (source, self.PENDING, now, self.PENDING, now)
+            ).fetchall()
+        return [((serial_no, pd_no, source), json.loads(record)) for serial_no, pd_no, record in rows]
+
+    def mark_delivered(self, keys):
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self.lock:
+            for serial_no, pd_no, source in keys:
+                self.conn.execute(
+                    "UPDATE outbox SET state = ?, delivered_at = ?, attempts = attempts + 1, last_error = NULL "
+                    "WHERE serial_no = ? AND pd_no = ? AND source_file = ?",
+                    (self.DELIVERED, now, serial_no, pd_no, source)
+                )
+                for side in ("T", "B"):
+                    self.conn.execute(
+                        "INSERT OR IGNORE INTO acknowledged (serial_no, side, model_id, source_file, delivered_at) "
+                        "SELECT serial_no, ?, model_id, source_file, ? FROM outbox "
+                        "WHERE serial_no = ? AND pd_no = ? AND source_file = ? AND instr(sides, ?) > 0",
+                        (side, now, serial_no, pd_no, source, side)
+                    )
+            self.conn.commit()
+
+    # The failed rows of one work order become due again together - one backoff per work order batch,
+    # taken from its most retried row
+    def mark_failed(self, keys, error):
+        with self.lock:
+            batches = defaultdict(list)
+            for serial_no, pd_no, source in keys:
+                row = self.conn.execute(
+                    "SELECT attempts, model_id FROM outbox WHERE serial_no = ? AND pd_no = ? AND source_file = ?",
+                    (serial_no, pd_no, source)
+                ).fetchone()
+                if row:
+                    batches[row[1]].append((row[0], (serial_no, pd_no, source)))
+            now = time.time()
+            for batch in batches.values():
+                next_attempt_at = now + self.backoff_delay(max(attempts for attempts, _ in batch) + 1)
+                self.conn.executemany(
+                    "UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ?, last_error = ? "
+                    "WHERE serial_no = ? AND pd_no = ? AND source_file = ?",
+                    [(next_attempt_at, error, *key) for _, key in batch]
+                )
+            self.conn.commit()
+
+    # Exponential backoff with +-50% jitter so failed work orders of many files do not retry in lockstep
+    def backoff_delay(self, attempts):
+        delay = min(self.backoff_max, self.backoff_base * (2 ** (attempts - 1)))
+        return delay * random.uniform(0.5, 1.5)
+
+    def pending_count(self, source_file):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM outbox WHERE source_file = ? AND state = ?",
+                (os.path.basename(source_file), self.PENDING)
+            ).fetchone()[0]
+
+    # Drop rows of fully delivered history, acknowledged sides are kept as long as the retention allows
+    def purge(self, retention_days):
+        cutoff = datetime.fromtimestamp(time.time() - retention_days * 86400).strftime('%Y-%m-%d %H:%M:%S')
+        with self.lock:
+            self.conn.execute("DELETE FROM outbox WHERE state != ? AND delivered_at IS NOT NULL AND delivered_at < ?",
+                              (self.PENDING, cutoff))
+            self.conn.execute("DELETE FROM outbox WHERE state = ? AND created_at < ?", (self.DUPLICATE, cutoff))
+            self.conn.execute("DELETE FROM acknowledged WHERE delivered_at < ?", (cutoff,))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+outbox = None
+
+# Helper function to open the shared outbox once per process
+def get_outbox():
+    global outbox
+    if outbox is None:
+        outbox = Outbox(state_files["Outbox"],
+                        backoff_base=settings["Outbox_Backoff_Base"],
+                        backoff_max=settings["Outbox_Backoff_Max"])
+    return outbox
+
+# serial_no -> (model_id, program_name, top/bottom panel and time) index over everything in Done_Folder.
+# SPI, PAOI & AOI look a board up with one indexed query instead of scanning every LM JSON file.
+# The live index is in State_Folder, the copy in Done_Folder for the FTP transfer is kept up to date incrementally.
+SERIAL_INDEX_EXPORT_NAME = "lm_serial_index.db"
+
+class SerialIndex:
+    FIELDS = ("model_id", "program_name", "top_panel", "top_time", "bottom_panel", "bottom_time", "source_file")
+
+    def __init__(self, db_path, export_path=None, export_interval=60, retention_days=0):
+        self.db_path = db_path
+        self.export_path = export_path
+        self.export_interval = export_interval
+        self.retention_days = retention_days
+        self.last_export = 0
+        self.last_prune = 0
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.export_lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS serials ("
+            "serial_no TEXT PRIMARY KEY, model_id TEXT, program_name TEXT, top_panel TEXT, top_time TEXT, "
+            "bottom_panel TEXT, bottom_time TEXT, source_file TEXT, "
+            "seq INTEGER NOT NULL DEFAULT 0, updated_at REAL NOT NULL DEFAULT 0) WITHOUT ROWID"
+        )
+        # seq (change counter) and updated_at came later - indexes of older versions start with every row at seq 1
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(serials)")}
+        if "seq" not in columns:
+            self.conn.execute("ALTER TABLE serials ADD COLUMN seq INTEGER NOT NULL DEFAULT 1")
+            self.conn.execute("ALTER TABLE serials ADD COLUMN updated_at REAL NOT NULL DEFAULT 0")
+            self.conn.execute("UPDATE serials SET updated_at = ?", (time.time(),))
+        self.conn.execute("CREATE INDEX IF NOT EXISTS serials_seq ON serials (seq)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS serials_updated_at ON serials (updated_at)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS pruned (seq INTEGER NOT NULL, cutoff REAL NOT NULL)")
+        self.conn.commit()
+        self.seq = self.conn.execute("SELECT MAX(seq) FROM (SELECT MAX(seq) AS seq FROM serials "
+                                     "UNION ALL SELECT MAX(seq) FROM pruned)").fetchone()[0] or 0
+
+    # Upsert - a single sided record never wipes the other side already known for the board.
+    # Every change takes the next seq, the export picks up the rows past its high-water mark.
+    def add_records(self, records, source_file):
+        now = time.time()
+        with self.lock:
+            self.seq += 1
+            rows = [(record.get("serial_no", ""), record.get("model_id", ""), record.get("program_name", ""),
+                     record.get("top_panel", ""), record.get("top_time", ""),
+                     record.get("bottom_panel", ""), record.get("bottom_time", ""), source_file, self.seq, now)
+                    for record in records if record.get("serial_no")]
+            self.conn.executemany(
+                "INSERT INTO serials (serial_no, model_id, program_name, top_panel, top_time, bottom_panel, bottom_time, "
+                "source_file, seq, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(serial_no) DO UPDATE SET "
+                "model_id = COALESCE(NULLIF(excluded.model_id, ''), model_id), "
+                "program_name = COALESCE(NULLIF(excluded.program_name, ''), program_name), "
+                "top_panel = COALESCE(NULLIF(excluded.top_panel, ''), top_panel), "
+                "top_time = COALESCE(NULLIF(excluded.top_time, ''), top_time), "
+                "bottom_panel = COALESCE(NULLIF(excluded.bottom_panel, ''), bottom_panel), "
+                "bottom_time = COALESCE(NULLIF(excluded.bottom_time, ''), bottom_time), "
+                "source_file = excluded.source_file, seq = excluded.seq, updated_at = excluded.updated_at",
+                rows
+            )
+            self.conn.commit()
+            self.dirty = True
+
+    def is_empty(self):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM serials LIMIT 1").fetchone() is None
+
+    def lookup(self, serial_no):
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT {', '.join(self.FIELDS)} FROM serials WHERE serial_no = ?", (serial_no,)
+            ).fetchone()
+        return dict(zip(self.FIELDS, row)) if row else None
+
+    # Retention - boards not seen for retention_days are dropped. The cutoff is recorded with its own seq,
+    # so the export drops the same rows on its next update. Runs at most once an hour.
+    def prune(self, now=None):
+        now = now or time.time()
+        if not self.retention_days or now - self.last_prune < 3600:
+            return 0
+        self.last_prune = now
+        cutoff = now - self.retention_days * 86400
+        with self.lock:
+            removed = self.conn.execute("DELETE FROM serials WHERE updated_at < ?", (cutoff,)).rowcount
+            if removed:
+                self.seq += 1
+                self.conn.execute("INSERT INTO pruned (seq, cutoff) VALUES (?, ?)", (self.seq, cutoff))
+                self.conn.execute("DELETE FROM pruned WHERE seq < (SELECT MAX(seq) FROM pruned)")
+                self.dirty = True
+            self.conn.commit()
+        if removed:
+            logging.info(f"Serial index: {removed} board(s) older than {self.retention_days} day(s) pruned.")
+        return removed
+
+    # The export in Done_Folder is brought up to date with only the rows changed since its high-water mark
+    # (export_state.seq), applied to a temp copy that is then renamed, so an FTP pickup never sees a half
+    # written file. A missing or unreadable export is rebuilt with a full snapshot through the SQLite backup API.
+    # dirty is cleared only once the export holds every change made so far.
+    def export(self, force=False):
+        self.prune()
+        if not self.export_path or not self.dirty:
+            return
+        if not force and time.time() - self.last_export < self.export_interval:
+            return
+        with self.export_lock:
+            try:
+                seq = self.export_changes()
+                if seq is None:
+                    seq = self.export_snapshot()
+                    logging.info(f"Serial index exported to {self.export_path}")
+                self.last_export = time.time()
+                with self.lock:
+                    if self.seq == seq:
+                        self.dirty = False
+            except Exception as e:
+                logging.error(f"Failed to export serial index: {e}")
+
+    # Helper function of export - returns the seq exported, None when a full snapshot is needed
+    def export_changes(self):
+        if not os.path.exists(self.export_path):
+            return None
+        temp_path = self.export_path + ".tmp"
+        shutil.copyfile(self.export_path, temp_path)
+        target = sqlite3.connect(temp_path, timeout=30)
+        try:
+            try:
+                since = target.execute("SELECT seq FROM export_state").fetchone()[0]
+            except (sqlite3.DatabaseError, TypeError):
+                return None  # Older full snapshot without a high-water mark, or a damaged file
+            with self.lock:
+                if since > self.seq:
+                    return None  # Live index was reset, the export is ahead of it
+                rows = self.conn.execute(
+                    f"SELECT serial_no, {', '.join(self.FIELDS)}, seq, updated_at FROM serials WHERE seq > ?", (since,)
+                ).fetchall()
+                cutoffs = self.conn.execute("SELECT cutoff FROM pruned WHERE seq > ?", (since,)).fetchall()
+                seq = self.seq
+            with target:
+                for (cutoff,) in cutoffs:
+                    target.execute("DELETE FROM serials WHERE updated_at < ?", (cutoff,))
+                target.executemany(
+                    f"INSERT OR REPLACE INTO serials (serial_no, {', '.join(self.FIELDS)}, seq, updated_at) "
+                    f"VALUES ({', '.join('?' * (len(self.FIELDS) + 3))})",
+                    rows
+                )
+                target.execute("UPDATE export_state SET seq = ?", (seq,))
+        finally:
+            target.close()
+        os.replace(temp_path, self.export_path)
+        return seq
+
+    def export_snapshot(self):
+        temp_path = self.export_path + ".tmp"
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        target = sqlite3.connect(temp_path)
+        try:
+            with self.lock:
+                self.conn.backup(target)
+                seq = self.seq
+            target.execute("DROP TABLE IF EXISTS pruned")
+            target.execute("CREATE TABLE export_state (seq INTEGER NOT NULL)")
+            target.execute("INSERT INTO export_state (seq) VALUES (?)", (seq,))
+            target.commit()
+            target.execute("PRAGMA journal_mode=DELETE")
+        finally:
+            target.close()
+        os.replace(temp_path, self.export_path)
+        return seq
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+serial_index = None
+
+# Helper function to open the shared serial_no index once per process
+def get_serial_index():
+    global serial_index
+    if serial_index is None:
+        serial_index = SerialIndex(state_files["Serial_Index"],
+                                   export_path=os.path.join(folders["Done_Folder"], SERIAL_INDEX_EXPORT_NAME),
+                                   export_interval=settings["Serial_Index_Export_Interval"],
+                                   retention_days=settings["Serial_Index_Retention_Days"])
+        if serial_index.is_empty():
+            index_done_folder(serial_index)
+    return serial_index
+
+# Function to build the index once from the JSON files already in Done_Folder (first start)
+def index_done_folder(index):
+    done_folder = folders["Done_Folder"]
+    json_files = [file for file in os.listdir(done_folder) if file.endswith('.json')] if os.path.isdir(done_folder) else []
+    for file_name in sorted(json_files):
+        try:
+            records, _ = load_existing_json_2(os.path.join(done_folder, file_name))
+            index.add_records(records, file_name)
+        except Exception as e:
+            logging.error(f"Failed to index {file_name}: {e}")
+    if json_files:
+        logging.info(f"Serial index built from {len(json_files)} file(s) in Done_Folder.")
+
+# Lookup API for SPI, PAOI & AOI - O(log n) query on the exported index, no JSON parsing.
+# Returns a dict with model_id, program_name, top/bottom panel and time, source_file, or None when unknown.
+def lookup_serial_no(serial_no, index_path):
+    conn = sqlite3.connect(f"file:{urllib.request.pathname2url(os.path.abspath(index_path))}?mode=ro", uri=True)
+    try:
+        row = conn.execute(
+            f"SELECT {', '.join(SerialIndex.FIELDS)} FROM serials WHERE serial_no = ?", (serial_no,)
+        ).fetchone()
+    finally:
+        conn.close()
+    return dict(zip(SerialIndex.FIELDS, row)) if row else None
+
+# Rolling export bundles for the LAN FTP transfer to SPI, PAOI & AOI.
+# Done records go into hourly compressed JSONL segments (Export_Folder/segments/lm_YYYY-MM-DD_HH.jsonl.gz).
+# Each export appends one gzip member to the current segment and updates its sha256 incrementally.
+# manifest_<N>h.json lists the segments of each window with size, record count and sha256, so receivers
+# only fetch new or changed segments (the first size bytes - a later append may be under way). Segments older than the largest window are pruned.
+bundle_lock = threading.Lock()
+
+# Helper function to read the export state (segment name -> size, sha256, records)
+def load_bundle_state(export_folder):
+    state_file = os.path.join(export_folder, "export_state.json")
+    if os.path.exists(state_file):
+        with open(state_file, 'r') as f:
+            return json.load(f)
+    return {}
+
+# Helper function to write a small file atomically
+def write_json_atomic(path, data):
+    with open(path + ".tmp", 'w') as f:
+        json.dump(data, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+segment_hashers = {}  # segment name -> (size hashed, running sha256) of the segment currently appended to
+
+# Helper function to get the running sha256 of a segment, so an append hashes only the new member.
+# The segment of an hour that rolled over is sealed - its hash is dropped. After a restart the current
+# segment is hashed once from the file, up to the size recorded in the export state.
+def get_segment_hasher(segment_name, segment_path, size):
+    for name in [name for name in segment_hashers if name != segment_name]:
+        del segment_hashers[name]
+    cached = segment_hashers.get(segment_name)
+    if cached is not None and cached[0] == size:
+        return cached[1]
+    hasher = hashlib.sha256()
+    if size:
+        with open(segment_path, 'rb') as f:
+            remaining = size
+            while remaining:
+                chunk = f.read(min(remaining, 1024 * 1024))
+                hasher.update(chunk)
+                remaining -= len(chunk)
+    return hasher
+
+# Function to append Done records to the current hourly segment and refresh the window manifests
+def export_records_to_bundles(records, now=None):
+    if not records:
+        return
+    now = now or datetime.now()
+    export_folder = folders["Export_Folder"]
+    segment_folder = os.path.join(export_folder, "segments")
+    try:
+        with bundle_lock:
+            os.makedirs(segment_folder, exist_ok=True)
+            state = load_bundle_state(export_folder)
+
+            segment_name = f"lm_{now.strftime('%Y-%m-%d_%H')}.jsonl.gz"
+            segment_path = os.path.join(segment_folder, segment_name)
+            lines = "".join(json.dumps(record, separators=(',', ':')) + "\n" for record in records)
+            member = gzip.compress(lines.encode(), compresslevel=6)
+
+            entry = state.get(segment_name, {"records": 0, "size": 0, "hour": now.strftime('%Y-%m-%d %H:00:00')})
+            actual_size = os.path.getsize(segment_path) if os.path.exists(segment_path) else 0
+            if actual_size < entry["size"]:
+                logging.warning(f"Export segment {segment_name} is shorter than recorded ({actual_size} < {entry['size']}), "
+                                f"continuing from its current end.")
+                entry["size"] = actual_size
+            hasher = get_segment_hasher(segment_name, segment_path, entry["size"])
+
+            # Appended in place - concatenated gzip members read back as one stream. Bytes past the recorded size
+            # (an append cut short by a crash) are cut off first.
+            with open(segment_path, 'ab') as f:
+                if f.tell() != entry["size"]:
+                    f.truncate(entry["size"])
+                f.write(member)
+                f.flush()
+                os.fsync(f.fileno())
+            hasher.update(member)
+
+            entry["records"] += len(records)
+            entry["size"] += len(member)
+            entry["sha256"] = hasher.hexdigest()
+            entry["updated_at"] = now.strftime('%Y-%m-%d %H:%M:%S')
+            state[segment_name] = entry
+            segment_hashers[segment_name] = (entry["size"], hasher)
+
+            prune_bundles(state, segment_folder, now)
+            write_json_atomic(os.path.join(export_folder, "export_state.json"), state)
+            write_bundle_manifests(state, export_folder, now)
+    except Exception as e:
+        logging.error(f"Error exporting records to bundles: {e}")
+        print(f"Error exporting records to bundles: {e}")
+
+# Function to prune and re-list the windows when no new records came in (called every cycle)
+def refresh_export_bundles(now=None):
+    if not settings["Export_Bundles"]:
+        return
+    now = now or datetime.now()
+    export_folder = folders["Export_Folder"]
+    try:
+        with bundle_lock:
+            state = load_bundle_state(export_folder)
+            if not state:
+                return
+            prune_bundles(state, os.path.join(export_folder, "segments"), now)
+            write_json_atomic(os.path.join(export_folder, "export_state.json"), state)
+            write_bundle_manifests(state, export_folder, now)
+    except Exception as e:
+        logging.error(f"Error refreshing export bundles: {e}")
+
+# Function to drop segments older than the largest window
+def prune_bundles(state, segment_folder, now):
+    oldest_hour = now - timedelta(hours=max(settings["Export_Windows_Hours"]))
+    for segment_name, entry in list(state.items()):
+        if datetime.strptime(entry["hour"], '%Y-%m-%d %H:%M:%S') + timedelta(hours=1) <= oldest_hour:
+            segment_path = os.path.join(segment_folder, segment_name)
+            if os.path.exists(segment_path):
+                os.remove(segment_path)
+            del state[segment_name]
+            logging.info(f"Pruned export segment {segment_name}")
+
+# Function to write one manifest per window listing its segments
+def write_bundle_manifests(state, export_folder, now):
+    for hours in settings["Export_Windows_Hours"]:
+        start = now - timedelta(hours=hours)
+        segments = [dict(entry, name=f"segments/{segment_name}") for segment_name, entry in sorted(state.items())
+                    if datetime.strptime(entry["hour"], '%Y-%m-%d %H:%M:%S') + timedelta(hours=1) > start]
+        write_json_atomic(os.path.join(export_folder, f"manifest_{hours}h.json"), {
+            "window_hours": hours,
+            "generated_at": now.strftime('%Y-%m-%d %H:%M:%S'),
+            "segments": segments
+        })
+
+# Helper function for receivers - read every record of a segment
+def read_bundle_segment(segment_path):
+    with gzip.open(segment_path, 'rt') as f:
+        return [json.loads(line) for line in f if line.strip()]
 
 # When JSON File successfully processed, move to Done Folder
-def move_to_done_folder(json_file):
+# The serial_no index is updated from the same records, pass them when already loaded
+@metrics.timed("move_to_done_folder")
+def move_to_done_folder(json_file, records=None):
     try:
         if os.path.exists(json_file):  # Check if the file exists
             done_folder = folders["Done_Folder"]
-            shutil.move(json_file, os.path.join(done_folder, os.path.basename(json_file)))
+            if json_file.endswith('.jsonl'):
+                # Streaming files are exported in the usual document shape for SPI, PAOI & AOI
+                done_file = os.path.join(done_folder, os.path.basename(json_file)[:-1])
+                document = convert_jsonl_to_document(json_file, done_file)
+                os.remove(json_file)
+                discard_jsonl_state(json_file)
+                if records is None:
+                    records = document["laser_marking"]
+            else:
+                done_file = os.path.join(done_folder, os.path.basename(json_file))
+                shutil.move(json_file, done_file)
+                if records is None:
+                    records, _ = load_existing_json_2(done_file)
             logging.info(f"Moved {json_file} to Done Folder.")
-            print(f"Moved {json_file} to Done Folder.")
+            console(f"Moved {json_file} to Done Folder.")
+
+            index = get_serial_index()
+            index.add_records(records, os.path.basename(done_file))
+            index.export()
+
+            if settings["Export_Bundles"]:
+                export_records_to_bundles(records)
         else:
             logging.error(f"File not found: {json_file}")
             print(f"File not found: {json_file}")
@@ -402,83 +2808,943 @@ def move_to_done_folder(json_file):
         print(f"Error moving {json_file} file to Done Folder: {e}")
         
 
+#----------------------------------------------------------------------------Archive----!
+
+# Long term layout of Backup_Folder and Done_Folder. Files older than Archive_After_Hours move into a day shard
+# <Folder>/YYYY/MM/DD/ (day of the file mtime). Once the day is closed, the shard is packed into <Folder>/YYYY/MM/DD.zip.
+# Every archived file is recorded in State_Folder/archive_index.db, so one file can be found and pulled back out
+# without listing folders or unpacking the whole day.
+class ArchiveIndex:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS archived ("
+            "folder TEXT NOT NULL, name TEXT NOT NULL, day TEXT NOT NULL, location TEXT NOT NULL, member TEXT NOT NULL, "
+            "size INTEGER NOT NULL, archived_at TEXT NOT NULL, PRIMARY KEY (folder, location, member))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS archived_name ON archived (name)")
+        self.conn.commit()
+
+    # rows are (folder, name, day, location, member, size) - location is the shard folder or zip, relative to folder
+    def add(self, rows):
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO archived (folder, name, day, location, member, size, archived_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", [row + (now,) for row in rows])
+            self.conn.commit()
+
+    # Shard packed into its zip - the members keep their names
+    def move_day(self, folder, day, old_location, new_location):
+        with self.lock:
+            self.conn.execute("UPDATE archived SET location = ? WHERE folder = ? AND day = ? AND location = ?",
+                              (new_location, folder, day, old_location))
+            self.conn.commit()
+
+    # Members renamed while packing (a name already taken in the zip) - pairs of (shard name, zip member)
+    def rename_members(self, folder, location, renamed):
+        with self.lock:
+            self.conn.executemany("UPDATE archived SET member = ? WHERE folder = ? AND location = ? AND member = ?",
+                                  [(member, folder, location, name) for name, member in renamed])
+            self.conn.commit()
+
+    def drop_day(self, folder, day):
+        with self.lock:
+            self.conn.execute("DELETE FROM archived WHERE folder = ? AND day = ?", (folder, day))
+            self.conn.commit()
+
+    # Newest copy first - (folder, day, location, member)
+    def find(self, name, folder=None):
+        query = "SELECT folder, day, location, member FROM archived WHERE name = ?"
+        params = [name]
+        if folder is not None:
+            query += " AND folder = ?"
+            params.append(os.path.abspath(folder))
+        with self.lock:
+            return self.conn.execute(query + " ORDER BY day DESC, archived_at DESC, rowid DESC", params).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+archive_index = None
+
+# Helper function to open the archive index once per process
+def get_archive_index():
+    global archive_index
+    if archive_index is None:
+        archive_index = ArchiveIndex(state_files["Archive_Index"])
+    return archive_index
+
+# Helper function to list the day shards of a folder - (day, shard folder or None, zip or None), oldest first
+def iter_archive_days(folder):
+    days = {}
+    for year in sorted(os.listdir(folder)):
+        year_path = os.path.join(folder, year)
+        if not (len(year) == 4 and year.isdigit() and os.path.isdir(year_path)):
+            continue
+        for month in sorted(os.listdir(year_path)):
+            month_path = os.path.join(year_path, month)
+            if not (len(month) == 2 and month.isdigit() and os.path.isdir(month_path)):
+                continue
+            for entry in os.listdir(month_path):
+                day = entry[:-4] if entry.endswith('.zip') else entry
+                if not (len(day) == 2 and day.isdigit()):
+                    continue
+                shard, packed = days.setdefault(f"{year}-{month}-{day}", (None, None))
+                if entry.endswith('.zip'):
+                    packed = os.path.join(month_path, entry)
+                else:
+                    shard = os.path.join(month_path, entry)
+                days[f"{year}-{month}-{day}"] = (shard, packed)
+    return [(day, shard, packed) for day, (shard, packed) in sorted(days.items())]
+
+# Helper function to pick a free name in a shard or zip - a second file of the same name gets a ~2, ~3 ... suffix
+def unique_archive_name(name, taken):
+    if name not in taken:
+        return name
+    stem, ext = os.path.splitext(name)
+    counter = 2
+    while f"{stem}~{counter}{ext}" in taken:
+        counter += 1
+    return f"{stem}~{counter}{ext}"
+
+# Function to archive one folder - shard the old loose files, pack closed days, then apply retention and the size limit.
+# extensions limits the files archived (None - every file), keep lists names that always stay in place
+@metrics.timed("archive")
+def archive_folder(folder, after_hours=48, retention_days=0, max_mb=0, extensions=None, keep=()):
+    if not os.path.isdir(folder):
+        return {}
+    folder = os.path.abspath(folder)
+    index = get_archive_index()
+    stats = defaultdict(int)
+    now = time.time()
+    cutoff = now - after_hours * 3600
+
+    # 1. Loose files older than the cutoff move into their day shard (a rename, no data is copied)
+    rows = []
+    taken = {}  # shard -> names already in it
+    with os.scandir(folder) as entries:
+        loose = [(entry.name, entry.path, entry.stat()) for entry in entries
+                 if entry.is_file() and entry.name not in keep and not entry.name.endswith('.tmp')
+                 and (extensions is None or entry.name.endswith(extensions))]
+    for name, path, stat in loose:
+        if stat.st_mtime >= cutoff:
+            continue
+        day = datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d')
+        location = os.path.join(day[:4], day[5:7], day[8:10])
+        shard = os.path.join(folder, location)
+        if shard not in taken:
+            os.makedirs(shard, exist_ok=True)
+            taken[shard] = set(os.listdir(shard))
+        member = unique_archive_name(name, taken[shard])
+        taken[shard].add(member)
+        os.replace(path, os.path.join(shard, member))
+        rows.append((folder, name, day, location, member, stat.st_size))
+    if rows:
+        index.add(rows)
+        stats["sharded"] = len(rows)
+
+    # 2. Closed days - no file of the day can still be loose - are packed into one zip per day
+    days = iter_archive_days(folder)
+    for day, shard, packed in days:
+        day_end = (datetime.strptime(day, '%Y-%m-%d') + timedelta(days=1)).timestamp()
+        if shard is not None and day_end <= cutoff:
+            stats["packed"] += pack_archive_day(folder, day, shard, packed)
+
+    # 3. Retention by age, then the oldest days beyond the size limit
+    today = datetime.now().date()
+    days = iter_archive_days(folder)
+    sizes = []
+    for day, shard, packed in days:
+        if retention_days and (today - datetime.strptime(day, '%Y-%m-%d').date()).days > retention_days:
+            delete_archive_day(folder, day, shard, packed)
+            stats["deleted_days"] += 1
+            continue
+        size = os.path.getsize(packed) if packed else 0
+        if shard:
+            size += sum(entry.stat().st_size for entry in os.scandir(shard) if entry.is_file())
+        sizes.append((day, shard, packed, size))
+    total = sum(size for *_, size in sizes)
+    for day, shard, packed, size in sizes:
+        if not max_mb or total <= max_mb * 1024 * 1024:
+            break
+        delete_archive_day(folder, day, shard, packed)
+        total -= size
+        stats["deleted_days"] += 1
+
+    if stats:
+        logging.info(f"Archived {folder}: {dict(stats)}")
+    return dict(stats)
+
+# Function to pack a day shard into <day>.zip - written to a temp file and swapped in, so a crash never leaves a broken zip.
+# Files of a day already packed (late arrivals) are added to the existing zip. Returns the number of files packed
+def pack_archive_day(folder, day, shard, packed):
+    zip_path = shard + ".zip"
+    tmp_path = zip_path + ".tmp"
+    names = sorted(os.listdir(shard))
+    if packed:
+        shutil.copy2(packed, tmp_path)
+    with zipfile.ZipFile(tmp_path, 'a' if packed else 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
+        taken = set(zf.namelist())
+        renamed = []
+        for name in names:
+            member = unique_archive_name(name, taken)
+            taken.add(member)
+            # Already compressed files (.gz copies of direct staging) are stored as they are
+            zf.write(os.path.join(shard, name), member,
+                     compress_type=zipfile.ZIP_STORED if name.endswith('.gz') else zipfile.ZIP_DEFLATED)
+            if member != name:
+                renamed.append((name, member))
+    os.replace(tmp_path, zip_path)
+
+    index = get_archive_index()
+    location = os.path.relpath(shard, folder)
+    if renamed:
+        index.rename_members(folder, location, renamed)
+    index.move_day(folder, day, location, location + ".zip")
+    shutil.rmtree(shard)
+    return len(names)
+
+def delete_archive_day(folder, day, shard, packed):
+    if shard:
+        shutil.rmtree(shard, ignore_errors=True)
+    if packed:
+        os.remove(packed)
+    get_archive_index().drop_day(folder, day)
+    logging.info(f"Archive day {day} of {folder} deleted (retention).")
+    # Drop month / year folders left empty
+    for parent in (os.path.dirname(shard or packed), os.path.dirname(os.path.dirname(shard or packed))):
+        try:
+            os.rmdir(parent)
+        except OSError:
+            break
+
+# Function to archive Done_Folder and the Backup_Folder of every source
+def run_archive(sources=None):
+    try:
+        options = dict(after_hours=settings["Archive_After_Hours"], retention_days=settings["Archive_Retention_Days"],
+                       max_mb=settings["Archive_Max_MB"])
+        archive_folder(folders["Done_Folder"], extensions=('.json',), keep=(SERIAL_INDEX_EXPORT_NAME,), **options)
+        for source in sources or [resolve_source(None)]:
+            archive_folder(source.folders["Backup_Folder"], **options)
+    except Exception as e:
+        logging.error(f"Error during archiving: {e}")
+        print(f"Error during archiving: {e}")
+
+archive_thread = None
+
+# Function to start an archive run in the background, skipped while the previous one is still running
+def start_archive_thread(sources=None):
+    global archive_thread
+    if archive_thread is not None and archive_thread.is_alive():
+        return
+    archive_thread = threading.Thread(target=run_archive, args=(sources,), name="LM-archive", daemon=True)
+    archive_thread.start()
+
+# Function to pull one archived file (by its original name) back out of Backup_Folder or Done_Folder - only its own
+# zip member is read. Returns the restored path, or None when the name is not in the archive index
+def restore_archived_file(name, dest_folder, folder=None):
+    matches = get_archive_index().find(name, folder)
+    if not matches:
+        return None
+    folder, day, location, member = matches[0]
+    os.makedirs(dest_folder, exist_ok=True)
+    dest_path = os.path.join(dest_folder, name)
+    if location.endswith('.zip'):
+        with zipfile.ZipFile(os.path.join(folder, location)) as zf:
+            info = zf.getinfo(member)
+            with zf.open(info) as src, open(dest_path, 'wb') as dest:
+                shutil.copyfileobj(src, dest)
+        mtime = datetime(*info.date_time).timestamp()
+        os.utime(dest_path, (mtime, mtime))
+    else:
+        shutil.copy2(os.path.join(folder, location, member), dest_path)
+    logging.info(f"Restored {name} from {os.path.join(folder, location)} to {dest_folder}")
+    return dest_path
+
+#----------------------------------------------------------------------------Sources----!
+
+# Multi-source operation - one process serves several laser marking machines. Every source has its own machine
+# folder and staging state (Scan_Folder, JSON_Data_Folder, Backup_Folder, Copy/Parser/Backup logs, ingestion manifest).
+# ERP client, circuit breaker, parent name cache, outbox, Done_Folder and upload batching are shared by all sources.
+PRIMARY_SOURCE_NAME = "LM"
+STAGING_FOLDERS = ("Scan_Folder", "JSON_Data_Folder", "Backup_Folder")
+
+class Source:
+    def __init__(self, name, machine_data_folder, staging_folder=None):
+        self.name = name
+        self.machine_data_folder = machine_data_folder
+        self.staging_folder = staging_folder
+        self.manifest = None
+        self.pairing = None
+        self.worker = None  # Thread of the running sequential task_workflow
+        if staging_folder is None:
+            # Primary source (top level Machine_Data_Folder) keeps the top level folders, single machine setups are unchanged
+            self.folders = folders
+            self.log_folders = log_folders
+            self.lock = workflow_lock
+        else:
+            self.folders = {key: os.path.join(staging_folder, key) for key in STAGING_FOLDERS}
+            self.log_folders = {key: os.path.join(staging_folder, "Logs", key) for key in log_folders}
+            self.lock = threading.RLock()
+
+    def create_folders(self):
+        for folder in list(self.folders.values()) + list(self.log_folders.values()):
+            os.makedirs(folder, exist_ok=True)
+
+    def get_manifest(self):
+        if self.staging_folder is None:
+            return get_ingest_manifest()
+        with self.lock:
+            if self.manifest is None:
+                self.manifest = IngestManifest(os.path.join(self.staging_folder, "ingest_manifest.db"))
+        return self.manifest
+
+    # None while Pairing_Buffer_Enabled is off
+    def get_pairing_buffer(self):
+        if not settings["Pairing_Buffer_Enabled"]:
+            return None
+        if self.staging_folder is None:
+            return get_pairing_buffer()
+        with self.lock:
+            if self.pairing is None:
+                self.pairing = get_pairing_buffer(os.path.join(self.staging_folder, "pairing_buffer.json"))
+        return self.pairing
+
+    # New JSON file path - extra sources prefix their name, so files of several lines never collide in Done_Folder
+    def new_json_file(self, timestamp_format='%Y-%m-%d_%H_%M_%S_%f'):
+        extension = "jsonl" if settings["Output_Format"] == "jsonl" else "json"
+        prefix = "" if self.staging_folder is None else f"{self.name}_"
+        return os.path.join(self.folders["JSON_Data_Folder"], f"{prefix}data_{datetime.now().strftime(timestamp_format)}.{extension}")
+
+    def log_file(self, log_type, date_str=None):
+        date_str = date_str or datetime.now().strftime('%Y-%m-%d')
+        return os.path.join(self.log_folders[log_type], f"{log_type.lower()}_{date_str}.log")
+
+    # Where a staged file is parsed from - Scan_Folder, or the machine folder itself in direct staging
+    def staged_path(self, file_name):
+        if settings["Staging_Mode"] == "direct":
+            return os.path.join(self.machine_data_folder, file_name)
+        return os.path.join(self.folders["Scan_Folder"], file_name)
+
+    def stage_new_files(self, file_names=None, date_str=None):
+        return copy_new_files(self.machine_data_folder, self.folders["Scan_Folder"], self.log_file("Copy_Logs", date_str),
+                              manifest=self.get_manifest(), file_names=file_names)
+
+    # Backup of parsed files - moved out of Scan_Folder, or archived as .gz in direct staging.
+    # Without file names every file in Scan_Folder is moved
+    def backup_staged_files(self, file_names=None, date_str=None):
+        backup_log_file = self.log_file("Backup_Logs", date_str)
+        if settings["Staging_Mode"] == "direct":
+            archive_machine_files(self.machine_data_folder, self.folders["Backup_Folder"], backup_log_file,
+                                  file_names or [], manifest=self.get_manifest())
+        else:
+            move_files_to_backup(self.folders["Scan_Folder"], self.folders["Backup_Folder"], backup_log_file, file_names=file_names)
+
+
+active_sources = []
+
+# Function to build the source list - the top level Machine_Data_Folder first, then every valid "Sources" entry of the config
+def load_sources(config, machine_data_folder):
+    sources = [Source(PRIMARY_SOURCE_NAME, machine_data_folder)]
+    names = {PRIMARY_SOURCE_NAME}
+    for entry in (config or {}).get("Sources", []):
+        name = str(entry.get("Name", "")).strip()
+        source_folder = entry.get("Machine_Data_Folder")
+        if not name or os.path.basename(name) != name or name in names or not source_folder:
+            logging.error(f"Invalid or duplicate source ignored: {entry}")
+            print(f"Invalid or duplicate source ignored: {entry}")
+            continue
+        names.add(name)
+        source = Source(name, source_folder, entry.get("Staging_Folder") or os.path.join(folders["Sources_Folder"], name))
+        try:
+            source.create_folders()
+        except Exception as e:
+            logging.error(f"Error creating folders of source {name}: {e}")
+            print(f"Error creating folders of source {name}: {e}")
+            continue
+        sources.append(source)
+    logging.info(f"Sources: {', '.join(f'{source.name} ({source.machine_data_folder})' for source in sources)}")
+    return sources
+
+# Helper function to get the source to work on - None stands for the primary source
+def resolve_source(source, machine_data_folder=None):
+    if source is not None:
+        return source
+    for known in active_sources:
+        if known.staging_folder is None and machine_data_folder in (None, known.machine_data_folder):
+            return known
+    return Source(PRIMARY_SOURCE_NAME, machine_data_folder)
+
+# Function to run task_workflow of every source on its own worker thread. A source still busy with the
+# previous tick is skipped, so a slow line never delays the others.
+def run_sources_workflow(api_key, api_secret, erp_url, sources):
+    for source in sources:
+        if source.worker is not None and source.worker.is_alive():
+            logging.warning(f"Source {source.name} still busy with the previous cycle, tick skipped.")
+            continue
+        source.worker = threading.Thread(target=task_workflow, name=f"LM-worker-{source.name}",
+                                         args=(api_key, api_secret, erp_url, source.machine_data_folder, source))
+        source.worker.daemon = True
+        source.worker.start()
+
+
 # Main task workflow with user-specified schedule frequency - CGC-2 - cmd_12.py additions for existing json file handling
-def task_workflow(api_key, api_secret, erp_url, machine_data_folder):
-    # 1. Process pending JSON files from JSON_Data_Folder first
-    process_pending_json_files(api_key, api_secret, erp_url)
-
-    # 2. mvf.py: Copy new files from machine_data_folder to Scan_Folder
-    copy_log_file = get_log_file_path("Copy_Logs", datetime.now().strftime('%Y-%m-%d'))
-    copy_new_files(machine_data_folder, folders["Scan_Folder"], copy_log_file)
-
-    # 3. psr.py: Parse CSV files to JSON in Scan_Folder
-    log_file = get_log_file_path("Parser_Logs", datetime.now().strftime('%Y-%m-%d'))
-    json_file = os.path.join(folders["JSON_Data_Folder"], f"data_{datetime.now().strftime('%Y-%m-%d_%H_%M')}.json")
-    csv_files = [file for file in os.listdir(folders["Scan_Folder"]) if file.endswith('.csv')]
+def task_workflow(api_key, api_secret, erp_url, machine_data_folder, source=None):
+    source = resolve_source(source, machine_data_folder)
+    # Runs as the reconciliation sweep in watch mode, so the event driven ingest and the sweep never overlap
+    with source.lock:
+        # 1. Process pending JSON files from JSON_Data_Folder first
+        process_pending_json_files(api_key, api_secret, erp_url, source)
+
+        # 2. mvf.py: Copy new files from machine_data_folder to Scan_Folder
+        copied = source.stage_new_files()
+        direct = settings["Staging_Mode"] == "direct"
+
+        # 3. psr.py: Parse CSV files to JSON in Scan_Folder
+        log_file = source.log_file("Parser_Logs")
+        json_file = source.new_json_file('%Y-%m-%d_%H_%M')
+        if direct:
+            csv_files = [file for file in copied if file.endswith('.csv')]
+        else:
+            csv_files = list_folder_files(source.folders["Scan_Folder"], '.csv')
     
-    for csv_file in csv_files:
-        parse_csv_to_json(os.path.join(folders["Scan_Folder"], csv_file), json_file, log_file)
-        logging.info(f"JSON file created {json_file}")
+        for csv_file in csv_files:
+            parse_csv_to_json(source.staged_path(csv_file), json_file, log_file, source)
+            logging.info(f"JSON file created {json_file}")
+        flush_pairing_buffer(json_file, source)
 
-    # 4. Process the newly created JSON file
-    process_json_file(json_file, api_key, api_secret, erp_url)
+        # 4. Process the newly created JSON file
+        process_json_file(json_file, api_key, api_secret, erp_url)
 
-    # 5. Backup: Move files to Backup_Folder
-    backup_log_file = get_log_file_path("Backup_Logs", datetime.now().strftime('%Y-%m-%d'))
-    move_files_to_backup(folders["Scan_Folder"], folders["Backup_Folder"], backup_log_file)
+        # 5. Backup: Move files to Backup_Folder
+        source.backup_staged_files(copied if direct else None)
+
+        # 6. Publish the serial_no index and the rolling export bundles for SPI, PAOI & AOI
+        get_serial_index().export(force=True)
+        refresh_export_bundles()
 
 
 # Process pending JSON files first before new ones
-def process_pending_json_files(api_key, api_secret, erp_url):
-    pending_json_files = [file for file in os.listdir(folders["JSON_Data_Folder"]) if file.endswith('.json')]
-    for json_file in sorted(pending_json_files):  # Ensuring oldest files are processed first
-        process_json_file(os.path.join(folders["JSON_Data_Folder"], json_file), api_key, api_secret, erp_url)
+def process_pending_json_files(api_key, api_secret, erp_url, source=None):
+    json_folder = resolve_source(source).folders["JSON_Data_Folder"]
+    get_outbox().purge(settings["Outbox_Retention_Days"])
+
+    if get_erp_breaker().is_open():
+        logging.warning("ERP circuit breaker open, pending JSON files left for the next cycle.")
+        print("ERP unreachable, pending JSON files left for the next cycle.")
+        return
+    pending_json_files = list_folder_files(json_folder, ('.json', '.jsonl'))
+    for json_file in pending_json_files:  # Sorted, ensuring oldest files are processed first
+        process_json_file(os.path.join(json_folder, json_file), api_key, api_secret, erp_url)
 
 # Process each JSON file by loading its content, sending data to ERP, and moving it to Done folder
 def process_json_file(json_file, api_key, api_secret, erp_url):
-    existing_data, last_pd_no = load_existing_json_2(json_file)
-    
-    # Debugging: Print the type and contents of existing_data to verify its format
-    # print("Type of existing_data:", type(existing_data))
-    # print("Contents of existing_data:", existing_data)
-
-    if existing_data:  # Only proceed if data exists
-        all_successful = True
+    return process_json_files([json_file], api_key, api_secret, erp_url)[json_file]
+
+# Process several JSON files as one upload batch - rows of different files (and sources) feeding the same
+# work order go out in the same grouped update. Returns {json_file: moved to Done_Folder}
+def process_json_files(json_files, api_key, api_secret, erp_url):
+    results = {json_file: False for json_file in json_files}
+    if get_erp_breaker().is_open():
+        logging.warning(f"ERP circuit breaker open, {', '.join(json_files)} left pending.")
+        return results
+
+    store = get_outbox()
+    file_records = {}
+    due = []  # (json_file, outbox key, record)
+    for json_file in json_files:
+        existing_data, last_pd_no = load_existing_json_2(json_file)
+        if not existing_data:  # Only proceed if data exists
+            console("No data found to process in the JSON file.")
+            continue
 
         # Adjust iteration based on the format of existing_data
         if isinstance(existing_data, dict) and "laser_marking" in existing_data:
             # When existing_data is a dictionary with a laser_marking key
-            for record in existing_data["laser_marking"]:
-                success = send_to_erpnext([record], api_key, api_secret, erp_url)
-                if not success:
-                    all_successful = False
-                    break
-        elif isinstance(existing_data, list):
+            records = existing_data["laser_marking"]
+        else:
             # If it's a list, directly process all records
-            success = send_to_erpnext(existing_data, api_key, api_secret, erp_url)
-            if not success:
-                all_successful = False
+            records = existing_data
+        file_records[json_file] = records
+
+        # Outbox - only rows not yet delivered and past their backoff are sent
+        store.enqueue(json_file, records)
+        due.extend((json_file, key, record) for key, record in store.due(json_file))
+
+    if due:
+        # Batch upload - one grouped update per work order, results reported per record. No sleeping retries,
+        # a failed row waits in the outbox for its backoff to expire.
+        _, record_results = send_to_erpnext_batched([record for _, _, record in due], api_key, api_secret, erp_url, retries=1)
+        # Rows held back behind a failed chunk (None) were never sent - they stay pending without using up an attempt
+        delivered = [key for (_, key, _), ok in zip(due, record_results) if ok]
+        failed = [(json_file, key) for (json_file, key, _), ok in zip(due, record_results) if ok is False]
+        metrics.inc("lm_records_uploaded_total", len(delivered))
+        metrics.inc("lm_records_failed_total", len(failed))
+        if delivered:
+            store.mark_delivered(delivered)
+        if failed:
+            store.mark_failed([key for _, key in failed], "upload failed")
+        not_uploaded = defaultdict(int)
+        due_count = defaultdict(int)
+        for (json_file, _, _), ok in zip(due, record_results):
+            due_count[json_file] += 1
+            if not ok:
+                not_uploaded[json_file] += 1
+        for json_file, count in not_uploaded.items():
+            logging.error(f"{count}/{due_count[json_file]} record(s) of {json_file} were not uploaded, retried after backoff.")
+            print(f"{count}/{due_count[json_file]} record(s) of {json_file} were not uploaded.")
+
+    # Done_Folder copy is derived from the outbox - moved once no row of the file is pending
+    for json_file, records in file_records.items():
+        results[json_file] = store.pending_count(json_file) == 0
+        if results[json_file]:
+            move_to_done_folder(json_file, records)
+
+    return results
+
+
+#----------------------------------------------------------------------------Watcher----!
+
+# Event driven ingest - machine files are pushed through copy, parse, upload and backup seconds after
+# the laser marker finishes writing them. The scheduled task_workflow stays as a reconciliation sweep.
+workflow_lock = threading.RLock()
+
+# inotify constants (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len - followed by the NUL padded name
+
+# Linux inotify watcher through ctypes, no extra module needed.
+# poll() returns the names touched since the last call, None after a queue overflow (caller rescans).
+class InotifyWatcher:
+    def __init__(self, folder):
+        self.folder = folder
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_MODIFY
+        if self.libc.inotify_add_watch(self.fd, os.fsencode(folder), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f"inotify_add_watch failed for {folder}")
+
+    def poll(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        names = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                if name and not mask & IN_ISDIR:
+                    names.add(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+# Fallback watcher for Windows or when inotify is not available - compares size/mtime between scans
+class PollingWatcher:
+    def __init__(self, folder, interval=2):
+        self.folder = folder
+        self.interval = interval
+        self.scanner = FolderScanner(folder, full_interval=settings["Scan_Full_Interval"],
+                                     hot_seconds=settings["Scan_Hot_Seconds"])
+        self.snapshot = {}
+        self.scan()  # Files already present are left to the reconciliation sweep
+
+    # Names whose (size, mtime) changed since they were last seen
+    def scan(self):
+        last_full = self.scanner.last_full
+        names = set()
+        for name, _, stat in self.scanner.scan(full=not settings["Incremental_Scan"]):
+            fingerprint = (stat.st_size, stat.st_mtime_ns)
+            if self.snapshot.get(name) != fingerprint:
+                self.snapshot[name] = fingerprint
+                names.add(name)
+        if self.scanner.last_full != last_full:  # Full scan - drop files no longer in the folder
+            for name in self.snapshot.keys() - self.scanner.known.keys() - self.scanner.hot:
+                del self.snapshot[name]
+        return names
+
+    def poll(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        return self.scan()
+
+    def close(self):
+        pass
+
+# Helper function to pick the watcher - "auto" uses inotify where available and falls back to polling
+def create_watcher(folder):
+    kind = settings["Watcher"]
+    if kind in ("auto", "inotify") and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(folder)
+        except (OSError, AttributeError) as e:
+            if kind == "inotify":
+                raise
+            logging.warning(f"inotify not available ({e}), using polling watcher.")
+    return PollingWatcher(folder, interval=settings["Watch_Poll_Interval"])
+
+# Debounce - a file is ready once its size and mtime have not changed for settle_seconds
+class FileSettler:
+    def __init__(self, folder, settle_seconds=2):
+        self.folder = folder
+        self.settle_seconds = settle_seconds
+        self.candidates = {}  # name -> (size, mtime_ns, stable_since)
+
+    def touch(self, names):
+        for name in names:
+            self.candidates.setdefault(name, (None, None, time.monotonic()))
+
+    def ready(self):
+        now = time.monotonic()
+        ready = []
+        for name, (size, mtime_ns, stable_since) in list(self.candidates.items()):
+            try:
+                stat = os.stat(os.path.join(self.folder, name))
+            except FileNotFoundError:
+                del self.candidates[name]
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                self.candidates[name] = (stat.st_size, stat.st_mtime_ns, now)
+            elif now - stable_since >= self.settle_seconds:
+                ready.append(name)
+                del self.candidates[name]
+        return ready
+
+    def pending(self):
+        return len(self.candidates)
+
+# Function to push settled machine files straight through copy, parse, upload and backup
+def ingest_ready_files(file_names, api_key, api_secret, erp_url, machine_data_folder, source=None):
+    source = resolve_source(source, machine_data_folder)
+    with source.lock:
+        date_str = datetime.now().strftime('%Y-%m-%d')
+        copied = source.stage_new_files(file_names, date_str)
+        if not copied:
+            return
+
+        json_file = source.new_json_file()
+        log_file = source.log_file("Parser_Logs", date_str)
+        for file_name in copied:
+            if file_name.endswith('.csv'):
+                parse_csv_to_json(source.staged_path(file_name), json_file, log_file, source)
+        flush_pairing_buffer(json_file, source)
+
+        process_json_file(json_file, api_key, api_secret, erp_url)
+
+        source.backup_staged_files(copied, date_str)
+
+# Watch loop run in its own thread until stop_event is set
+def watch_machine_folder(api_key, api_secret, erp_url, machine_data_folder, stop_event, source=None):
+    source = resolve_source(source, machine_data_folder)
+    machine_data_folder = source.machine_data_folder
+    watcher = create_watcher(machine_data_folder)
+    settler = FileSettler(machine_data_folder, settle_seconds=settings["Settle_Seconds"])
+    logging.info(f"Watching {machine_data_folder} with {type(watcher).__name__}.")
+    try:
+        while not stop_event.is_set():
+            names = watcher.poll(0.5 if settler.pending() else 1)
+            if names is None:
+                # Event queue overflowed - every file becomes a candidate, the manifest skips known ones
+                names = set(os.listdir(machine_data_folder))
+            settler.touch(names)
+            ready = settler.ready()
+            if ready:
+                try:
+                    if active_pipeline is not None:
+                        active_pipeline.submit(ready, source)
+                    else:
+                        ingest_ready_files(ready, api_key, api_secret, erp_url, machine_data_folder, source)
+                except Exception as e:
+                    logging.error(f"Error during event driven ingest: {e}")
+                    print(f"Error during event driven ingest: {e}")
+    finally:
+        watcher.close()
+
+# Function to create and start the watcher thread
+def start_watch_thread(api_key, api_secret, erp_url, machine_data_folder, stop_event, source=None):
+    watch_thread = threading.Thread(target=watch_machine_folder,
+                                    args=(api_key, api_secret, erp_url, machine_data_folder, stop_event, source))
+    watch_thread.daemon = True
+    watch_thread.start()
+    return watch_thread
+
+
+#---------------------------------------------------------------------------Pipeline----!
+
+# Decoupled workflow - collector (copy), parser and uploader workers connected by bounded queues.
+# Copy and parse never wait on ERP: when the upload queue is full the JSON file simply stays in
+# JSON_Data_Folder and the next sweep hands it over again.
+# Every source gets its own collector and parser, the upload queue and uploaders are shared so JSON files
+# of different lines are merged into one upload batch (up to Upload_Batch_Files files).
+class Pipeline:
+    STOP = object()  # Queue sentinel
+
+    def __init__(self, api_key, api_secret, erp_url, sources, queue_size=1000, upload_workers=1,
+                 parse_batch_size=200, upload_batch_files=20):
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.erp_url = erp_url
+        self.sources = list(sources)
+        self.parse_batch_size = parse_batch_size
+        self.upload_workers = upload_workers
+        self.upload_batch_files = max(1, upload_batch_files)
+
+        self.collect_queues = {source.name: queue.Queue(maxsize=queue_size) for source in self.sources}  # Machine file names
+        self.parse_queues = {source.name: queue.Queue(maxsize=queue_size) for source in self.sources}  # Names staged in Scan_Folder
+        self.upload_queue = queue.Queue(maxsize=queue_size)  # JSON file paths in the JSON_Data_Folder of any source
+
+        # Items sitting in a queue or being worked on, so a sweep never hands the same item over twice
+        self.lock = threading.Lock()
+        self.parse_pending = set()  # (source name, file name)
+        self.upload_pending = set()
+        self.parsers_running = len(self.sources)
+
+        self.counters = defaultdict(int)
+        self.threads = []
+        self.stopping = False
+
+    def start(self):
+        for source in self.sources:
+            self.threads.append(threading.Thread(target=self.collector, args=(source,), name=f"LM-collector-{source.name}", daemon=True))
+            self.threads.append(threading.Thread(target=self.parser, args=(source,), name=f"LM-parser-{source.name}", daemon=True))
+        for index in range(self.upload_workers):
+            self.threads.append(threading.Thread(target=self.uploader, name=f"LM-uploader-{index + 1}", daemon=True))
+        for thread in self.threads:
+            thread.start()
+        logging.info(f"Pipeline started for {len(self.sources)} source(s) with {self.upload_workers} upload worker(s).")
+        return self
+
+    # Entry point for the watcher - blocks while the collector is behind (backpressure)
+    def submit(self, file_names, source=None):
+        source = source or self.sources[0]
+        if file_names and not self.stopping:
+            self.collect_queues[source.name].put(list(file_names))
+
+    # Reconciliation sweep run by the schedule - hands over whatever is waiting in the folders
+    def reconcile(self):
+        if self.stopping:
+            return
+        get_outbox().purge(settings["Outbox_Retention_Days"])
+        for source in self.sources:
+            try:
+                self.collect_queues[source.name].put_nowait(None)  # None - collector scans the whole machine folder
+            except queue.Full:
+                pass
+
+            with self.lock:
+                staged = [name for name in list_folder_files(source.folders["Scan_Folder"])
+                          if (source.name, name) not in self.parse_pending] if settings["Staging_Mode"] != "direct" else []
+            if staged:
+                self.queue_for_parsing(source, staged, block=False)
+
+            # Marks whose other side never came are released even while the machine is idle
+            pairing = source.get_pairing_buffer()
+            if pairing is not None and len(pairing):
+                flush_pairing_buffer(source.new_json_file(), source)
+
+            for name in list_folder_files(source.folders["JSON_Data_Folder"], ('.json', '.jsonl')):
+                self.queue_for_upload(os.path.join(source.folders["JSON_Data_Folder"], name))
+
+        get_serial_index().export(force=True)
+        refresh_export_bundles()
+        logging.info(f"Pipeline status: {self.stats()}")
+
+    def queue_for_parsing(self, source, file_names, block=True):
+        with self.lock:
+            file_names = [name for name in file_names if (source.name, name) not in self.parse_pending]
+            self.parse_pending.update((source.name, name) for name in file_names)
+        try:
+            self.parse_queues[source.name].put(file_names, block=block)
+        except queue.Full:
+            with self.lock:
+                self.parse_pending.difference_update((source.name, name) for name in file_names)  # Left in Scan_Folder for the next sweep
+
+    def queue_for_upload(self, json_file):
+        with self.lock:
+            if json_file in self.upload_pending:
+                return
+            self.upload_pending.add(json_file)
+        try:
+            self.upload_queue.put_nowait(json_file)
+        except queue.Full:
+            with self.lock:
+                self.upload_pending.discard(json_file)  # Stays pending in JSON_Data_Folder
+            self.counters["upload_queue_full"] += 1
+
+    def collector(self, source):
+        collect_queue = self.collect_queues[source.name]
+        while True:
+            item = collect_queue.get()
+            if item is self.STOP:
+                self.parse_queues[source.name].put(self.STOP)
+                return
+            try:
+                copied = source.stage_new_files(item)
+                self.counters["collected"] += len(copied)
+                if copied:
+                    self.queue_for_parsing(source, copied)
+            except Exception as e:
+                logging.error(f"Collector error ({source.name}): {e}")
+
+    def parser(self, source):
+        parse_queue = self.parse_queues[source.name]
+        while True:
+            item = parse_queue.get()
+            if item is self.STOP:
+                # The last parser to stop passes the sentinel on to the shared uploaders
+                with self.lock:
+                    self.parsers_running -= 1
+                    last = self.parsers_running == 0
+                if last:
+                    for _ in range(self.upload_workers):
+                        self.upload_queue.put(self.STOP)
+                return
+
+            # Take whatever else is already waiting, up to one parse batch
+            file_names = list(item)
+            stop_after = False
+            while len(file_names) < self.parse_batch_size:
+                try:
+                    more = parse_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if more is self.STOP:
+                    stop_after = True
+                    break
+                file_names.extend(more)
 
-        # If processing was successful, move the file to the 'Done' folder
-        if all_successful:
-            move_to_done_folder(json_file)
-            # print("moved to done!")
+            try:
+                self.parse_batch(source, file_names)
+            except Exception as e:
+                logging.error(f"Parser error ({source.name}): {e}")
+            finally:
+                with self.lock:
+                    self.parse_pending.difference_update((source.name, name) for name in file_names)
+
+            if stop_after:
+                parse_queue.put(self.STOP)
+
+    def parse_batch(self, source, file_names):
+        date_str = datetime.now().strftime('%Y-%m-%d')
+        json_file = source.new_json_file()
+        with self.lock:
+            self.upload_pending.add(json_file)  # A sweep must not pick up the file while it is written
+
+        log_file = source.log_file("Parser_Logs", date_str)
+        for file_name in file_names:
+            if file_name.endswith('.csv'):
+                parse_csv_to_json(source.staged_path(file_name), json_file, log_file, source)
+        flush_pairing_buffer(json_file, source)
+        source.backup_staged_files(file_names, date_str)
+        self.counters["parsed"] += len(file_names)
+
+        with self.lock:
+            self.upload_pending.discard(json_file)
+        if os.path.exists(json_file):
+            self.queue_for_upload(json_file)
+
+    def uploader(self):
+        while True:
+            json_file = self.upload_queue.get()
+            if json_file is self.STOP:
+                return
+
+            # Merge whatever else is already waiting into the same upload batch
+            json_files = [json_file]
+            stop_after = False
+            while len(json_files) < self.upload_batch_files:
+                try:
+                    more = self.upload_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if more is self.STOP:
+                    stop_after = True
+                    break
+                json_files.append(more)
 
-        return all_successful
-    else:
-        print("No data found to process in the JSON file.")
-        return False
+            try:
+                existing = [json_file for json_file in json_files if os.path.exists(json_file)]
+                if existing:
+                    results = process_json_files(existing, self.api_key, self.api_secret, self.erp_url)
+                    self.counters["uploaded_files"] += sum(results.values())
+                    self.counters["upload_batches"] += 1
+            except Exception as e:
+                logging.error(f"Uploader error for {', '.join(json_files)}: {e}")
+            finally:
+                with self.lock:
+                    self.upload_pending.difference_update(json_files)
+
+            if stop_after:
+                return
+
+    def stats(self):
+        return {
+            "collect_queue": sum(collect_queue.qsize() for collect_queue in self.collect_queues.values()),
+            "parse_queue": sum(parse_queue.qsize() for parse_queue in self.parse_queues.values()),
+            "upload_queue": self.upload_queue.qsize(),
+            **self.counters
+        }
 
+    # Graceful drain - every stage finishes what is already queued, then passes the STOP sentinel on
+    def stop(self, timeout=60):
+        if self.stopping:
+            return
+        self.stopping = True
+        logging.info(f"Pipeline draining: {self.stats()}")
+        for collect_queue in self.collect_queues.values():
+            collect_queue.put(self.STOP)
+        deadline = time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        logging.info(f"Pipeline stopped: {self.stats()}")
+
+
+active_pipeline = None
+
+# Function to create and start the shared pipeline from settings
+def start_pipeline(api_key, api_secret, erp_url, sources):
+    global active_pipeline
+    active_pipeline = Pipeline(
+        api_key, api_secret, erp_url, sources,
+        queue_size=settings["Queue_Size"],
+        upload_workers=settings["Upload_Workers"],
+        parse_batch_size=settings["Parse_Batch_Size"],
+        upload_batch_files=settings["Upload_Batch_Files"]
+    ).start()
+    return active_pipeline
 
-# Helper function to get log file path for different operations
-def get_log_file_path(log_type, date_str):
-    return os.path.join(log_folders[log_type], f"{log_type.lower()}_{date_str}.log")
 
 # Helper function to log parsed CSVs
 def log_parsed_file(log_file, csv_file):
-    with open(log_file, 'a') as log:
-        # log.write(f"Parsed {csv_file} at {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-        log.write(f"Parsed {csv_file} at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+    # log.write(f"Parsed {csv_file} at {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+    write_audit_line(log_file, f"Parsed {csv_file} at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
 
 # Helper function to load existing JSON data - Parser
 def load_existing_json(json_file):
@@ -506,11 +3772,14 @@ def load_existing_json(json_file):
 # Helper function to load existing JSON data - API
 def load_existing_json_2(json_file):
     if os.path.exists(json_file):
-        with open(json_file, 'r') as f:
-            data = json.load(f)
-        
-        # Access the 'laser_marking' list from the loaded data
-        laser_marking_data = data.get('laser_marking', [])
+        if json_file.endswith('.jsonl'):
+            laser_marking_data = read_jsonl_records(json_file)
+        else:
+            with open(json_file, 'r') as f:
+                data = json.load(f)
+
+            # Access the 'laser_marking' list from the loaded data
+            laser_marking_data = data.get('laser_marking', [])
         
         if laser_marking_data:
             last_pd_no = laser_marking_data[-1]['pd_no']
@@ -567,15 +3836,17 @@ def reset_config_file():
         print("Incorrect password. Returning to normal operation...")
         logging.info("RESET Unsuccessfull. Incorrect Password.")
 
+# Set by STOP, the control file or a termination signal - the main loop then shuts down gracefully
+stop_requested = threading.Event()
+
 # Function to check for 'STOP' or 'RESET' input in a separate thread
 def control_program():
     while True:
         user_input = input("Program Started Successfully... \nType 'STOP' to exit or 'RESET' to reset configuration: ").strip().upper()
 
         if user_input == 'STOP':
-            print("Stopping program...")
-            logging.info("Program Stopped.")
-            os._exit(0)
+            stop_requested.set()
+            return
 
         elif user_input == 'RESET':
             print("Resetting configuration...")
@@ -588,44 +3859,176 @@ def start_control_thread():
     control_thread.daemon = True  # Daemon thread will not block program exit
     control_thread.start()
 
+# Function to stop on SIGTERM / SIGINT (systemd, Task Scheduler "End", Ctrl+C) and SIGBREAK (Windows console close)
+def install_signal_handlers():
+    def handle_signal(signum, frame):
+        logging.info(f"Signal {signum} received.")
+        stop_requested.set()
+    for name in ("SIGTERM", "SIGINT", "SIGBREAK"):
+        signum = getattr(signal, name, None)
+        if signum is not None:
+            signal.signal(signum, handle_signal)
+
+# Function to read and consume the command written to the control file (STOP, SWEEP or STATUS)
+def read_control_command(control_file):
+    try:
+        with open(control_file, 'r') as f:
+            command = f.read().strip().upper()
+        os.remove(control_file)
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        logging.error(f"Failed to read control file {control_file}: {e}")
+        return None
+    logging.info(f"Control command received: {command}")
+    return command
+
+# Function to write the current state for the STATUS command
+def write_status(status_file, sources):
+    write_json_atomic(status_file, {
+        "time": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        "workflow_mode": settings["Workflow_Mode"],
+        "ingest_mode": settings["Ingest_Mode"],
+        "erp_breaker": get_erp_breaker().state,
+        "pipeline": active_pipeline.stats() if active_pipeline is not None else None,
+        "sources": {source.name: {
+            "pending_json_files": count_files(source.folders["JSON_Data_Folder"], ('.json', '.jsonl')),
+            "scan_folder_files": count_files(source.folders["Scan_Folder"]),
+            "busy": source.worker is not None and source.worker.is_alive()
+        } for source in sources}
+    })
+
+# Function to stop gracefully - drain the pipeline queues, wait for running workflows and uploads, flush state and logs
+def shutdown_program(reason):
+    print(f"Stopping program ({reason})...")
+    logging.info(f"Stopping program: {reason}")
+    # Shutdown_Timeout is the budget for the whole shutdown, every step only gets what is left of it
+    deadline = time.monotonic() + settings["Shutdown_Timeout"]
+    if active_pipeline is not None:
+        print("Draining pipeline queues...")
+        active_pipeline.stop(timeout=max(0, deadline - time.monotonic()))
+    for source in active_sources:
+        if source.worker is not None and source.worker.is_alive():
+            source.worker.join(max(0, deadline - time.monotonic()))
+    if upload_executor is not None:
+        with upload_executor_lock:
+            pending = list(upload_futures)
+        _, not_done = concurrent.futures.wait(pending, timeout=max(0, deadline - time.monotonic()))
+        if not_done:
+            logging.warning(f"{len(not_done)} upload(s) still running after Shutdown_Timeout, left to the outbox.")
+        upload_executor.shutdown(wait=False, cancel_futures=True)
+    try:
+        get_parent_cache().save()
+    except Exception as e:
+        logging.error(f"Failed to save the parent name cache: {e}")
+    logging.info("Program Stopped.")
+    shutdown_logging()
+
+# Function to read the command line - headless runs take everything from config.json and these options
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="LM laser marking data collector and ERP uploader.")
+    parser.add_argument("--headless", action="store_true",
+                        help="No console prompts - for Task Scheduler / systemd. Needs an existing config.json")
+    parser.add_argument("--config", help="Path of config.json (default next to the program)")
+    parser.add_argument("--frequency", type=int, help="Scheduling frequency in minutes (default Schedule_Frequency)")
+    return parser.parse_args(argv)
+
 # Main execution logic
-def main():
-    logging.info("Program started by the user.")
+def main(argv=None):
+    args = parse_arguments(argv)
+    init_logging()
+    logging.info("Program started headless." if args.headless else "Program started by the user.")
     create_folders()
 
     # Load inputs from config file if it exists, otherwise prompt user
-    config = load_inputs_from_file()
+    config = load_inputs_from_file(args.config)
     if config:
         api_key = config["API_Key"]
         api_secret = config["API_Secret"]
         erp_url = config["ERP_URL"]
         machine_data_folder = config["Machine_Data_Folder"]
+        apply_settings(config)
+    elif args.headless:
+        logging.error("Headless start without a config file.")
+        print("No config.json found - run the program once interactively or pass --config.")
+        sys.exit(2)
     else:
         api_key, api_secret, erp_url, machine_data_folder = get_inputs()
         write_folder_paths_to_file(api_key, api_secret, erp_url, machine_data_folder)
+    setup_logging()
 
-    # Scheduling frequency as user input
-    schedule_freq = input("Enter the scheduling frequency in minutes: ")
-    try:
-        schedule_freq = int(schedule_freq)
-    except ValueError:
-        print("Invalid input. Setting default scheduling frequency to 10 minutes.")
-        schedule_freq = 10
-
-    # Schedule the task workflow at the user-defined interval
-    schedule.every(schedule_freq).minutes.do(task_workflow, api_key, api_secret, erp_url, machine_data_folder)
-
-    # Start a separate thread to monitor the STOP and RESET commands
-    start_control_thread()
+    # Scheduling frequency from the command line, from the config when headless, else as user input
+    if args.frequency:
+        schedule_freq = args.frequency
+    elif args.headless:
+        schedule_freq = settings["Schedule_Frequency"]
+    else:
+        schedule_freq = input("Enter the scheduling frequency in minutes: ")
+        try:
+            schedule_freq = int(schedule_freq)
+        except ValueError:
+            print("Invalid input. Setting default scheduling frequency to 10 minutes.")
+            schedule_freq = 10
+
+    # One worker per source - the top level Machine_Data_Folder plus the "Sources" list of the config
+    active_sources.extend(load_sources(config, machine_data_folder))
+
+    if settings["Metrics_Enabled"]:
+        start_metrics(settings["Metrics_Host"], settings["Metrics_Port"],
+                      snapshot_file=state_files["Metrics_Snapshot"],
+                      snapshot_interval=settings["Metrics_Snapshot_Interval"])
+
+    # Schedule the task workflow at the user-defined interval. In pipeline mode the stages run on their
+    # own threads and the schedule only triggers the reconciliation sweep.
+    if settings["Workflow_Mode"] == "pipeline":
+        pipeline = start_pipeline(api_key, api_secret, erp_url, active_sources)
+        sweep = schedule.every(schedule_freq).minutes.do(pipeline.reconcile)
+    else:
+        sweep = schedule.every(schedule_freq).minutes.do(run_sources_workflow, api_key, api_secret, erp_url, active_sources)
+
+    # Catch-up run - whatever waits in JSON_Data_Folder and Scan_Folder (and the machine folder) goes out right away
+    if settings["Catch_Up_On_Start"]:
+        logging.info("Catch-up run on start.")
+        sweep.run()
+
+    # Backup_Folder / Done_Folder archiving in the background
+    if settings["Archive_Enabled"]:
+        schedule.every(settings["Archive_Interval_Minutes"]).minutes.do(start_archive_thread, active_sources)
+
+    # Event driven ingest in watch mode, the schedule above then only runs the reconciliation sweep
+    stop_event = threading.Event()
+    if settings["Ingest_Mode"] == "watch":
+        for source in active_sources:
+            start_watch_thread(api_key, api_secret, erp_url, source.machine_data_folder, stop_event, source)
+
+    # STOP / RESET from the console, signals and the control file in State_Folder
+    install_signal_handlers()
+    if not args.headless:
+        start_control_thread()
+    control_file = state_files["Control_File"]
+    if os.path.exists(control_file):
+        os.remove(control_file)  # Left over from an earlier run
 
     # Keeps script running to execute the scheduled tasks. Catching ISR calls
+    reason = "signal or STOP"
     try:
-        while True:
+        while not stop_requested.is_set():
             schedule.run_pending()
-            time.sleep(1)
+            command = read_control_command(control_file)
+            if command == "STOP":
+                reason = "control file"
+                break
+            elif command == "SWEEP":
+                sweep.run()
+            elif command == "STATUS":
+                write_status(state_files["Status_File"], active_sources)
+            elif command:
+                logging.warning(f"Unknown control command ignored: {command}")
+            stop_requested.wait(1)
     except KeyboardInterrupt:
-        print("Program stopped by the user.")
-        logging.info("Program stopped by the user using Keyboard Interrupt.")
+        reason = "keyboard interrupt"
+    stop_event.set()
+    shutdown_program(reason)
 
 
 if __name__ == "__main__":
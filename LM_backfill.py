@@ -0,0 +1,335 @@
+import argparse
+import gzip
+import io
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import zipfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from LM_loader import load_lm_module
+
+# Bulk backfill / replay of archived laser marking CSVs into ERP, without the interactive program.
+# Streams the CSVs of Backup_Folder (or any folder) for a date range, pairs the marks with the program's own
+# parser, skips serial_nos ERP already holds and uploads the rest per work order - bulk child inserts, several
+# work orders in parallel, capped at --rps requests per second. Progress is checkpointed after every batch of
+# files, so an interrupted run resumes where it stopped.
+
+DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+
+# Function to parse a --from / --to value. A plain date given as --to covers that whole day.
+def parse_date(text, end=False):
+    for date_format in DATE_FORMATS:
+        try:
+            value = datetime.strptime(text, date_format)
+        except ValueError:
+            continue
+        if end and date_format == '%Y-%m-%d':
+            value += timedelta(days=1)
+        return value
+    raise argparse.ArgumentTypeError(f"Invalid date '{text}', expected YYYY-MM-DD or 'YYYY-MM-DD HH:MM:SS'")
+
+
+# Helper function to read the marking time of a record (top side first), None when missing or unreadable
+def record_time(record):
+    for key in ("top_time", "bottom_time"):
+        try:
+            return datetime.strptime(record.get(key, ""), '%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            continue
+    return None
+
+
+# Function to list the CSVs (and .csv.gz archive copies) of a folder tree, oldest first. CSVs packed into archive
+# day zips (<Folder>/YYYY/MM/DD.zip) are listed as (zip path, member) and read without unpacking.
+# Files last written before the range start cannot hold marks of the range, so they are skipped without being opened.
+def list_csv_files(folder, start=None):
+    files = []
+    for root, _, names in os.walk(folder):
+        for name in names:
+            path = os.path.join(root, name)
+            if name.lower().endswith('.zip'):
+                files.extend(list_zip_members(folder, path, start))
+                continue
+            if not name.lower().endswith(('.csv', '.csv.gz')):
+                continue
+            stat = os.stat(path)
+            if start is not None and stat.st_mtime < start.timestamp():
+                continue
+            files.append((stat.st_mtime, path, f"{os.path.relpath(path, folder)}|{stat.st_size}|{stat.st_mtime_ns}"))
+    files.sort(key=lambda item: (item[0], item[2]))
+    return [(path, key) for _, path, key in files]
+
+
+# Helper function of list_csv_files for one archive day zip, the member times are the original file times
+def list_zip_members(folder, zip_path, start=None):
+    if start is not None and os.stat(zip_path).st_mtime < start.timestamp():
+        return []  # Packed before the range start, so every member is older too
+    members = []
+    try:
+        with zipfile.ZipFile(zip_path) as zf:
+            for info in zf.infolist():
+                if info.is_dir() or not info.filename.lower().endswith(('.csv', '.csv.gz')):
+                    continue
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                if start is not None and mtime < start.timestamp() - 2:  # Zip times have a 2 second resolution
+                    continue
+                key = f"{os.path.relpath(zip_path, folder)}/{info.filename}|{info.file_size}|{info.CRC}"
+                members.append((mtime, (zip_path, info.filename), key))
+    except zipfile.BadZipFile as e:
+        print(f"Skipping unreadable archive {zip_path}: {e}")
+        logging.error(f"Backfill: unreadable archive {zip_path}: {e}")
+    return members
+
+
+# Function to parse one listed CSV - a plain / .gz file or a (zip path, member) pair of an archive day zip
+def read_csv_source(lm, source, pairing=None):
+    if isinstance(source, str):
+        return lm.read_csv_records(source, pairing=pairing)
+    zip_path, member = source
+    with zipfile.ZipFile(zip_path) as zf, zf.open(member) as raw:
+        stream = gzip.GzipFile(fileobj=raw) if member.lower().endswith('.gz') else raw
+        with io.TextIOWrapper(stream) as file:
+            return lm.read_csv_stream(file, pairing=pairing)
+
+
+# Resumable progress - the files fully uploaded (or already in ERP) and the running totals of one backfill run.
+# A run is identified by its folder and date range, a different range starts a fresh checkpoint.
+class Checkpoint:
+    def __init__(self, lm, path, run_key, reset=False):
+        self.lm = lm
+        self.path = path
+        self.run_key = run_key
+        self.done = set()
+        self.totals = defaultdict(int)
+        if not reset and os.path.exists(path):
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data.get("run") == run_key:
+                self.done = set(data.get("done", []))
+                self.totals.update(data.get("totals", {}))
+            else:
+                print(f"Checkpoint {path} belongs to another run ({data.get('run')}), starting fresh.")
+
+    def save(self):
+        self.lm.write_json_atomic(self.path, {
+            "run": self.run_key,
+            "updated": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "totals": dict(self.totals),
+            "done": sorted(self.done)
+        })
+
+
+class Backfill:
+    def __init__(self, lm, api_key, api_secret, erp_url, workers=4, rps=None, dedupe=True, retries=3, retry_delay=5,
+                 dry_run=False):
+        self.lm = lm
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.erp_url = erp_url
+        self.workers = max(1, workers)
+        self.dedupe = dedupe
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.dry_run = dry_run
+        self.known = {}  # model_id -> serial_nos in ERP (or uploaded by this run)
+        self.lock = threading.Lock()
+        client = lm.get_erp_client(api_key, api_secret, erp_url)
+        client.rate_limiter = lm.RateLimiter(rps) if rps else None
+
+    # Serial_nos of a work order already in ERP, read once per work order and kept up to date by the uploads
+    def known_serials(self, model_id):
+        with self.lock:
+            if model_id in self.known:
+                return self.known[model_id]
+        serials = set()
+        if self.dedupe:
+            self.wait_for_erp()
+            serials = self.lm.fetch_erp_serial_nos(model_id, self.api_key, self.api_secret, self.erp_url)
+        with self.lock:
+            return self.known.setdefault(model_id, serials)
+
+    # Waits out an open circuit breaker instead of failing every chunk while ERP is down
+    def wait_for_erp(self):
+        breaker = self.lm.get_erp_breaker()
+        while breaker.is_open():
+            time.sleep(1)
+
+    # Function to upload the records of one work order in bulk chunks, returns {"uploaded", "in_erp", "failed", "failed_files"}
+    def upload_work_order(self, model_id, items):
+        result = {"uploaded": 0, "in_erp": 0, "failed": 0, "failed_files": set()}
+        try:
+            known = self.known_serials(model_id)
+        except Exception as e:
+            print(f"Could not read the existing rows of {model_id}: {e}")
+            logging.error(f"Backfill: could not read the existing rows of {model_id}: {e}")
+            result["failed"] = len(items)
+            result["failed_files"].update(key for key, _ in items)
+            return result
+
+        fresh = [(key, record) for key, record in items if record["serial_no"] not in known]
+        result["in_erp"] = len(items) - len(fresh)
+        batch_size = max(1, int(self.lm.settings["ERP_Batch_Size"]))
+        for start in range(0, len(fresh), batch_size):
+            chunk = fresh[start:start + batch_size]
+            if self.dry_run:
+                ok = True
+            else:
+                self.wait_for_erp()
+                ok = self.lm.send_group_to_erpnext(model_id, [record for _, record in chunk], self.api_key, self.api_secret,
+                                                   self.erp_url, retries=self.retries, delay=self.retry_delay)
+            if ok:
+                known.update(record["serial_no"] for _, record in chunk)
+                result["uploaded"] += len(chunk)
+            else:
+                result["failed"] += len(chunk)
+                result["failed_files"].update(key for key, _ in chunk)
+        return result
+
+    # Function to upload one batch of parsed records - work orders in parallel, each work order in file order
+    def upload(self, items):
+        grouped = defaultdict(list)
+        for key, record in items:
+            grouped[record["model_id"]].append((key, record))
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return list(pool.map(lambda group: self.upload_work_order(*group), grouped.items()))
+
+
+# Function to run the backfill and return the totals
+def run_backfill(lm, folder, api_key, api_secret, erp_url, start=None, end=None, checkpoint_file=None,
+                 files_per_batch=200, workers=4, rps=None, dedupe=True, retries=3, retry_delay=5, dry_run=False,
+                 reset=False):
+    run_key = f"{os.path.abspath(folder)}|{start or ''}|{end or ''}"
+    checkpoint = Checkpoint(lm, checkpoint_file, run_key, reset=reset)
+    backfill = Backfill(lm, api_key, api_secret, erp_url, workers=workers, rps=rps, dedupe=dedupe, retries=retries,
+                        retry_delay=retry_delay, dry_run=dry_run)
+
+    files = list_csv_files(folder, start)
+    todo = [(path, key) for path, key in files if key not in checkpoint.done]
+    print(f"{len(files)} CSV file(s) in range, {len(files) - len(todo)} already done, {len(todo)} to go.")
+    logging.info(f"Backfill started from {folder} ({start} - {end}), {len(todo)} file(s) to go.")
+
+    started = time.perf_counter()
+    sent = 0
+    for batch_start in range(0, len(todo), files_per_batch):
+        batch = todo[batch_start:batch_start + files_per_batch]
+
+        # Parse with the program's own pairing logic, marks split over two files of the batch are merged through an
+        # in-memory pairing buffer. Keep the records of the range, first mark of a serial_no wins.
+        pairing = lm.create_pairing_buffer(None) if lm.settings["Pairing_Buffer_Enabled"] else None
+        parsed = []
+        parse_failed = set()
+        for path, key in batch:
+            try:
+                records, _, _ = read_csv_source(lm, path, pairing)
+            except Exception as e:
+                print(f"Error parsing {path}: {e}")
+                logging.error(f"Backfill: error parsing {path}: {e}")
+                parse_failed.add(key)
+                continue
+            parsed.extend((key, record) for record in records.to_dicts())
+        if pairing is not None:
+            parsed.extend((batch[-1][1], mark.to_dict()) for mark in pairing.expire(drain=True))
+
+        items = []
+        seen = set()
+        for key, record in parsed:
+            marked = record_time(record)
+            if marked is not None and ((start and marked < start) or (end and marked >= end)):
+                continue
+            if record["serial_no"] in seen:
+                checkpoint.totals["duplicates"] += 1
+                continue
+            seen.add(record["serial_no"])
+            items.append((key, record))
+
+        # A merged record may come from two files, so a failed upload keeps the whole batch for the next run
+        results = backfill.upload(items)
+        if any(result["failed_files"] for result in results):
+            failed_files = {key for _, key in batch}
+        else:
+            failed_files = parse_failed
+        checkpoint.done.update(key for _, key in batch if key not in failed_files)
+        checkpoint.totals["records"] += len(items)
+        for name in ("uploaded", "in_erp", "failed"):
+            checkpoint.totals[name] += sum(result[name] for result in results)
+        if not dry_run:
+            checkpoint.save()
+
+        sent += sum(result["uploaded"] for result in results)
+        elapsed = time.perf_counter() - started
+        totals = checkpoint.totals
+        print(f"[{min(batch_start + files_per_batch, len(todo))}/{len(todo)} files] records {totals['records']}, "
+              f"uploaded {totals['uploaded']}, already in ERP {totals['in_erp']}, failed {totals['failed']} "
+              f"- {sent / elapsed if elapsed else 0:.0f} records/s")
+
+    checkpoint.totals["failed_files"] = len([key for _, key in files if key not in checkpoint.done])
+    if not dry_run:
+        checkpoint.save()
+    lm.get_parent_cache().save()
+    logging.info(f"Backfill finished: {dict(checkpoint.totals)}")
+    return dict(checkpoint.totals)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Re-send archived laser marking CSVs to ERP (backfill / replay).")
+    parser.add_argument("--folder", help="Folder (searched recursively) holding the CSVs, default the program's Backup_Folder")
+    parser.add_argument("--from", dest="start", type=parse_date, help="Start of the range, YYYY-MM-DD [HH:MM:SS]")
+    parser.add_argument("--to", dest="end", type=lambda text: parse_date(text, end=True),
+                        help="End of the range, a plain date includes the whole day")
+    parser.add_argument("--config", help="config.json with API_Key, API_Secret, ERP_URL and Settings, default the program's")
+    parser.add_argument("--erp-url", help="Override the ERP_URL of the config")
+    parser.add_argument("--workers", type=int, default=4, help="Work orders uploaded in parallel")
+    parser.add_argument("--rps", type=float, default=20, help="Max ERP requests per second, 0 for no limit")
+    parser.add_argument("--files-per-batch", type=int, default=200, help="CSV files parsed and checkpointed together")
+    parser.add_argument("--retries", type=int, default=3, help="Attempts per bulk request")
+    parser.add_argument("--retry-delay", type=float, default=5, help="Seconds between attempts")
+    parser.add_argument("--no-dedupe", action="store_true", help="Do not read the serial_nos ERP already holds")
+    parser.add_argument("--checkpoint", help="Checkpoint file, default State_Folder/backfill_checkpoint.json")
+    parser.add_argument("--reset", action="store_true", help="Ignore the existing checkpoint")
+    parser.add_argument("--dry-run", action="store_true", help="Parse and dedupe only, nothing is uploaded")
+    parser.add_argument("--program", help="Path of the LM program, default the newest 01_LM_V*.py next to this file")
+    args = parser.parse_args(argv)
+
+    lm = load_lm_module(args.program)
+    lm.init_logging()
+    if args.config:
+        with open(args.config, 'r') as f:
+            config = json.load(f)
+    else:
+        config = lm.load_inputs_from_file()
+    if not config:
+        parser.error("No config.json found, run the program once or pass --config")
+    lm.apply_settings(config)
+    lm.create_folders()
+
+    totals = run_backfill(
+        lm,
+        folder=args.folder or lm.folders["Backup_Folder"],
+        api_key=config["API_Key"],
+        api_secret=config["API_Secret"],
+        erp_url=args.erp_url or config["ERP_URL"],
+        start=args.start,
+        end=args.end,
+        checkpoint_file=args.checkpoint or os.path.join(lm.folders["State_Folder"], "backfill_checkpoint.json"),
+        files_per_batch=max(1, args.files_per_batch),
+        workers=args.workers,
+        rps=args.rps or None,
+        dedupe=not args.no_dedupe,
+        retries=max(1, args.retries),
+        retry_delay=args.retry_delay,
+        dry_run=args.dry_run,
+        reset=args.reset
+    )
+    print(json.dumps(totals, indent=4))
+    return 1 if totals.get("failed_files") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,280 @@
+import argparse
+import contextlib
+import csv
+import gc
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from LM_fake_erp import FakeERP
+from LM_loader import load_lm_module
+
+# Offline throughput benchmark for the LM program.
+# Generates laser marking CSVs, runs task_workflow end to end against the in-process fake ERP and reports
+# records/s, HTTP calls and bytes per record, peak RSS and wall time per stage.
+
+# Stages timed by wrapping the module functions task_workflow calls
+STAGES = (
+    "process_pending_json_files",
+    "copy_new_files",
+    "parse_csv_to_json",
+    "send_to_erpnext_batched",
+    "move_to_done_folder",
+    "move_files_to_backup",
+)
+
+
+# Function to parse a work order mix like "WO1001:3,WO1002:1" into (names, weights)
+def parse_work_order_mix(mix):
+    names, weights = [], []
+    for part in mix.split(","):
+        name, _, weight = part.partition(":")
+        names.append(name.strip())
+        weights.append(float(weight) if weight else 1.0)
+    return names, weights
+
+
+# Function to generate laser marking CSVs in the machine format (SerialNo, PanelNo -T/-B, DateTime, ModelID, ProgramName)
+def generate_csvs(folder, files, boards_per_file, work_orders=("WO1001",), weights=None, single_sided=0.02,
+                  start_serial=0, start_time=None, seed=None):
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    mark_time = start_time or datetime(2024, 1, 1, 8, 0, 0)
+    serial = start_serial
+    paths = []
+    for file_no in range(files):
+        path = os.path.join(folder, f"LM_{mark_time.strftime('%Y%m%d_%H%M%S')}_{start_serial + file_no:06d}.csv")
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["SerialNo", "PanelNo", "DateTime", "ModelID", "ProgramName"])
+            for panel in range(1, boards_per_file + 1):
+                model_id = rng.choices(work_orders, weights)[0]
+                program_name = f"PRG_{model_id}"
+                serial_no = f"KT{serial:010d}"
+                serial += 1
+                sides = ["-T", "-B"]
+                if rng.random() < single_sided:
+                    sides = [rng.choice(sides)]
+                for side in sides:
+                    writer.writerow([serial_no, f"{panel}{side}", mark_time.strftime('%Y-%m-%d %H:%M:%S'), model_id, program_name])
+                    mark_time += timedelta(seconds=2)
+        paths.append(path)
+    return paths, serial
+
+
+# Helper function to point every folder and state file of the LM module into a scratch directory
+def isolate_lm_module(lm, base):
+    for key in lm.folders:
+        lm.folders[key] = os.path.join(base, key)
+    for key in lm.log_folders:
+        lm.log_folders[key] = os.path.join(lm.folders["Logs_Folder"], key)
+    for key, path in lm.state_files.items():
+        lm.state_files[key] = os.path.join(lm.folders["State_Folder"], os.path.basename(path))
+    lm.create_folders()
+    lm.init_logging(os.path.join(lm.folders["Logs_Folder"], "LM_app.log"))
+
+
+# Helper function to wrap the stage functions of the module with wall time accumulators
+def instrument_stages(lm, timings):
+    for name in STAGES:
+        original = getattr(lm, name)
+
+        def timed(*args, __original=original, __name=name, **kwargs):
+            start = time.perf_counter()
+            try:
+                return __original(*args, **kwargs)
+            finally:
+                timings[__name] += time.perf_counter() - start
+
+        setattr(lm, name, timed)
+
+
+# Helper function to read the peak resident set size in MB (None where the platform has no resource module)
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+
+
+# Function to run the benchmark and return the report as a dict
+def run_benchmark(files=20, boards_per_file=100, cycles=3, work_order_mix="WO1001:3,WO1002:1,WO1003:1", latency=0.0,
+                  failure_rate=0.0, settings=None, drain_cycles=10, seed=1, keep=False, quiet=True):
+    lm = load_lm_module()
+    base = tempfile.mkdtemp(prefix="lm_bench_")
+    isolate_lm_module(lm, base)
+    lm.settings["Workflow_Mode"] = "sequential"
+    lm.settings["Outbox_Backoff_Base"] = 0  # Failed rows are retried on the next cycle
+    lm.settings["Breaker_Reset_Timeout"] = 1
+    lm.settings["Settle_Seconds"] = 0  # Generated files are complete when task_workflow runs
+    lm.settings.update(settings or {})
+
+    timings = defaultdict(float)
+    instrument_stages(lm, timings)
+
+    machine_folder = os.path.join(base, "Machine_Data_Folder")
+    work_orders, weights = parse_work_order_mix(work_order_mix)
+    serial = 0
+    generated_records = 0
+    output = io.StringIO()
+
+    with FakeERP(latency=latency, failure_rate=failure_rate, seed=seed) as erp:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(output if quiet else sys.stdout):
+            for cycle in range(cycles):
+                _, next_serial = generate_csvs(machine_folder, files, boards_per_file, work_orders, weights,
+                                               start_serial=serial, seed=seed + cycle)
+                generated_records += next_serial - serial
+                serial = next_serial
+                lm.task_workflow("bench_key", "bench_secret", erp.url, machine_folder)
+
+            # Extra cycles only re-drive rows that failed because of injected errors
+            for _ in range(drain_cycles):
+                pending = [name for name in os.listdir(lm.folders["JSON_Data_Folder"]) if name.endswith(('.json', '.jsonl'))]
+                if not pending:
+                    break
+                if lm.get_erp_breaker().is_open():
+                    time.sleep(lm.get_erp_breaker().reset_timeout)
+                lm.task_workflow("bench_key", "bench_secret", erp.url, machine_folder)
+        elapsed = time.perf_counter() - start
+        stats = erp.stats()
+
+    delivered = stats["child_rows"]
+    report = {
+        "records_generated": generated_records,
+        "records_in_erp": delivered,
+        "records_held_for_pairing": len(lm.get_pairing_buffer()) if lm.settings["Pairing_Buffer_Enabled"] else 0,
+        "wall_time_s": round(elapsed, 3),
+        "records_per_s": round(delivered / elapsed, 1) if elapsed else None,
+        "http_calls": stats["requests_total"],
+        "http_calls_per_record": round(stats["requests_total"] / delivered, 4) if delivered else None,
+        "bytes_per_record": round((stats["bytes_received"] + stats["bytes_sent"]) / delivered, 1) if delivered else None,
+        "bytes_sent_per_record": round(stats["bytes_received"] / delivered, 1) if delivered else None,
+        "calls_by_kind": stats["calls"],
+        "failures_injected": stats["failures_injected"],
+        "peak_rss_mb": peak_rss_mb(),
+        "stage_wall_time_s": {name: round(timings[name], 4) for name in STAGES},
+        "settings": {key: lm.settings[key] for key in sorted(settings or {})},
+    }
+    if keep:
+        report["work_folder"] = base
+    else:
+        shutil.rmtree(base, ignore_errors=True)
+    return report
+
+
+# Reference parser in the per-row dict style the LM program used before MarkBatch (csv.DictReader, one dict per mark)
+def parse_to_dicts(csv_file):
+    records = []
+    panel_dict = {}
+    pd_no = 0
+    with open(csv_file, 'r') as f:
+        for row in csv.DictReader(f):
+            serial_no = row['SerialNo']
+            panel_no = row['PanelNo']
+            if panel_no.endswith('-T'):
+                panel_dict[serial_no] = {'serial_no': serial_no, 'model_id': row['ModelID'], 'program_name': row['ProgramName'],
+                                         'top_panel': panel_no, 'top_time': row['DateTime']}
+            elif panel_no.endswith('-B'):
+                record = panel_dict.pop(serial_no, None) or {'serial_no': serial_no, 'model_id': row['ModelID'],
+                                                             'program_name': row['ProgramName']}
+                record['bottom_panel'] = panel_no
+                record['bottom_time'] = row['DateTime']
+                pd_no += 1
+                record['pd_no'] = f"PD{pd_no:04d}"
+                records.append(record)
+    for record in panel_dict.values():
+        pd_no += 1
+        record['pd_no'] = f"PD{pd_no:04d}"
+        records.append(record)
+    return records
+
+
+# Function to compare memory and CPU per batch of marks - dict records against the MarkBatch columns of the program
+def run_memory_benchmark(marks=100000, seed=1):
+    lm = load_lm_module()
+    folder = tempfile.mkdtemp(prefix="lm_mem_")
+    try:
+        paths, _ = generate_csvs(folder, 1, marks // 2, ("WO1001", "WO1002", "WO1003"), single_sided=0, seed=seed)
+        variants = {
+            "dict_records": (parse_to_dicts,
+                             lambda records: "".join(json.dumps(record, separators=(',', ':')) + "\n" for record in records)),
+            "mark_batch": (lambda path: lm.read_csv_records(path)[0], lambda batch: batch.to_jsonl()),
+        }
+        report = {"marks": marks}
+        for name, (parse, serialize) in variants.items():
+            gc.collect()
+            start = time.perf_counter()
+            records = parse(paths[0])
+            parse_time = time.perf_counter() - start
+            start = time.perf_counter()
+            serialize(records)
+            serialize_time = time.perf_counter() - start
+            del records
+
+            gc.collect()
+            tracemalloc.start()
+            records = parse(paths[0])
+            retained, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del records
+            report[name] = {
+                "retained_mb_per_100k_marks": round(retained / marks * 100000 / (1024 * 1024), 2),
+                "peak_mb_per_100k_marks": round(peak / marks * 100000 / (1024 * 1024), 2),
+                "parse_s": round(parse_time, 3),
+                "jsonl_serialize_s": round(serialize_time, 3),
+            }
+        report["retained_ratio"] = round(report["mark_batch"]["retained_mb_per_100k_marks"]
+                                         / report["dict_records"]["retained_mb_per_100k_marks"], 3)
+        return report
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark for the LM program.")
+    parser.add_argument("--files", type=int, default=20, help="CSV files generated per cycle")
+    parser.add_argument("--boards", type=int, default=100, help="Boards per CSV file")
+    parser.add_argument("--cycles", type=int, default=3, help="task_workflow cycles with new files")
+    parser.add_argument("--work-orders", default="WO1001:3,WO1002:1,WO1003:1", help="Work order mix, NAME:WEIGHT,...")
+    parser.add_argument("--latency", type=float, default=0.0, help="Fake ERP latency per request in seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Share of fake ERP requests answered with 503")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="Override an LM setting, VALUE parsed as JSON when possible (repeatable)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch folder for inspection")
+    parser.add_argument("--verbose", action="store_true", help="Show the LM console output")
+    parser.add_argument("--memory", type=int, metavar="MARKS",
+                        help="Only compare parse memory/CPU of dict records and MarkBatch for this many marks")
+    args = parser.parse_args(argv)
+
+    if args.memory:
+        print(json.dumps(run_memory_benchmark(args.memory, seed=args.seed), indent=4))
+        return
+
+    overrides = {}
+    for item in args.set:
+        key, _, value = item.partition("=")
+        try:
+            overrides[key] = json.loads(value)
+        except ValueError:
+            overrides[key] = value
+
+    report = run_benchmark(files=args.files, boards_per_file=args.boards, cycles=args.cycles,
+                           work_order_mix=args.work_orders, latency=args.latency, failure_rate=args.failure_rate,
+                           settings=overrides, seed=args.seed, keep=args.keep, quiet=not args.verbose)
+    print(json.dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+import contextlib
+import io
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from LM_loader import load_lm_module
+
+# Local stand-in for the Frappe/ERPNext REST API used by the LM program.
+# Serves /api/resource/<Doctype> (list, get, POST, PUT, HEAD) and /api/method/frappe.client.insert_many
+# from memory, and counts calls and bytes so the upload paths can be measured offline.
+
+
+class FakeERP:
+    def __init__(self, doctype="SMT Traceability", child_field="laser_marking", latency=0.0, failure_rate=0.0,
+                 allow_child_insert=True, seed=None):
+        self.doctype = doctype
+        self.child_field = child_field
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.allow_child_insert = allow_child_insert
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.docs = {}
+        self.counter = 0
+        self.reset_stats()
+        self.server = None
+        self.thread = None
+        self.connections = set()
+        self.scheduled_failures = {}  # call kind -> {call number: HTTP status}
+        self.call_numbers = {}
+
+    # ----------------------------------------------------------------------- Stats
+
+    def reset_stats(self):
+        with self.lock:
+            self.calls = {}
+            self.requests_total = 0
+            self.bytes_received = 0
+            self.bytes_sent = 0
+            self.failures_injected = 0
+
+    def record_call(self, kind, received, sent):
+        with self.lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+            self.requests_total += 1
+            self.bytes_received += received
+            self.bytes_sent += sent
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests_total": self.requests_total,
+                "calls": dict(self.calls),
+                "bytes_received": self.bytes_received,
+                "bytes_sent": self.bytes_sent,
+                "failures_injected": self.failures_injected,
+                "documents": len(self.docs),
+                "child_rows": sum(len(doc.get(self.child_field, [])) for doc in self.docs.values()),
+            }
+
+    # Make the number-th call of a kind (e.g. "POST_insert_many", counted from 1) fail with status
+    def fail_call(self, kind, number, status=500):
+        with self.lock:
+            self.scheduled_failures.setdefault(kind, {})[number] = status
+
+    def scheduled_failure(self, kind):
+        with self.lock:
+            number = self.call_numbers.get(kind, 0) + 1
+            self.call_numbers[kind] = number
+            status = self.scheduled_failures.get(kind, {}).pop(number, None)
+            if status is not None:
+                self.failures_injected += 1
+            return status
+
+    # ----------------------------------------------------------------------- Server
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/api/resource/{urllib.parse.quote(self.doctype)}"
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self, host="127.0.0.1", port=0):
+        fake = self
+
+        class Handler(FakeERPHandler):
+            erp = fake
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+            # Drop kept-alive connections too, so clients see the outage like a real server going down
+            with self.lock:
+                connections = list(self.connections)
+            for connection in connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # ----------------------------------------------------------------------- Documents
+
+    def new_name(self):
+        self.counter += 1
+        return f"SMT-TRC-{self.counter:05d}"
+
+    def create_doc(self, doc):
+        with self.lock:
+            name = doc.get("name") or self.new_name()
+            if name in self.docs:
+                return None
+            stored = dict(doc)
+            stored["name"] = name
+            stored["doctype"] = self.doctype
+            rows = []
+            for index, row in enumerate(stored.get(self.child_field, []) or [], start=1):
+                rows.append(dict(row, idx=index, parent=name, parentfield=self.child_field, parenttype=self.doctype))
+            stored[self.child_field] = rows
+            self.docs[name] = stored
+            return json.loads(json.dumps(stored))
+
+    def append_child(self, parent, row):
+        with self.lock:
+            doc = self.docs.get(parent)
+            if doc is None:
+                return None
+            rows = doc.setdefault(self.child_field, [])
+            child = {key: value for key, value in row.items() if key not in ("doctype", "parenttype", "parentfield", "parent")}
+            child.update(idx=len(rows) + 1, parent=parent, parentfield=self.child_field, parenttype=self.doctype)
+            child["name"] = f"{parent}-{len(rows) + 1}"
+            rows.append(child)
+            return child["name"]
+
+    def update_doc(self, name, changes):
+        with self.lock:
+            doc = self.docs.get(name)
+            if doc is None:
+                return None
+            for key, value in changes.items():
+                if key == self.child_field:
+                    value = [dict(row, idx=index, parent=name, parentfield=self.child_field, parenttype=self.doctype)
+                             for index, row in enumerate(value, start=1)]
+                doc[key] = value
+            return json.loads(json.dumps(doc))
+
+    def get_doc(self, name):
+        with self.lock:
+            doc = self.docs.get(name)
+            return json.loads(json.dumps(doc)) if doc is not None else None
+
+    def list_docs(self, filters, fields, limit):
+        with self.lock:
+            matches = []
+            for doc in self.docs.values():
+                if all(match_filter(doc, condition) for condition in filters):
+                    matches.append({field: doc.get(field) for field in fields})
+            if limit:
+                matches = matches[:limit]
+            return matches
+
+
+def match_filter(doc, condition):
+    if isinstance(condition, dict):
+        return all(doc.get(key) == value for key, value in condition.items())
+    field, operator, value = condition[-3:]
+    if operator == "=":
+        return doc.get(field) == value
+    if operator == "in":
+        values = value.split(",") if isinstance(value, str) else value
+        return doc.get(field) in values
+    if operator == "!=":
+        return doc.get(field) != value
+    raise ValueError(f"Unsupported filter operator: {operator}")
+
+
+class FakeERPHandler(BaseHTTPRequestHandler):
+    erp = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass  # Keep benchmark output clean
+
+    def setup(self):
+        super().setup()
+        with self.erp.lock:
+            self.erp.connections.add(self.connection)
+
+    def finish(self):
+        with self.erp.lock:
+            self.erp.connections.discard(self.connection)
+        super().finish()
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def reply(self, status, payload, kind, received):
+        body = json.dumps(payload).encode() if payload is not None else b""
+        self.erp.record_call(kind, received, len(body))  # Counted before replying so the client never sees stale stats
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def route(self):
+        parsed = urllib.parse.urlsplit(self.path)
+        parts = [urllib.parse.unquote(part) for part in parsed.path.split("/") if part]
+        query = urllib.parse.parse_qs(parsed.query)
+        return parts, query
+
+    def before(self, kind, received):
+        if self.erp.latency:
+            time.sleep(self.erp.latency)
+        if self.erp.failure_rate and self.erp.random.random() < self.erp.failure_rate:
+            with self.erp.lock:
+                self.erp.failures_injected += 1
+            self.reply(503, {"exc_type": "ServiceUnavailable"}, kind + "_failed", received)
+            return False
+        status = self.erp.scheduled_failure(kind)
+        if status is not None:
+            self.reply(status, {"exc_type": "InternalServerError"}, kind + "_failed", received)
+            return False
+        return True
+
+    def do_HEAD(self):
+        received = len(self.path)
+        if self.before("HEAD", received):
+            self.reply(200, None, "HEAD", received)
+
+    def do_GET(self):
+        parts, query = self.route()
+        received = len(self.path)
+        if parts[:2] != ["api", "resource"] or len(parts) < 3 or parts[2] != self.erp.doctype:
+            return self.reply(404, {"exc_type": "DoesNotExistError"}, "GET_unknown", received)
+        if len(parts) == 3:
+            if not self.before("GET_list", received):
+                return
+            filters = json.loads(query.get("filters", ["[]"])[0])
+            fields = json.loads(query.get("fields", ['["name"]'])[0])
+            limit = int(query.get("limit_page_length", ["20"])[0])
+            return self.reply(200, {"data": self.erp.list_docs(filters, fields, limit)}, "GET_list", received)
+        if not self.before("GET_doc", received):
+            return
+        doc = self.erp.get_doc(parts[3])
+        if doc is None:
+            return self.reply(404, {"exc_type": "DoesNotExistError"}, "GET_doc", received)
+        return self.reply(200, {"data": doc}, "GET_doc", received)
+
+    def do_POST(self):
+        parts, query = self.route()
+        body = self.read_body()
+        received = len(self.path) + len(body)
+        if parts[:2] == ["api", "method"] and parts[2:] == ["frappe.client.insert_many"]:
+            if not self.before("POST_insert_many", received):
+                return
+            return self.insert_many(json.loads(body or b"{}"), received)
+        if parts[:2] != ["api", "resource"] or len(parts) != 3 or parts[2] != self.erp.doctype:
+            return self.reply(404, {"exc_type": "DoesNotExistError"}, "POST_unknown", received)
+        if not self.before("POST", received):
+            return
+        doc = self.erp.create_doc(json.loads(body or b"{}"))
+        if doc is None:
+            return self.reply(409, {"exc_type": "DuplicateEntryError"}, "POST", received)
+        return self.reply(200, {"data": doc}, "POST", received)
+
+    def do_PUT(self):
+        parts, query = self.route()
+        body = self.read_body()
+        received = len(self.path) + len(body)
+        if parts[:2] != ["api", "resource"] or len(parts) != 4 or parts[2] != self.erp.doctype:
+            return self.reply(404, {"exc_type": "DoesNotExistError"}, "PUT_unknown", received)
+        if not self.before("PUT", received):
+            return
+        doc = self.erp.update_doc(parts[3], json.loads(body or b"{}"))
+        if doc is None:
+            return self.reply(404, {"exc_type": "DoesNotExistError"}, "PUT", received)
+        return self.reply(200, {"data": doc}, "PUT", received)
+
+    def insert_many(self, payload, received):
+        docs = payload.get("docs", [])
+        if isinstance(docs, str):
+            docs = json.loads(docs)
+        names = []
+        if not self.erp.allow_child_insert:  # ERP without the insert_many method
+            return self.reply(405, {"exc_type": "MethodNotAllowed"}, "POST_insert_many", received)
+        for doc in docs:
+            if doc.get("parenttype"):
+                name = self.erp.append_child(doc.get("parent"), doc)
+                if name is None:
+                    return self.reply(404, {"exc_type": "DoesNotExistError"}, "POST_insert_many", received)
+            elif doc.get("doctype") == self.erp.doctype:
+                created = self.erp.create_doc(doc)
+                if created is None:
+                    return self.reply(409, {"exc_type": "DuplicateEntryError"}, "POST_insert_many", received)
+                name = created["name"]
+            else:
+                return self.reply(417, {"exc_type": "ValidationError"}, "POST_insert_many", received)
+            names.append(name)
+        return self.reply(200, {"message": names}, "POST_insert_many", received)
+
+
+# Check that the bytes sent per appended row stay flat while the parent's child table grows.
+# The full_rewrite mode is measured alongside for comparison.
+def check_append_cost(rounds=8, rows_per_round=100, tolerance=0.10):
+    lm = load_lm_module()
+    lm.settings["Parent_Cache_Persist"] = False
+    results = {}
+    for mode in ("child_insert", "full_rewrite"):
+        lm.settings["ERP_Append_Mode"] = mode
+        lm.child_insert_state["disabled"] = False
+        lm.parent_cache = None  # Every mode starts against a fresh fake ERP
+        with FakeERP() as erp:
+            per_row = []
+            for round_no in range(rounds):
+                records = [{
+                    "serial_no": f"{mode[:2].upper()}{round_no:03d}{i:05d}",
+                    "model_id": "WO-CHECK",
+                    "program_name": "PRG",
+                    "top_panel": f"{i}-T",
+                    "top_time": "2024-01-01 10:00:00",
+                    "bottom_panel": f"{i}-B",
+                    "bottom_time": "2024-01-01 10:00:05",
+                } for i in range(rows_per_round)]
+                before = erp.stats()["bytes_received"]
+                with contextlib.redirect_stdout(io.StringIO()):
+                    ok = lm.send_group_to_erpnext("WO-CHECK", records, "key", "secret", erp.url, retries=1)
+                if not ok:
+                    raise AssertionError(f"{mode}: upload failed in round {round_no}")
+                if round_no:  # First round creates the parent with POST, measure appends only
+                    per_row.append((erp.stats()["bytes_received"] - before) / rows_per_round)
+            results[mode] = per_row
+            print(f"{mode:>12}: bytes sent per row by round {[round(value) for value in per_row]}")
+
+    child = results["child_insert"]
+    spread = (max(child) - min(child)) / min(child)
+    if spread > tolerance:
+        raise AssertionError(f"child_insert bytes per row grew by {spread:.1%} as the child table grew")
+    print(f"OK - child_insert bytes per row stay within {spread:.1%} while the table grows")
+    return results
+
+
+# Check that child insert chunks ERP already committed are not sent again when a later chunk of the same upload fails
+def check_partial_failure(rows=450):
+    lm = load_lm_module()
+    lm.settings["Parent_Cache_Persist"] = False
+    lm.settings["ERP_Append_Mode"] = "child_insert"
+    lm.settings["ERP_Batch_Size"] = rows  # One send_group call, split into insert_many chunks of INSERT_MANY_LIMIT
+    lm.settings["Bulk_Parent_Create"] = False
+    lm.child_insert_state["disabled"] = False
+    lm.parent_cache = None
+    with FakeERP() as erp:
+        existing = erp.create_doc({"model_id": "WO-PARTIAL", "laser_marking": [{"serial_no": "PARENT"}]})
+        records = [{
+            "serial_no": f"PF{i:05d}",
+            "model_id": "WO-PARTIAL",
+            "program_name": "PRG",
+            "top_panel": f"{i}-T",
+            "top_time": "2024-01-01 10:00:00",
+            "bottom_panel": f"{i}-B",
+            "bottom_time": "2024-01-01 10:00:05",
+        } for i in range(rows)]
+        erp.fail_call("POST_insert_many", 2)
+        pending = records
+        for attempt in range(3):
+            with contextlib.redirect_stdout(io.StringIO()):
+                _, results = lm.send_to_erpnext_batched(pending, "key", "secret", erp.url, retries=1)
+            pending = [record for record, ok in zip(pending, results) if not ok]
+            if not pending:
+                break
+        child_rows = len(erp.get_doc(existing["name"])["laser_marking"])
+        if pending or child_rows != rows + 1:
+            raise AssertionError(f"partial failure: ERP holds {child_rows} rows, expected {rows + 1} "
+                                 f"({len(pending)} still pending)")
+    print(f"OK - {rows} rows with a failed insert_many chunk reached ERP exactly once after {attempt + 1} upload(s)")
+
+
+if __name__ == "__main__":
+    if "--check" in sys.argv:
+        check_append_cost()
+        check_partial_failure()
+    else:
+        port = int(sys.argv[1]) if len(sys.argv) > 1 else 8001
+        erp = FakeERP().start(port=port)
+        print(f"Fake ERP listening on {erp.url} - Ctrl+C to stop")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            erp.stop()
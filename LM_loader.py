@@ -0,0 +1,17 @@
+import glob
+import importlib.util
+import os
+
+# Shared by the helper tools (LM_backfill.py, LM_benchmark.py, LM_fake_erp.py) - the program file name starts with a
+# digit and carries its version, so it cannot be imported by name.
+
+
+# Helper function to load the LM program as a module, by default the newest 01_LM_V*.py next to this file
+def load_lm_module(path=None):
+    if path is None:
+        candidates = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "01_LM_V*.py")))
+        path = candidates[-1]
+    spec = importlib.util.spec_from_file_location("lm_program", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
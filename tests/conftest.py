@@ -0,0 +1,46 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from LM_benchmark import isolate_lm_module
+from LM_fake_erp import FakeERP
+from LM_loader import load_lm_module
+
+
+# Fresh copy of the LM program per test, every folder and state file under tmp_path
+@pytest.fixture
+def lm(tmp_path):
+    module = load_lm_module()
+    isolate_lm_module(module, str(tmp_path))
+    module.settings["Parent_Cache_Persist"] = False
+    module.settings["Metrics_Enabled"] = False
+    yield module
+    if module.outbox is not None:
+        module.outbox.close()
+    if module.ingest_manifest is not None:
+        module.ingest_manifest.close()
+    if module.upload_executor is not None:
+        module.upload_executor.shutdown(wait=True)
+
+
+@pytest.fixture
+def erp():
+    with FakeERP() as fake:
+        yield fake
+
+
+# Helper function to build paired laser marking records of one work order
+def make_records(model_id, count, prefix="S"):
+    return [{
+        "serial_no": f"{prefix}{i:05d}",
+        "pd_no": f"PD{i + 1:04d}",
+        "model_id": model_id,
+        "program_name": "PRG",
+        "top_panel": f"{i}-T",
+        "top_time": "2024-01-01 10:00:00",
+        "bottom_panel": f"{i}-B",
+        "bottom_time": "2024-01-01 10:00:05",
+    } for i in range(count)]
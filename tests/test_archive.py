@@ -0,0 +1,32 @@
+import os
+import time
+import zipfile
+
+
+def test_archive_is_off_by_default(lm):
+    assert lm.settings["Archive_Enabled"] is False
+
+
+def test_old_files_are_packed_by_day_and_restored(lm, tmp_path):
+    done = lm.folders["Done_Folder"]
+    old = time.time() - 5 * 86400
+    for name in ("data_a.json", "data_b.json", lm.SERIAL_INDEX_EXPORT_NAME):
+        with open(os.path.join(done, name), 'w') as f:
+            f.write('{"name": "%s"}' % name)
+        os.utime(os.path.join(done, name), (old, old))
+    with open(os.path.join(done, "data_new.json"), 'w') as f:
+        f.write("{}")
+
+    stats = lm.archive_folder(done, after_hours=48, extensions=('.json',), keep=(lm.SERIAL_INDEX_EXPORT_NAME,))
+
+    assert stats["sharded"] == stats["packed"] == 2
+    assert set(name for name in os.listdir(done) if not name.isdigit()) == {"data_new.json", lm.SERIAL_INDEX_EXPORT_NAME}
+    day = time.strftime('%Y/%m/%d', time.localtime(old))
+    with zipfile.ZipFile(os.path.join(done, day + ".zip")) as zf:
+        assert sorted(zf.namelist()) == ["data_a.json", "data_b.json"]
+
+    restored = lm.restore_archived_file("data_b.json", str(tmp_path / "restored"))
+
+    with open(restored) as f:
+        assert f.read() == '{"name": "data_b.json"}'
+    assert lm.restore_archived_file("data_missing.json", str(tmp_path / "restored")) is None
@@ -0,0 +1,14 @@
+import pytest
+
+from conftest import make_records
+
+
+@pytest.mark.parametrize("status, disabled", [(403, False), (417, False), (500, False), (405, True), (404, True)])
+def test_child_insert_disabled_only_when_method_is_missing(lm, erp, status, disabled):
+    erp.create_doc({"model_id": "WO1", "laser_marking": []})
+    erp.fail_call("POST_insert_many", 1, status)
+
+    ok = lm.send_group_to_erpnext("WO1", make_records("WO1", 1), "key", "secret", erp.url, retries=1, delay=0)
+
+    assert ok is disabled  # The full rewrite fallback delivers the row right away
+    assert lm.child_insert_state["disabled"] is disabled
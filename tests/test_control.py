@@ -0,0 +1,27 @@
+import json
+import os
+
+
+def test_control_command_is_read_once(lm):
+    control_file = lm.state_files["Control_File"]
+    with open(control_file, 'w') as f:
+        f.write(" sweep\n")
+
+    assert lm.read_control_command(control_file) == "SWEEP"
+    assert not os.path.exists(control_file)
+    assert lm.read_control_command(control_file) is None
+
+
+def test_status_lists_breaker_and_pending_files(lm):
+    source = lm.resolve_source(None)
+    with open(os.path.join(source.folders["JSON_Data_Folder"], "data_1.jsonl"), 'w') as f:
+        f.write("{}\n")
+
+    lm.write_status(lm.state_files["Status_File"], [source])
+
+    with open(lm.state_files["Status_File"]) as f:
+        status = json.load(f)
+    assert status["erp_breaker"] == lm.CircuitBreaker.CLOSED
+    assert status["pipeline"] is None
+    assert status["sources"][source.name]["pending_json_files"] == 1
+    assert status["sources"][source.name]["busy"] is False
@@ -0,0 +1,47 @@
+import pytest
+
+from conftest import make_records
+
+
+def test_open_breaker_uses_no_rate_limiter_token(lm, erp):
+    breaker = lm.CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    client = lm.ERPClient("key", "secret", erp.url, breaker=breaker)
+    client.rate_limiter = lm.RateLimiter(rate=0.01, burst=3)
+    breaker.record_failure("down")
+
+    for _ in range(3):
+        with pytest.raises(lm.CircuitOpenError):
+            client.get(erp.url)
+
+    assert client.rate_limiter.tokens == 3
+    client.close()
+
+
+def test_breaker_opens_after_failures_and_closes_after_a_probe(lm, erp):
+    breaker = lm.CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    client = lm.ERPClient("key", "secret", erp.url, breaker=breaker)
+    erp.fail_call("GET_list", 1, status=502)
+    erp.fail_call("GET_list", 2, status=503)
+
+    assert client.get(erp.url).status_code == 502
+    assert client.get(erp.url).status_code == 503
+    assert breaker.state == lm.CircuitBreaker.OPEN
+    with pytest.raises(lm.CircuitOpenError):
+        client.get(erp.url)
+    assert erp.stats()["calls"]["GET_list_failed"] == 2
+
+    breaker.opened_at -= 61  # Reset timeout passed, one probe goes through
+    assert client.get(erp.url).status_code == 200
+    assert breaker.state == lm.CircuitBreaker.CLOSED
+    client.close()
+
+
+def test_upload_is_skipped_while_the_breaker_is_open(lm, erp):
+    lm.settings["Breaker_Failure_Threshold"] = 1
+    lm.get_erp_breaker().record_failure("down")
+
+    ok, results = lm.send_to_erpnext_batched(make_records("WO1", 5), "key", "secret", erp.url, retries=1)
+
+    assert not ok
+    assert results == [None] * 5  # Still pending, no retry attempt used up
+    assert erp.stats()["calls"] == {}
@@ -0,0 +1,69 @@
+import hashlib
+import json
+import os
+import sqlite3
+from datetime import datetime, timedelta
+
+from conftest import make_records
+
+
+def test_serial_index_export_is_incremental_and_pruned(lm, tmp_path):
+    export_path = str(tmp_path / "export.db")
+    index = lm.SerialIndex(str(tmp_path / "live.db"), export_path=export_path, retention_days=30)
+    index.add_records(make_records("WO1", 100), "a.json")
+    index.export(force=True)
+
+    index.add_records([{"serial_no": "S00005", "model_id": "WO9"}], "b.json")
+    index.export(force=True)
+    assert lm.lookup_serial_no("S00005", export_path)["model_id"] == "WO9"
+    assert sqlite3.connect(export_path).execute("SELECT seq FROM export_state").fetchone()[0] == index.seq
+
+    # Everything but S00005 was last seen 40 days ago
+    for conn in (index.conn, sqlite3.connect(export_path)):
+        conn.execute("UPDATE serials SET updated_at = updated_at - 40 * 86400 WHERE serial_no != 'S00005'")
+        conn.commit()
+    index.last_prune = 0
+    index.export(force=True)
+
+    assert lm.lookup_serial_no("S00001", export_path) is None
+    assert lm.lookup_serial_no("S00005", export_path) is not None
+    assert index.lookup("S00001") is None
+
+
+def test_failed_serial_index_export_keeps_the_old_file_and_stays_dirty(lm, tmp_path, monkeypatch):
+    export_path = str(tmp_path / "export.db")
+    index = lm.SerialIndex(str(tmp_path / "live.db"), export_path=export_path)
+    index.add_records(make_records("WO1", 10), "a.json")
+    index.export(force=True)
+    assert not index.dirty
+
+    index.add_records([{"serial_no": "S00005", "model_id": "WO9"}], "b.json")
+    with monkeypatch.context() as m:
+        m.setattr(lm.os, "replace", lambda src, dst: (_ for _ in ()).throw(OSError("disk full")))
+        index.export(force=True)
+
+    assert index.dirty
+    assert lm.lookup_serial_no("S00005", export_path)["model_id"] == "WO1"
+    index.export(force=True)
+    assert not index.dirty
+    assert lm.lookup_serial_no("S00005", export_path)["model_id"] == "WO9"
+
+
+def test_bundle_segment_is_appended_with_matching_sha256(lm):
+    now = datetime(2024, 1, 1, 10, 0)
+    for minute in range(3):
+        lm.export_records_to_bundles(make_records("WO1", 10, f"M{minute}"), now + timedelta(minutes=minute))
+    segment_path = os.path.join(lm.folders["Export_Folder"], "segments", "lm_2024-01-01_10.jsonl.gz")
+    with open(segment_path, 'ab') as f:
+        f.write(b"cut short")  # Append interrupted by a crash
+    lm.segment_hashers.clear()  # Restart
+
+    lm.export_records_to_bundles(make_records("WO1", 10, "M3"), now + timedelta(minutes=3))
+
+    with open(os.path.join(lm.folders["Export_Folder"], "manifest_24h.json")) as f:
+        entry = json.load(f)["segments"][0]
+    with open(segment_path, 'rb') as f:
+        data = f.read()
+    assert entry["size"] == len(data)
+    assert entry["sha256"] == hashlib.sha256(data).hexdigest()
+    assert len(lm.read_bundle_segment(segment_path)) == entry["records"] == 40
@@ -0,0 +1,83 @@
+import os
+
+
+def write_machine_file(folder, name, text="SerialNo,PanelNo,DateTime,ModelID,ProgramName\n", age=1000):
+    path = os.path.join(folder, name)
+    with open(path, 'w') as f:
+        f.write(text)
+    past = os.path.getmtime(path) - age
+    os.utime(path, (past, past))
+    return path
+
+
+def copy_log(lm):
+    return os.path.join(lm.log_folders["Copy_Logs"], "copy_logs_2024-01-01.log")
+
+
+def test_known_file_is_not_copied_again(lm, tmp_path):
+    source = tmp_path / "machine"
+    source.mkdir()
+    write_machine_file(str(source), "LM_1.csv")
+    lm.settings.update(Settle_Seconds=0, Staging_Mode="copy")
+
+    assert lm.copy_new_files(str(source), lm.folders["Scan_Folder"], copy_log(lm)) == ["LM_1.csv"]
+    os.remove(os.path.join(lm.folders["Scan_Folder"], "LM_1.csv"))
+    assert lm.copy_new_files(str(source), lm.folders["Scan_Folder"], copy_log(lm)) == []
+
+
+def test_rewritten_file_is_copied_again(lm, tmp_path):
+    source = tmp_path / "machine"
+    source.mkdir()
+    write_machine_file(str(source), "LM_1.csv")
+    lm.settings.update(Settle_Seconds=0, Staging_Mode="copy", Incremental_Scan=False)
+    lm.copy_new_files(str(source), lm.folders["Scan_Folder"], copy_log(lm))
+
+    write_machine_file(str(source), "LM_1.csv", "SerialNo,PanelNo,DateTime,ModelID,ProgramName\nS1,1-T,x,WO,P\n")
+
+    assert lm.copy_new_files(str(source), lm.folders["Scan_Folder"], copy_log(lm)) == ["LM_1.csv"]
+
+
+def test_old_copy_logs_are_migrated_once(lm, tmp_path):
+    source = tmp_path / "machine"
+    source.mkdir()
+    write_machine_file(str(source), "LM_1.csv")
+    write_machine_file(str(source), "LM_2.csv")
+    os.makedirs(lm.log_folders["Copy_Logs"], exist_ok=True)
+    with open(os.path.join(lm.log_folders["Copy_Logs"], "copy_logs_2023-12-31.log"), 'w') as f:
+        f.write("LM_1.csv\nLM_gone.csv\n")
+    lm.settings.update(Settle_Seconds=0, Staging_Mode="copy")
+
+    assert lm.copy_new_files(str(source), lm.folders["Scan_Folder"], copy_log(lm)) == ["LM_2.csv"]
+    assert lm.get_ingest_manifest().migrated
+    assert lm.get_ingest_manifest().migrate_copy_logs(lm.log_folders["Copy_Logs"], str(source)) == 0
+
+
+def test_manifest_survives_a_restart(lm, tmp_path):
+    db_path = str(tmp_path / "manifest.db")
+    manifest = lm.IngestManifest(db_path)
+    manifest.add("LM_1.csv", 10, 123)
+    manifest.close()
+
+    reopened = lm.IngestManifest(db_path)
+
+    assert reopened.contains("LM_1.csv", 10, 123)
+    assert not reopened.contains("LM_1.csv", 11, 123)
+
+
+def test_old_entries_are_pruned_once_the_file_is_gone(lm, tmp_path):
+    source = tmp_path / "machine"
+    source.mkdir()
+    write_machine_file(str(source), "LM_kept.csv")
+    manifest = lm.IngestManifest(str(tmp_path / "manifest.db"))
+    manifest.add("LM_kept.csv", 1, 1)
+    manifest.add("LM_gone.csv", 1, 1)
+    manifest.add("LM_new.csv", 1, 1)
+    manifest.conn.execute("UPDATE ingested SET ingested_at = '2000-01-01 00:00:00' WHERE file_name != 'LM_new.csv'")
+
+    assert manifest.prune(30, str(source)) == 1
+
+    assert manifest.contains("LM_kept.csv", 1, 1)  # Still in the machine folder
+    assert not manifest.contains("LM_gone.csv", 1, 1)
+    assert manifest.contains("LM_new.csv", 1, 1)
+    assert manifest.conn.execute("SELECT COUNT(*) FROM ingested").fetchone()[0] == 2
+    assert manifest.prune(30, str(source)) == 0  # Once an hour
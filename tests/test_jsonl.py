@@ -0,0 +1,33 @@
+import json
+import os
+
+from conftest import make_records
+
+
+def test_restart_resumes_from_the_state_file(lm, tmp_path):
+    jsonl_file = str(tmp_path / "data.jsonl")
+    lm.append_jsonl_records(jsonl_file, make_records("WO1", 3), "PD0003")
+    lm.jsonl_state.clear()  # Restart
+
+    assert lm.get_jsonl_last_pd_no(jsonl_file) == "PD0003"
+    with open(lm.get_jsonl_state_file(jsonl_file)) as f:
+        assert json.load(f)["size"] == os.path.getsize(jsonl_file)
+
+
+def test_lines_past_the_state_file_are_recovered_and_a_torn_line_cut(lm, tmp_path):
+    jsonl_file = str(tmp_path / "data.jsonl")
+    lm.append_jsonl_records(jsonl_file, make_records("WO1", 3), "PD0003")
+    with open(jsonl_file, 'a') as f:
+        # Crash after the append but before the sidecar update, then in the middle of the next line
+        f.write(json.dumps({"serial_no": "X1", "pd_no": "PD0004"}) + "\n")
+        f.write('{"serial_no": "X2", "pd_')
+    lm.jsonl_state.clear()
+
+    assert lm.get_jsonl_last_pd_no(jsonl_file) == "PD0004"
+    lm.append_jsonl_records(jsonl_file, make_records("WO1", 1, "Y"), "PD0005")
+
+    records = lm.read_jsonl_records(jsonl_file)
+    assert [record["pd_no"] for record in records] == ["PD0001", "PD0002", "PD0003", "PD0004", "PD0001"]
+    document = lm.convert_jsonl_to_document(jsonl_file, str(tmp_path / "data.json"))
+    assert document["model_id"] == "WO1"
+    assert len(document["laser_marking"]) == 5
@@ -0,0 +1,72 @@
+import os
+import sqlite3
+
+from conftest import make_records
+
+
+def test_failed_rows_of_a_work_order_share_one_backoff(lm, tmp_path):
+    outbox = lm.Outbox(str(tmp_path / "outbox.db"), backoff_base=100, backoff_max=900)
+    outbox.enqueue("a.json", make_records("WO1", 6))
+    keys = [key for key, _ in outbox.due("a.json")]
+
+    outbox.mark_failed(keys[:4], "upload failed")
+
+    rows = outbox.conn.execute("SELECT attempts, next_attempt_at FROM outbox ORDER BY rowid").fetchall()
+    assert {row for row in rows[:4]} == {rows[0]}  # One jitter for the whole batch
+    assert rows[0][0] == 1
+    assert rows[4:] == [(0, 0), (0, 0)]  # Not part of the failed batch, no attempt used up
+
+
+def test_work_order_in_backoff_holds_back_its_later_rows(lm, tmp_path):
+    outbox = lm.Outbox(str(tmp_path / "outbox.db"), backoff_base=100, backoff_max=900)
+    outbox.enqueue("a.json", make_records("WO1", 3, "A") + make_records("WO2", 2, "B"))
+    outbox.enqueue("b.json", make_records("WO1", 2, "C"))
+    keys = [key for key, _ in outbox.due("a.json")]
+
+    outbox.mark_failed(keys[:1], "upload failed")
+
+    assert [record["model_id"] for _, record in outbox.due("a.json")] == ["WO2", "WO2"]
+    assert outbox.due("b.json") == []  # Same work order from another file waits too
+    outbox.conn.execute("UPDATE outbox SET next_attempt_at = 0")
+    assert len(outbox.due("a.json")) == 5
+
+
+def test_delivered_serial_is_not_sent_again_from_another_file(lm, tmp_path):
+    outbox = lm.Outbox(str(tmp_path / "outbox.db"))
+    outbox.enqueue("a.json", make_records("WO1", 2))
+    outbox.mark_delivered([key for key, _ in outbox.due("a.json")])
+    outbox.enqueue(os.path.join("x", "b.json"), make_records("WO1", 3))
+
+    assert [record["serial_no"] for _, record in outbox.due("b.json")] == ["S00002"]
+    assert outbox.pending_count("a.json") == 0
+
+
+def test_only_sides_already_acknowledged_are_duplicates(lm, tmp_path):
+    outbox = lm.Outbox(str(tmp_path / "outbox.db"))
+    record = make_records("WO1", 1)[0]
+    outbox.enqueue("a.json", [dict(record, bottom_panel="", bottom_time="")])
+    outbox.mark_delivered([key for key, _ in outbox.due("a.json")])
+
+    outbox.enqueue("b.json", [dict(record, top_panel="", top_time="", pd_no="PD0009")])
+    outbox.enqueue("c.json", [dict(record, bottom_panel="", bottom_time="", pd_no="PD0010")])
+
+    assert len(outbox.due("b.json")) == 1  # Bottom half never reached ERP
+    assert outbox.due("c.json") == []  # Top half again
+    outbox.mark_delivered([key for key, _ in outbox.due("b.json")])
+    outbox.enqueue("d.json", [dict(record, pd_no="PD0011")])
+    assert outbox.due("d.json") == []  # Both sides acknowledged
+
+
+def test_acknowledged_serials_of_older_stores_cover_both_sides(lm, tmp_path):
+    db_path = str(tmp_path / "outbox.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE acknowledged (serial_no TEXT PRIMARY KEY, model_id TEXT, source_file TEXT, "
+                 "delivered_at TEXT NOT NULL)")
+    conn.execute("INSERT INTO acknowledged VALUES ('S00000', 'WO1', 'old.json', '2024-01-01 00:00:00')")
+    conn.commit()
+    conn.close()
+
+    outbox = lm.Outbox(db_path)
+    outbox.enqueue("a.json", make_records("WO1", 2))
+
+    assert [record["serial_no"] for _, record in outbox.due("a.json")] == ["S00001"]
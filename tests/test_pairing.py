@@ -0,0 +1,91 @@
+import json
+import threading
+
+from conftest import make_records
+
+
+def write_csv(path, rows):
+    with open(path, 'w') as f:
+        f.write("SerialNo,PanelNo,DateTime,ModelID,ProgramName\n")
+        for row in rows:
+            f.write(",".join(row) + "\n")
+
+
+def test_halves_are_paired_across_files(lm, tmp_path):
+    pairing = lm.create_pairing_buffer(None)
+    write_csv(tmp_path / "a.csv", [("S1", "1-T", "2024-01-01 10:00:00", "WO1", "PRG")])
+    write_csv(tmp_path / "b.csv", [("S1", "1-B", "2024-01-01 10:00:05", "WO1", "PRG")])
+
+    first, last_pd_no, _ = lm.read_csv_records(str(tmp_path / "a.csv"), pairing=pairing)
+    second, _, _ = lm.read_csv_records(str(tmp_path / "b.csv"), last_pd_no, pairing=pairing)
+
+    assert len(first) == 0
+    assert second.to_dicts()[0]["top_panel"] == "1-T"
+    assert second.to_dicts()[0]["bottom_panel"] == "1-B"
+
+
+def test_concurrent_saves_leave_a_readable_file(lm, tmp_path):
+    persist_file = str(tmp_path / "pairing.json")
+    pairing = lm.PairingBuffer(persist_file=persist_file)
+    marks = [lm.LaserMark(record["serial_no"], "WO1", "PRG", record["top_panel"], record["top_time"])
+             for record in make_records("WO1", 400)]
+    errors = []
+
+    def worker(part):
+        try:
+            for mark in marks[part::4]:
+                pairing.put(mark)
+                pairing.save()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(part,)) for part in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    pairing.save()
+
+    assert not errors
+    with open(persist_file) as f:
+        assert len(json.load(f)["halves"]) == 400
+    restored = lm.PairingBuffer(persist_file=persist_file)
+    assert len(restored) == 400
+
+
+def test_parent_cache_concurrent_saves(lm, tmp_path):
+    persist_file = str(tmp_path / "parents.json")
+    cache = lm.ParentNameCache(persist_file=persist_file)
+
+    def worker(part):
+        for i in range(100):
+            cache.put(f"WO{part}-{i}", f"SMT-{part}-{i}")
+            cache.save()
+
+    threads = [threading.Thread(target=worker, args=(part,)) for part in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    cache.save()
+
+    with open(persist_file) as f:
+        assert len(json.load(f)) == 400
+
+
+def test_concurrent_observe_keeps_the_newest_time(lm):
+    pairing = lm.PairingBuffer()
+    times = [f"2024-01-01 10:{minute:02d}:{second:02d}" for minute in range(60) for second in range(60)]
+
+    def worker(part):
+        for panel_time in times[part::4]:
+            pairing.observe(panel_time)
+
+    threads = [threading.Thread(target=worker, args=(part,)) for part in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert pairing.newest_text == times[-1]
+    assert pairing.newest_mark == lm.PairingBuffer.mark_time(times[-1])
@@ -0,0 +1,47 @@
+def test_entries_expire_after_their_ttl(lm):
+    cache = lm.ParentNameCache(ttl=60, negative_ttl=5)
+    cache.put("WO1", "SMT-0001")
+    cache.put("WO2", None)
+
+    assert cache.get("WO1") == (True, "SMT-0001")
+    assert cache.get("WO2") == (True, None)
+
+    # Ten seconds later the negative entry is gone, the known name is still served
+    cache.entries = lm.OrderedDict((model_id, (name, expires_at - 10))
+                                   for model_id, (name, expires_at) in cache.entries.items())
+    assert cache.get("WO1") == (True, "SMT-0001")
+    assert cache.get("WO2") == (False, None)
+    assert "WO2" not in cache.entries
+    assert cache.stats() == {"size": 1, "hits": 2, "negative_hits": 1, "misses": 1, "evictions": 0}
+
+
+def test_negative_entries_are_not_persisted(lm, tmp_path):
+    persist_file = str(tmp_path / "parents.json")
+    cache = lm.ParentNameCache(persist_file=persist_file)
+    cache.put("WO1", "SMT-0001")
+    cache.put("WO2", None)
+    cache.save()
+
+    restored = lm.ParentNameCache(persist_file=persist_file)
+
+    assert restored.get("WO1") == (True, "SMT-0001")
+    assert restored.get("WO2") == (False, None)
+
+
+def test_cache_counters_are_exposed_as_gauges(lm):
+    lm.parent_cache = lm.ParentNameCache(max_size=2)
+    lm.register_metric_gauges()
+    lm.parent_cache.put("WO1", "SMT-0001")
+    lm.parent_cache.put("WO2", None)
+    lm.parent_cache.put("WO3", "SMT-0003")  # Evicts WO1
+    lm.parent_cache.get("WO1")
+    lm.parent_cache.get("WO2")
+    lm.parent_cache.get("WO3")
+
+    gauges = lm.metrics.read_gauges()
+
+    assert gauges[("lm_parent_cache_entries", ())] == 2
+    assert gauges[("lm_parent_cache_evictions", ())] == 1
+    for result in ("hit", "negative_hit", "miss"):
+        assert gauges[("lm_parent_cache_lookups", (("result", result),))] == 1
+    assert 'lm_parent_cache_lookups{result="negative_hit"} 1' in lm.metrics.render_prometheus()
@@ -0,0 +1,53 @@
+import os
+import time
+
+
+def age_folder(folder, seconds=100):
+    past = time.time() - seconds
+    os.utime(folder, (past, past))
+
+
+def test_unsettled_file_is_copied_once_it_settles(lm, tmp_path):
+    source = tmp_path / "machine"
+    source.mkdir()
+    (source / "LM_1.csv").write_text("SerialNo,PanelNo,DateTime,ModelID,ProgramName\n")
+    age_folder(source)  # Directory mtime unchanged from here on
+    lm.settings.update(Incremental_Scan=True, Scan_Hot_Seconds=0, Settle_Seconds=60, Staging_Mode="copy")
+    copy_log = os.path.join(lm.log_folders["Copy_Logs"], "copy.log")
+
+    assert lm.copy_new_files(str(source), lm.folders["Scan_Folder"], copy_log) == []
+    lm.settings["Settle_Seconds"] = 0
+    assert lm.copy_new_files(str(source), lm.folders["Scan_Folder"], copy_log) == ["LM_1.csv"]
+
+
+def test_unchanged_folder_is_not_listed_again(lm, tmp_path):
+    folder = tmp_path / "machine"
+    folder.mkdir()
+    for i in range(5):
+        (folder / f"LM_{i}.csv").write_text("x")
+    past = time.time() - 1000
+    for i in range(5):
+        os.utime(folder / f"LM_{i}.csv", (past, past))
+    age_folder(folder)
+    scanner = lm.FolderScanner(str(folder), full_interval=3600, hot_seconds=300)
+
+    assert len(scanner.scan()) == 5
+    assert scanner.scan() == []
+    (folder / "LM_5.csv").write_text("x")
+    assert [name for name, _, _ in scanner.scan()] == ["LM_5.csv"]
+
+
+def test_keep_hot_returns_names_without_a_directory_change(lm, tmp_path):
+    folder = tmp_path / "machine"
+    folder.mkdir()
+    (folder / "LM_1.csv").write_text("x")
+    past = time.time() - 1000
+    os.utime(folder / "LM_1.csv", (past, past))
+    age_folder(folder)
+    scanner = lm.FolderScanner(str(folder), full_interval=3600, hot_seconds=300)
+    scanner.scan()
+
+    scanner.keep_hot(["LM_1.csv"])
+
+    assert [name for name, _, _ in scanner.scan()] == ["LM_1.csv"]
+    assert scanner.scan() == []
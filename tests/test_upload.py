@@ -0,0 +1,73 @@
+import json
+import os
+
+from conftest import make_records
+
+
+def child_rows(erp, name):
+    return [row["serial_no"] for row in erp.get_doc(name)["laser_marking"]]
+
+
+def write_json_file(lm, name, records):
+    path = os.path.join(lm.folders["JSON_Data_Folder"], name)
+    with open(path, 'w') as f:
+        json.dump({"laser_marking": records}, f)
+    return path
+
+
+def test_partial_child_insert_reports_delivered_chunks(lm, erp):
+    parent = erp.create_doc({"model_id": "WO1", "laser_marking": []})
+    erp.fail_call("POST_insert_many", 2)
+    results = [False] * 450
+
+    ok = lm.send_group_to_erpnext("WO1", make_records("WO1", 450), "key", "secret", erp.url, retries=1, delay=0,
+                                  record_results=results)
+
+    assert not ok
+    assert results == [True] * lm.INSERT_MANY_LIMIT + [False] * 250
+    assert len(child_rows(erp, parent["name"])) == lm.INSERT_MANY_LIMIT
+
+
+def test_partial_failure_is_not_resent_by_the_outbox(lm, erp):
+    lm.settings["ERP_Batch_Size"] = 450
+    lm.settings["Outbox_Backoff_Base"] = 0
+    parent = erp.create_doc({"model_id": "WO1", "laser_marking": []})
+    erp.fail_call("POST_insert_many", 2)
+    json_file = write_json_file(lm, "LM_test.json", make_records("WO1", 450))
+
+    assert lm.process_json_files([json_file], "key", "secret", erp.url) == {json_file: False}
+    assert lm.process_json_files([json_file], "key", "secret", erp.url) == {json_file: True}
+
+    rows = child_rows(erp, parent["name"])
+    assert len(rows) == 450
+    assert rows == sorted(rows)
+    assert os.path.exists(os.path.join(lm.folders["Done_Folder"], "LM_test.json"))
+
+
+def test_held_back_chunks_use_no_attempt(lm, erp):
+    lm.settings["ERP_Batch_Size"] = 100
+    lm.settings["Outbox_Backoff_Base"] = 60
+    parent = erp.create_doc({"model_id": "WO1", "laser_marking": []})
+    erp.fail_call("POST_insert_many", 2)
+    json_file = write_json_file(lm, "LM_test.json", make_records("WO1", 300))
+
+    lm.process_json_files([json_file], "key", "secret", erp.url)
+
+    attempts = lm.get_outbox().conn.execute(
+        "SELECT state, attempts, COUNT(*) FROM outbox GROUP BY state, attempts ORDER BY state, attempts").fetchall()
+    assert attempts == [("delivered", 1, 100), ("pending", 0, 100), ("pending", 1, 100)]
+    assert len(child_rows(erp, parent["name"])) == 100
+    assert lm.get_outbox().due(json_file) == []  # The later rows wait for the failed chunk
+
+
+def test_bottom_half_after_a_delivered_top_half_is_sent(lm, erp):
+    top = [dict(record, bottom_panel="", bottom_time="") for record in make_records("WO1", 1)]
+    bottom = [dict(record, top_panel="", top_time="") for record in make_records("WO1", 1)]
+    first = write_json_file(lm, "LM_a.json", top)
+    assert lm.process_json_files([first], "key", "secret", erp.url) == {first: True}
+
+    second = write_json_file(lm, "LM_b.json", bottom)
+    assert lm.process_json_files([second], "key", "secret", erp.url) == {second: True}
+
+    rows = [doc["laser_marking"] for doc in erp.docs.values()][0]
+    assert [(row["top_panel"], row["bottom_panel"]) for row in rows] == [("0-T", ""), ("", "0-B")]